@@ -0,0 +1,100 @@
+"""
+Compare two e2e_bench.py reports and flag performance regressions.
+
+    python benchmarks/compare.py results/bench-main.json results/bench-branch.json --threshold 10
+
+Prints the per-phase change in throughput, latency percentiles, CPU and
+memory, and exits with status 1 if any phase lost more than ``--threshold``
+percent of its throughput or gained more than that on p95/p99 latency.
+"""
+import argparse
+import json
+import sys
+
+# metric -> True if a higher value is better
+METRICS = {
+    'rps': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+}
+# Only these are held to the threshold; p50 is reported for context
+GATED_METRICS = ('rps', 'p95_ms', 'p99_ms')
+
+
+def change(baseline, current):
+    if not baseline:
+        return None
+    return (current - baseline) / baseline * 100
+
+
+def resource_totals(phase, names):
+    resources = phase.get('resources') or {}
+    return (
+        sum(resources[name]['cpu_percent_avg'] for name in names),
+        sum(resources[name]['rss_mb_max'] for name in names),
+    )
+
+
+def compare(baseline, current, threshold):
+    """Return ``(rows, regressions)`` for the phases both reports share."""
+    baseline_phases = {phase['name']: phase for phase in baseline['phases']}
+    rows, regressions = [], []
+    for phase in current['phases']:
+        before = baseline_phases.get(phase['name'])
+        if before is None:
+            continue
+        row = {'phase': phase['name']}
+        for metric, higher_is_better in METRICS.items():
+            delta = change(before[metric], phase[metric])
+            row[metric] = (before[metric], phase[metric], delta)
+            if delta is None or metric not in GATED_METRICS:
+                continue
+            worse = -delta if higher_is_better else delta
+            if worse > threshold:
+                regressions.append(f"{phase['name']}: {metric} {before[metric]} -> {phase[metric]} ({delta:+.1f}%)")
+        if phase.get('errors') and not before.get('errors'):
+            regressions.append(f"{phase['name']}: {phase['errors']} errors (baseline had none)")
+        # Only containers/processes sampled in both runs are comparable
+        names = set(before.get('resources') or {}) & set(phase.get('resources') or {})
+        (cpu_before, rss_before), (cpu_after, rss_after) = resource_totals(before, names), resource_totals(phase, names)
+        row['cpu_percent'] = (cpu_before, cpu_after, change(cpu_before, cpu_after))
+        row['rss_mb'] = (rss_before, rss_after, change(rss_before, rss_after))
+        rows.append(row)
+    return rows, regressions
+
+
+def format_delta(delta):
+    return 'n/a' if delta is None else f'{delta:+.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Largest tolerated change, in percent, before a phase counts as a regression')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    print(f"baseline {(baseline.get('commit') or 'unknown')[:12]}  current {(current.get('commit') or 'unknown')[:12]}")
+    columns = [*METRICS, 'cpu_percent', 'rss_mb']
+    print(f"{'phase':<20} " + ' '.join(f'{column:>12}' for column in columns))
+    rows, regressions = compare(baseline, current, args.threshold)
+    for row in rows:
+        print(f"{row['phase']:<20} " + ' '.join(f'{format_delta(row[column][2]):>12}' for column in columns))
+
+    if regressions:
+        print(f'\nRegressions beyond {args.threshold}%:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+    print('\nNo regressions.')
+
+
+if __name__ == '__main__':
+    main()
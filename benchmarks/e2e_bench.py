@@ -0,0 +1,288 @@
+"""
+Replay a fixed workload against the whole stack and write a JSON report.
+
+The stack runs on one machine: nginx (frontend), service1, service2 and the
+negative image function under functions-framework, e.g.
+
+    docker compose -f docker-compose.yaml -f docker-compose.bench.yaml up --build -d
+    python benchmarks/e2e_bench.py --output results/bench-$(git rev-parse --short HEAD).json
+
+Each phase of the workload (benchmarks/workloads/default.json) drives one
+endpoint with a fixed number of keep-alive connections, sending the phase's
+optional ``headers`` with every request. Image phases post
+images made by locust/generate_test_images.py from the workload's seed, so
+every run sends the same bytes. While a phase runs, the CPU and memory of
+each container (``docker stats``) or process tree (``--pid``) are sampled.
+
+Compare two reports with benchmarks/compare.py.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from loadgen import multipart_request, request, run_load
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WORKLOAD = os.path.join(ROOT, 'benchmarks', 'workloads', 'default.json')
+DEFAULT_CONTAINERS = [
+    f'swe590-bench-{service}-1' for service in ('frontend', 'service1', 'service2', 'negative-image-function')
+]
+
+sys.path.insert(0, os.path.join(ROOT, 'locust'))
+
+
+def generate_images(seed):
+    """Write the seeded test images to a temporary directory and return it."""
+    from generate_test_images import generate
+
+    output_dir = tempfile.mkdtemp(prefix='bench-images-')
+    generate(output_dir, seed)
+    return output_dir
+
+
+def phase_requests(phase, image_dir):
+    method = phase.get('method', 'GET')
+    headers = phase.get('headers', {})
+    if method == 'GET':
+        return [request('GET', phase['path'], headers=headers)]
+    with open(os.path.join(image_dir, f"{phase['image']}.png"), 'rb') as f:
+        content = f.read()
+    method, path, body, multipart_headers = multipart_request(
+        phase['path'], {'file': (f"{phase['image']}.png", content, 'image/png')}, phase.get('fields'))
+    return [request(method, path, body, {**multipart_headers, **headers})]
+
+
+class DockerSampler:
+    """Samples CPU and memory of containers with ``docker stats``."""
+
+    def __init__(self, containers):
+        self.containers = containers
+
+    def sample(self):
+        output = subprocess.run(
+            ['docker', 'stats', '--no-stream', '--format', '{{.Name}}\t{{.CPUPerc}}\t{{.MemUsage}}',
+             *self.containers],
+            capture_output=True, text=True, timeout=30,
+        ).stdout
+        samples = {}
+        for line in output.splitlines():
+            name, cpu, memory = line.split('\t')
+            samples[name] = (float(cpu.rstrip('%') or 0), parse_size(memory.split('/')[0]))
+        return samples
+
+
+def parse_size(value):
+    """Bytes in a ``docker stats`` size such as ``123.4MiB``."""
+    value = value.strip()
+    units = {'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'kB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'B': 1}
+    for unit, factor in units.items():
+        if value.endswith(unit):
+            return float(value[:-len(unit)]) * factor
+    return float(value or 0)
+
+
+class ProcSampler:
+    """Samples CPU and memory of process trees from /proc.
+
+    Each tree is a root pid (e.g. a gunicorn master) plus all its
+    descendants, so workers started after the benchmark began are counted.
+    """
+
+    def __init__(self, pids):
+        self.pids = pids
+        self._ticks = os.sysconf('SC_CLK_TCK')
+        self._last = {}
+
+    @staticmethod
+    def _stat(pid):
+        with open(f'/proc/{pid}/stat') as f:
+            # The command name may contain spaces; fields resume after its ')'
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[1]), int(fields[11]) + int(fields[12])
+
+    @staticmethod
+    def _rss(pid):
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def _tree(self, root):
+        parents = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    parents[int(entry)] = self._stat(entry)[0]
+                except (OSError, IndexError):
+                    pass
+        tree, frontier = {root}, [root]
+        while frontier:
+            parent = frontier.pop()
+            children = [pid for pid, ppid in parents.items() if ppid == parent]
+            tree.update(children)
+            frontier.extend(children)
+        return tree
+
+    def sample(self):
+        now = time.monotonic()
+        samples = {}
+        for name, root in self.pids.items():
+            ticks, rss = 0, 0
+            for pid in self._tree(root):
+                try:
+                    ticks += self._stat(pid)[1]
+                    rss += self._rss(pid)
+                except (OSError, IndexError):
+                    pass
+            last = self._last.get(name)
+            self._last[name] = (now, ticks)
+            if last is not None and now > last[0]:
+                cpu = (ticks - last[1]) / self._ticks / (now - last[0]) * 100
+                samples[name] = (round(cpu, 1), rss)
+        return samples
+
+
+class ResourceMonitor:
+    """Collects samples in a background thread while a phase runs."""
+
+    def __init__(self, sampler, interval):
+        self.sampler = sampler
+        self.interval = interval
+        self._samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.sampler.sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._samples.append(self.sampler.sample())
+            except (OSError, subprocess.SubprocessError, ValueError) as e:
+                print(f'Resource sample failed: {e}', file=sys.stderr)
+
+    def summary(self):
+        names = sorted({name for sample in self._samples for name in sample})
+        result = {}
+        for name in names:
+            values = [sample[name] for sample in self._samples if name in sample]
+            cpu = [value[0] for value in values]
+            rss = [value[1] for value in values]
+            result[name] = {
+                'cpu_percent_avg': round(sum(cpu) / len(cpu), 1),
+                'cpu_percent_max': round(max(cpu), 1),
+                'rss_mb_max': round(max(rss) / 1024 ** 2, 1),
+            }
+        return result
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    cwd=ROOT, capture_output=True, text=True).stdout.strip())
+    except OSError:
+        return None, None
+    return commit or None, dirty
+
+
+def make_sampler(args):
+    if args.pids:
+        return ProcSampler({name: int(pid) for name, pid in (item.split('=', 1) for item in args.pids)})
+    if args.containers and shutil.which('docker'):
+        return DockerSampler(args.containers)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workload', default=DEFAULT_WORKLOAD, help='Workload JSON file')
+    parser.add_argument('--frontend-url', default='http://localhost:3001')
+    parser.add_argument('--service1-url', default='http://localhost:3001/api/service1')
+    parser.add_argument('--service2-url', default='http://localhost:3001/api/service2')
+    parser.add_argument('--function-url', default='http://localhost:8080')
+    parser.add_argument('--phase', action='append', dest='phases', help='Only run this phase (repeatable)')
+    parser.add_argument('--duration', type=float, help='Override every phase\'s duration')
+    parser.add_argument('--container', action='append', dest='containers',
+                        help='Container to sample (repeatable); defaults to the bench compose containers')
+    parser.add_argument('--pid', action='append', dest='pids', metavar='NAME=PID',
+                        help='Sample this process tree instead of containers (repeatable)')
+    parser.add_argument('--sample-interval', type=float, default=1.0)
+    parser.add_argument('--load-processes', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--output', help='Write the report to this file instead of stdout')
+    args = parser.parse_args()
+    if args.containers is None and not args.pids:
+        args.containers = DEFAULT_CONTAINERS
+
+    with open(args.workload) as f:
+        workload = json.load(f)
+    base_urls = {
+        'frontend': args.frontend_url,
+        'service1': args.service1_url,
+        'service2': args.service2_url,
+        'function': args.function_url,
+    }
+    phases = [phase for phase in workload['phases'] if not args.phases or phase['name'] in args.phases]
+    image_dir = generate_images(workload['seed'])
+    sampler = make_sampler(args)
+
+    commit, dirty = git_commit()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'host': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'workload': os.path.basename(args.workload),
+        'seed': workload['seed'],
+        'phases': [],
+    }
+    print(f"{'phase':<20} {'rps':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}", file=sys.stderr)
+    try:
+        for phase in phases:
+            base_url = base_urls[phase['service']]
+            requests = phase_requests(phase, image_dir)
+            duration = args.duration or phase['duration']
+            warmup = workload.get('warmup', 0)
+            if warmup:
+                run_load(base_url, requests, phase['concurrency'], warmup, args.load_processes)
+            if sampler is not None:
+                with ResourceMonitor(sampler, args.sample_interval) as monitor:
+                    stats = run_load(base_url, requests, phase['concurrency'], duration, args.load_processes)
+                resources = monitor.summary()
+            else:
+                stats = run_load(base_url, requests, phase['concurrency'], duration, args.load_processes)
+                resources = {}
+            print(f"{phase['name']:<20} {stats['rps']:>9} {stats['p50_ms']:>8} {stats['p95_ms']:>8} "
+                  f"{stats['p99_ms']:>8} {stats['errors']:>7}", file=sys.stderr)
+            report['phases'].append({**phase, 'duration': duration, **stats, 'resources': resources})
+    finally:
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
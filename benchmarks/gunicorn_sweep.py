@@ -0,0 +1,123 @@
+"""
+Sweep gunicorn worker settings for service1/service2 and compare them.
+
+For every combination of worker class, worker count and thread count the
+script starts the service with its gunicorn.conf.py, drives the endpoints
+with a built-in keep-alive load generator and reports throughput and
+latency percentiles.
+
+Example:
+    python benchmarks/gunicorn_sweep.py --service service1 \\
+        --worker-classes sync,gthread,uvicorn --workers 1,2,4 --threads 1,4 \\
+        --concurrency 32 --duration 20 --output results/sweep.json
+
+Needs the service's requirements installed in the current environment.
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+
+from loadgen import request, run_load, wait_until_ready
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_ENDPOINTS = {
+    'service1': ['/api/hello/?input=Bench'],
+    'service2': ['/api/evening/?input=Bench'],
+}
+
+
+def start_server(service, port, worker_class, workers, threads, settings_module):
+    env = dict(
+        os.environ,
+        GUNICORN_BIND=f'127.0.0.1:{port}',
+        GUNICORN_WORKER_CLASS=worker_class,
+        GUNICORN_WORKERS=str(workers),
+        GUNICORN_THREADS=str(threads),
+    )
+    if settings_module:
+        env['DJANGO_SETTINGS_MODULE'] = settings_module
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+        cwd=os.path.join(ROOT, service), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def stop_server(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(server.pid, signal.SIGKILL)
+        server.wait()
+
+
+def configurations(worker_classes, worker_counts, thread_counts):
+    for worker_class in worker_classes:
+        for workers in worker_counts:
+            # Thread counts only apply to gthread workers
+            for threads in (thread_counts if worker_class == 'gthread' else [1]):
+                yield worker_class, workers, threads
+
+
+def csv_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--service', choices=sorted(DEFAULT_ENDPOINTS), default='service1')
+    parser.add_argument('--endpoint', action='append', dest='endpoints',
+                        help='Path to request (repeatable); defaults to the service\'s greeting endpoint')
+    parser.add_argument('--worker-classes', type=csv_list, default=['sync', 'gthread', 'uvicorn'])
+    parser.add_argument('--workers', type=lambda v: csv_list(v, int), default=[1, 2, 4])
+    parser.add_argument('--threads', type=lambda v: csv_list(v, int), default=[1, 4, 8])
+    parser.add_argument('--settings', help='DJANGO_SETTINGS_MODULE for the service, e.g. service1_project.settings_api')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--load-processes', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    paths = args.endpoints or DEFAULT_ENDPOINTS[args.service]
+    requests = [request('GET', path) for path in paths]
+    base_url = f'http://127.0.0.1:{args.port}'
+    results = []
+    print(f"{'class':<8} {'workers':>7} {'threads':>7} {'rps':>9} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+    for worker_class, workers, threads in configurations(args.worker_classes, args.workers, args.threads):
+        server = start_server(args.service, args.port, worker_class, workers, threads, args.settings)
+        try:
+            if not wait_until_ready(base_url, timeout=30):
+                print(f'{worker_class:<8} {workers:>7} {threads:>7}  server did not start')
+                continue
+            if args.warmup:
+                run_load(base_url, requests, args.concurrency, args.warmup, args.load_processes)
+            stats = run_load(base_url, requests, args.concurrency, args.duration, args.load_processes)
+        finally:
+            stop_server(server)
+        print(f"{worker_class:<8} {workers:>7} {threads:>7} {stats['rps']:>9} {stats['p50_ms']:>8} "
+              f"{stats['p90_ms']:>8} {stats['p99_ms']:>8} {stats['max_ms']:>8} {stats['errors']:>7}")
+        results.append({'worker_class': worker_class, 'workers': workers, 'threads': threads, **stats})
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({
+                'service': args.service,
+                'endpoints': paths,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Closed-loop HTTP load generator shared by the benchmark scripts.
+
+Each connection sends its next request as soon as the previous response
+has been read, over a keep-alive ``http.client`` connection. Connections
+are spread over several processes so the generator is not limited by a
+single GIL.
+"""
+import http.client
+import itertools
+import multiprocessing
+import time
+import urllib.parse
+import uuid
+
+
+def request(method, path, body=None, headers=None):
+    """One request in a workload: ``(method, path, body, headers)``."""
+    return method, path, body, headers or {}
+
+
+def multipart_request(path, files, fields=None):
+    """POST request carrying ``files`` (``{name: (filename, bytes, type)}``)."""
+    boundary = uuid.uuid4().hex
+    body = bytearray()
+    for name, value in (fields or {}).items():
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                 f'{value}\r\n').encode('utf-8')
+    for name, (filename, content, content_type) in files.items():
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                 f'filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n').encode('utf-8')
+        body += content + b'\r\n'
+    body += f'--{boundary}--\r\n'.encode('utf-8')
+    return request('POST', path, bytes(body), {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _connect(host, port):
+    return http.client.HTTPConnection(host, port, timeout=60)
+
+
+def _send(connection, method, url, body, headers):
+    connection.request(method, url, body=body, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    return response
+
+
+def _client_loop(host, port, prefix, requests, deadline, latencies, errors):
+    """Send requests over one keep-alive connection until ``deadline``."""
+    connection = _connect(host, port)
+    reused = False
+    for method, path, body, headers in itertools.cycle(requests):
+        if time.perf_counter() >= deadline:
+            break
+        started = time.perf_counter()
+        try:
+            try:
+                response = _send(connection, method, prefix + path, body, headers)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection (e.g. a
+                # recycled gunicorn worker); retry once like a browser would
+                connection.close()
+                connection = _connect(host, port)
+                response = _send(connection, method, prefix + path, body, headers)
+            reused = True
+            if response.status >= 400:
+                errors.append(response.status)
+                continue
+            latencies.append(time.perf_counter() - started)
+            if response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+                reused = False
+        except (OSError, http.client.HTTPException):
+            errors.append(0)
+            connection.close()
+            connection = _connect(host, port)
+            reused = False
+    connection.close()
+
+
+def _load_process(args):
+    """One load-generator process running ``connections`` client threads."""
+    import threading
+
+    host, port, prefix, requests, connections, duration = args
+    deadline = time.perf_counter() + duration
+    latencies, errors = [], []
+    threads = [
+        threading.Thread(target=_client_loop, args=(host, port, prefix, requests, deadline, latencies, errors))
+        for _ in range(connections)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, len(errors)
+
+
+def run_load(base_url, requests, concurrency, duration, processes):
+    """Drive ``requests`` with ``concurrency`` connections for ``duration`` seconds.
+
+    ``base_url`` may carry a path prefix, which is prepended to every
+    request path. Returns throughput and latency percentiles.
+    """
+    url = urllib.parse.urlsplit(base_url)
+    prefix = url.path.rstrip('/')
+    processes = max(1, min(processes, concurrency))
+    per_process = [concurrency // processes + (1 if n < concurrency % processes else 0) for n in range(processes)]
+    jobs = [(url.hostname, url.port or 80, prefix, requests, count, duration) for count in per_process if count]
+    started = time.perf_counter()
+    with multiprocessing.Pool(len(jobs)) as pool:
+        results = pool.map(_load_process, jobs)
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(itertools.chain.from_iterable(result[0] for result in results))
+    errors = sum(result[1] for result in results)
+    to_ms = 1000.0
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * to_ms, 2),
+        'p90_ms': round(percentile(latencies, 0.90) * to_ms, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * to_ms, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * to_ms, 2),
+        'max_ms': round((latencies[-1] if latencies else 0) * to_ms, 2),
+    }
+
+
+def wait_until_ready(url, timeout):
+    """Poll ``url`` until it answers 200 or ``timeout`` seconds pass."""
+    parts = urllib.parse.urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = _connect(parts.hostname, parts.port or 80)
+            connection.request('GET', parts.path or '/')
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
@@ -0,0 +1,229 @@
+"""
+Batch mode for the negative-image function.
+
+A batch is a multipart request marked with ``batch=1`` whose ``file``
+parts (any number, one included) are the items, or one that carries a
+single ZIP/tar ``archive`` part. Items are inverted in parallel and the
+results are returned as one ZIP or tar archive with a ``manifest.json``
+that reports the outcome of every item.
+
+Archives are extracted one member at a time while earlier items are being
+inverted. A member larger than MAX_UPLOAD_BYTES, an archive that expands
+to more than MAX_BATCH_BYTES in all, or one with more than
+MAX_ARCHIVE_MEMBERS entries fails the whole batch before it is read.
+"""
+import collections
+import contextvars
+import io
+import json
+import os
+import posixpath
+import tarfile
+import tempfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, UnidentifiedImageError
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import imaging
+import metrics
+import tracing
+import workers
+
+MAX_BATCH_ITEMS = int(os.environ.get('MAX_BATCH_ITEMS', '50'))
+# Uncompressed size of all the images in a batch
+MAX_BATCH_BYTES = int(os.environ.get('MAX_BATCH_BYTES', str(4 * imaging.MAX_UPLOAD_BYTES)))
+# Entries of any kind (directories, links, ...) in an uploaded archive
+MAX_ARCHIVE_MEMBERS = int(os.environ.get('MAX_ARCHIVE_MEMBERS', str(4 * MAX_BATCH_ITEMS)))
+# Pillow releases the GIL while decoding and encoding, so threads spread
+# the work across cores
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', str(os.cpu_count() or 1)))
+
+# archive format -> content type
+ARCHIVE_FORMATS = {
+    'zip': 'application/zip',
+    'tar': 'application/x-tar',
+}
+
+_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+
+
+class BatchError(ValueError):
+    """Raised when the batch as a whole is invalid."""
+
+    status = 400
+
+
+class BatchTooLarge(BatchError):
+    """Raised when an archive member, or the batch in all, expands past its size limit."""
+
+    status = 413
+
+
+def is_batch(request):
+    try:
+        files = request.files
+        marked = request.form.get('batch') == '1'
+    except RequestEntityTooLarge:
+        # The body was refused unread (see imaging.MAX_UPLOAD_BYTES)
+        return False
+    # Keyed on the marker rather than the number of files, so a one-file
+    # batch still gets an archive and a manifest back
+    return marked or 'archive' in files
+
+
+def _read_member(name, declared_size, fp):
+    """Read one archive member, trusting neither its declared size nor its stream."""
+    limit = imaging.MAX_UPLOAD_BYTES
+    if declared_size > limit:
+        raise BatchTooLarge(f'{name} expands to {declared_size} bytes, the limit is {limit}')
+    data = fp.read(limit + 1)
+    if len(data) > limit:
+        raise BatchTooLarge(f'{name} expands to more than {limit} bytes')
+    return data
+
+
+def _archive_items(archive):
+    """Yield ``(name, bytes)`` for each regular file in a ZIP or tar upload."""
+    try:
+        yield from _extract(archive)
+    except (zipfile.BadZipFile, tarfile.TarError, zlib.error, EOFError) as e:
+        raise BatchError(f'archive is corrupt: {str(e)}')
+
+
+def _extract(archive):
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zf:
+            infos = zf.infolist()
+            if len(infos) > MAX_ARCHIVE_MEMBERS:
+                raise BatchError(f'archive may contain at most {MAX_ARCHIVE_MEMBERS} entries')
+            for info in infos:
+                if not info.is_dir():
+                    with zf.open(info) as fp:
+                        yield info.filename, _read_member(info.filename, info.file_size, fp)
+        return
+    archive.seek(0)
+    try:
+        tf = tarfile.open(fileobj=archive, mode='r:*')
+    except tarfile.TarError:
+        raise BatchError('archive must be a ZIP or tar file')
+    with tf:
+        for count, member in enumerate(tf, 1):
+            if count > MAX_ARCHIVE_MEMBERS:
+                raise BatchError(f'archive may contain at most {MAX_ARCHIVE_MEMBERS} entries')
+            if member.isfile():
+                with tf.extractfile(member) as fp:
+                    yield member.name, _read_member(member.name, member.size, fp)
+
+
+def iter_items(request):
+    """Yield the batch as ``(name, bytes)`` one item at a time.
+
+    Raises BatchError (or BatchTooLarge) as soon as the batch breaks
+    MAX_BATCH_ITEMS or MAX_BATCH_BYTES, or if it turns out to be empty.
+    """
+    if 'archive' in request.files:
+        source = _archive_items(request.files['archive'].stream)
+    else:
+        source = ((f.filename or 'image', f.stream.read()) for f in request.files.getlist('file'))
+    count = 0
+    total = 0
+    for name, data in source:
+        count += 1
+        total += len(data)
+        if count > MAX_BATCH_ITEMS:
+            raise BatchError(f'A batch may contain at most {MAX_BATCH_ITEMS} images')
+        if total > MAX_BATCH_BYTES:
+            raise BatchTooLarge(f'The batch expands to more than {MAX_BATCH_BYTES} bytes')
+        yield name, data
+    if not count:
+        raise BatchError('The batch contains no files')
+
+
+def _process_item(data, pillow_format, save_kwargs, pipeline):
+    timings = {}
+    with tracing.span('transform', attributes={'image.bytes': len(data)}):
+        try:
+            result = workers.process(io.BytesIO(data), pillow_format, save_kwargs, timings, pipeline)
+        finally:
+            metrics.observe_transform(len(data), timings)
+            tracing.record_phases(timings)
+    try:
+        return result.read()
+    finally:
+        result.close()
+
+
+def _output_name(name, extension, used):
+    stem = posixpath.splitext(posixpath.basename(name.replace('\\', '/')))[0] or 'image'
+    candidate = f'{stem}.{extension}'
+    counter = 1
+    while candidate in used:
+        candidate = f'{stem}-{counter}.{extension}'
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+
+def process_batch(items, pillow_format, extension, save_kwargs, archive_format, pipeline=None):
+    """Invert every item in parallel and pack the results into an archive.
+
+    ``items`` is consumed lazily: at most twice BATCH_WORKERS images are held
+    in memory at once. Returns ``(archive_file, error_count)``. The archive
+    is a spooled temporary file rewound to the start.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=imaging.SPOOL_MAX_BYTES)
+    if archive_format == 'zip':
+        # Encoded images are already compressed, so store them as-is
+        archive = zipfile.ZipFile(spool, 'w', compression=zipfile.ZIP_STORED)
+        add = archive.writestr
+    else:
+        archive = tarfile.open(fileobj=spool, mode='w')
+
+        def add(name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    manifest = []
+    used_names = {'manifest.json'}
+
+    def finish(index, name, future):
+        entry = {'index': index, 'name': name}
+        try:
+            data = future.result()
+            output_name = _output_name(name, extension, used_names)
+            add(output_name, data)
+            entry.update(status='ok', output=output_name)
+        except UnidentifiedImageError:
+            entry.update(status='error', error='cannot identify image file')
+        except (imaging.ImageTooLarge, imaging.InvalidOperation, Image.DecompressionBombError) as e:
+            entry.update(status='error', error=str(e))
+        except Exception as e:
+            print(f"Batch item {index} ({name}) failed: {str(e)}")
+            entry.update(status='error', error=str(e))
+        manifest.append(entry)
+
+    # Enough items in flight to keep every batch worker busy while results are written
+    pending = collections.deque()
+    try:
+        with archive:
+            for index, (name, data) in enumerate(items):
+                # Each item runs in the request's context so its spans join the request's trace
+                pending.append((index, name, _executor.submit(
+                    contextvars.copy_context().run, _process_item, data, pillow_format, save_kwargs, pipeline)))
+                if len(pending) >= 2 * BATCH_WORKERS:
+                    finish(*pending.popleft())
+            while pending:
+                finish(*pending.popleft())
+            add('manifest.json', json.dumps({'items': manifest}, indent=2).encode('utf-8'))
+    except BaseException:
+        for _, _, future in pending:
+            future.cancel()
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, sum(entry['status'] == 'error' for entry in manifest)
@@ -0,0 +1,456 @@
+"""
+Image transforms and output encoding for the negative-image function.
+"""
+import io
+import os
+import re
+import tempfile
+import time
+
+from PIL import Image, features
+
+# Lookup tables applied per band by Image.point
+INVERT_LUT = [255 - value for value in range(256)]
+IDENTITY_LUT = list(range(256))
+
+# Modes a lookup table can be applied to in place, mapped to their number of
+# colour bands and alpha bands (alpha bands are left untouched)
+_POINT_BANDS = {
+    '1': (1, 0),
+    'L': (1, 0),
+    'LA': (1, 1),
+    'RGB': (3, 0),
+    'RGBA': (3, 1),
+}
+
+# format name -> (Pillow format, content type, file extension)
+OUTPUT_FORMATS = {
+    'png': ('PNG', 'image/png', 'png'),
+    'webp': ('WEBP', 'image/webp', 'webp'),
+    'jpeg': ('JPEG', 'image/jpeg', 'jpg'),
+    'jpg': ('JPEG', 'image/jpeg', 'jpg'),
+}
+# AVIF needs a Pillow build with libavif
+if features.check('avif'):
+    OUTPUT_FORMATS['avif'] = ('AVIF', 'image/avif', 'avif')
+
+# Formats chosen from the Accept header when the client sends no 'format',
+# best first. Only media types the client names count; wildcards keep the
+# default format.
+NEGOTIATED_FORMATS = [
+    name.strip() for name in os.environ.get('NEGOTIATED_FORMATS', 'avif,webp,png').split(',')
+    if name.strip() in OUTPUT_FORMATS
+]
+
+# Largest max_width / max_height a client may ask for
+MAX_OUTPUT_DIMENSION = int(os.environ.get('MAX_OUTPUT_DIMENSION', '16384'))
+
+# Modes each encoder can write without a conversion
+_ENCODABLE_MODES = {
+    'JPEG': ('L', 'RGB', 'CMYK'),
+}
+
+DEFAULT_FORMAT = os.environ.get('DEFAULT_OUTPUT_FORMAT', 'png')
+DEFAULT_PNG_COMPRESS_LEVEL = int(os.environ.get('DEFAULT_PNG_COMPRESS_LEVEL', '6'))
+DEFAULT_QUALITY = int(os.environ.get('DEFAULT_OUTPUT_QUALITY', '85'))
+
+# Larger request bodies are refused before the multipart parser reads them,
+# and larger archive members before they are extracted. Werkzeug spools
+# uploaded parts over 500 KB to temporary files.
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(32 * 1024 * 1024)))
+
+# Uploads above this many pixels are rejected before decoding. Pillow's own
+# decompression-bomb check uses the same limit.
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(50_000_000)))
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Pillow formats accepted as uploads. Image.open only asks these plugins,
+# each of which matches the file's first bytes, so anything else is
+# rejected before any decoding.
+Image.init()
+INPUT_FORMATS = [
+    name.strip().upper() for name in os.environ.get('INPUT_FORMATS', 'PNG,JPEG,GIF,WEBP,BMP,TIFF,AVIF').split(',')
+    if name.strip().upper() in Image.OPEN
+]
+
+# Images at or above this many pixels are inverted in place one strip at a
+# time and encoded into a spool file that moves to disk past SPOOL_MAX_BYTES
+TILED_THRESHOLD_PIXELS = int(os.environ.get('TILED_THRESHOLD_PIXELS', str(4_000_000)))
+TILE_ROWS = int(os.environ.get('TILE_ROWS', '256'))
+SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', str(8 * 1024 * 1024)))
+
+
+class ImageTooLarge(ValueError):
+    """Raised when an image exceeds the configured pixel limit."""
+
+
+class InvalidOperation(ValueError):
+    """Raised when a pipeline operation does not fit the image, e.g. a crop outside it."""
+
+
+# Request fields that change the output, in the order they are forwarded
+TRANSFORM_FIELDS = ('format', 'compress_level', 'quality', 'max_width', 'max_height', 'ops')
+
+# Most operations one 'ops' field may list
+MAX_PIPELINE_OPS = int(os.environ.get('MAX_PIPELINE_OPS', '16'))
+
+# Clockwise rotations, in degrees
+_ROTATIONS = {
+    '90': Image.Transpose.ROTATE_270,
+    '180': Image.Transpose.ROTATE_180,
+    '270': Image.Transpose.ROTATE_90,
+}
+_CROP = re.compile(r'(\d+)x(\d+)\+(\d+)\+(\d+)')
+
+
+def _point_table(mode, lut):
+    colour, alpha = _POINT_BANDS[mode]
+    return lut * colour + IDENTITY_LUT * alpha
+
+
+def apply_lut(img, lut):
+    """Return ``img`` with ``lut`` applied to its colour bands, keeping its mode where possible.
+
+    L, RGB and their alpha variants take a single lookup-table pass and
+    alpha is preserved. Palette images only have their palette changed.
+    Anything else is converted to RGB (or RGBA, if it carries transparency)
+    first.
+    """
+    if img.mode in _POINT_BANDS:
+        return img.point(_point_table(img.mode, lut))
+    if img.mode == 'P' and img.palette is not None and img.palette.mode == 'RGB':
+        mapped = img.copy()
+        mapped.putpalette([lut[value] for value in img.getpalette()])
+        return mapped
+    has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+    mode = 'RGBA' if has_alpha else 'RGB'
+    return img.convert(mode).point(_point_table(mode, lut))
+
+
+def grayscale(img):
+    """Return ``img`` as L, or LA if it carries transparency."""
+    if img.mode in ('1', 'L', 'LA'):
+        return img
+    has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+    if img.mode == 'P':
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+    return img.convert('LA' if has_alpha else 'L')
+
+
+def check_size(img):
+    """Reject ``img`` before decoding if it has too many pixels.
+
+    Only the header has been read at this point, so this costs nothing even
+    for a decompression bomb.
+    """
+    pixels = img.width * img.height
+    if pixels > MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f'Image has {pixels} pixels, the limit is {MAX_IMAGE_PIXELS}')
+
+
+def check_upload(stream):
+    """Reject an upload from its header alone, then rewind ``stream``.
+
+    Raises UnidentifiedImageError for formats outside INPUT_FORMATS and
+    ImageTooLarge for images over the pixel limit, without decoding.
+    """
+    with Image.open(stream, formats=INPUT_FORMATS) as img:
+        check_size(img)
+    stream.seek(0)
+
+
+def use_tiles(img):
+    return img.width * img.height >= TILED_THRESHOLD_PIXELS
+
+
+def apply_lut_tiled(img, lut, rows=None):
+    """Apply ``lut`` to ``img`` in place, one strip of ``rows`` rows at a time.
+
+    Peak memory is the decoded image plus one strip, instead of the
+    decoded image plus a full mapped copy.
+    """
+    rows = rows or TILE_ROWS
+    if img.mode not in _POINT_BANDS:
+        if img.mode == 'P':
+            # Only the palette changes, which is cheap at any size
+            return apply_lut(img, lut)
+        has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+    img.load()
+    table = _point_table(img.mode, lut)
+    for top in range(0, img.height, rows):
+        box = (0, top, img.width, min(top + rows, img.height))
+        img.paste(img.crop(box).point(table), box)
+    return img
+
+
+def encode_spooled(img, pillow_format, save_kwargs):
+    """Encode ``img`` into a temporary file that spills to disk when large.
+
+    Returns the file rewound to the start, ready to be streamed out.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    encode(img, spool, pillow_format, save_kwargs)
+    spool.seek(0)
+    return spool
+
+
+def fitted_size(size, max_size):
+    """Largest size within ``max_size`` that keeps the aspect ratio.
+
+    ``max_size`` is ``(max_width, max_height)``; either may be None.
+    Images are only ever shrunk.
+    """
+    width, height = size
+    max_width, max_height = max_size
+    scale = min((max_width or width) / width, (max_height or height) / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class Pipeline:
+    """A compiled ``ops`` field, ready to run on one image.
+
+    Geometry moves pixels and the other operations only change their
+    values, so the operations are regrouped rather than run as listed. A
+    ``grayscale`` becomes one conversion straight after decoding, so the
+    geometry steps handle one band instead of three. The geometry steps
+    (``(op, argument)`` pairs) then run in the order given. Last comes one
+    lookup-table pass standing for every ``invert``, touching only the
+    pixels left after resizing and cropping.
+    """
+
+    def __init__(self):
+        self.geometry = []
+        self.grayscale = False
+        self.lut = None
+
+    def add_geometry(self, op, argument):
+        if op == 'resize' and self.geometry and self.geometry[-1][0] == 'resize':
+            # Fitting into one box and then another is fitting into the smaller of the two
+            argument = _tighter(self.geometry.pop()[1], argument)
+        self.geometry.append((op, argument))
+
+    def first_resize(self):
+        """Box of the resize the pipeline starts with, or None."""
+        if self.geometry and self.geometry[0][0] == 'resize':
+            return self.geometry[0][1]
+        return None
+
+
+def _tighter(box, other):
+    return tuple(b if a is None else a if b is None else min(a, b) for a, b in zip(box, other))
+
+
+def _resize_box(value):
+    width, separator, height = value.partition('x')
+    if not separator or not (width or height):
+        raise ValueError(f"resize expects WIDTHxHEIGHT, got '{value}'")
+    box = tuple(int(side) if side else None for side in (width, height))
+    if any(side is not None and not 1 <= side <= MAX_OUTPUT_DIMENSION for side in box):
+        raise ValueError(f'resize sides must be between 1 and {MAX_OUTPUT_DIMENSION}')
+    return box
+
+
+def compile_ops(spec, max_size=None):
+    """Compile an ``ops`` field into a ``Pipeline``.
+
+    ``spec`` is a comma-separated list of operations, applied in order:
+    ``resize:WxH`` (shrink to fit, keeping the aspect ratio; either side may
+    be left out), ``crop:WxH+X+Y``, ``rotate:90|180|270`` (clockwise),
+    ``flip`` (top to bottom), ``mirror`` (left to right), ``grayscale``
+    and ``invert``. Without a spec the image is only inverted. ``max_size``
+    (from ``resize_options``) adds a final resize. Raises ValueError for
+    unknown or malformed operations.
+    """
+    steps = [step.strip() for step in (spec or 'invert').split(',') if step.strip()]
+    if not steps:
+        raise ValueError('ops must list at least one operation')
+    if len(steps) > MAX_PIPELINE_OPS:
+        raise ValueError(f'ops may list at most {MAX_PIPELINE_OPS} operations')
+
+    pipeline = Pipeline()
+    for step in steps:
+        name, _, value = step.partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        if name == 'resize':
+            pipeline.add_geometry('resize', _resize_box(value))
+        elif name == 'crop':
+            match = _CROP.fullmatch(value)
+            if match is None:
+                raise ValueError(f"crop expects WIDTHxHEIGHT+LEFT+TOP, got '{value}'")
+            width, height, left, top = (int(part) for part in match.groups())
+            if not width or not height:
+                raise ValueError('crop width and height must be at least 1')
+            pipeline.add_geometry('crop', (width, height, left, top))
+        elif name == 'rotate':
+            if value not in _ROTATIONS:
+                raise ValueError(f"rotate expects one of {', '.join(_ROTATIONS)}, got '{value}'")
+            pipeline.add_geometry('rotate', _ROTATIONS[value])
+        elif name == 'flip':
+            pipeline.add_geometry('flip', Image.Transpose.FLIP_TOP_BOTTOM)
+        elif name == 'mirror':
+            pipeline.add_geometry('mirror', Image.Transpose.FLIP_LEFT_RIGHT)
+        elif name == 'grayscale':
+            pipeline.grayscale = True
+        elif name == 'invert':
+            # Successive inverts fold into one table
+            pipeline.lut = [255 - level for level in pipeline.lut or IDENTITY_LUT]
+        else:
+            raise ValueError(f"Unknown operation '{name}'")
+    if max_size:
+        pipeline.add_geometry('resize', max_size)
+
+    if pipeline.lut == IDENTITY_LUT:
+        # An even number of inverts cancels out
+        pipeline.lut = None
+    return pipeline
+
+
+def apply_geometry(img, op, argument):
+    """Run one geometry step of a ``Pipeline`` on ``img``."""
+    if op == 'resize':
+        target = fitted_size(img.size, argument)
+        if target == img.size:
+            return img
+        return img.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    if op == 'crop':
+        width, height, left, top = argument
+        box = (left, top, min(left + width, img.width), min(top + height, img.height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            raise InvalidOperation(
+                f'crop:{width}x{height}+{left}+{top} lies outside the {img.width}x{img.height} image')
+        return img.crop(box)
+    return img.transpose(argument)
+
+
+def process(stream, pillow_format, save_kwargs, timings=None, pipeline=None):
+    """Decode, transform and encode one image in a single pass.
+
+    ``pipeline`` comes from ``compile_ops``; without one the image is only
+    inverted. Returns a file object rewound to the start of the encoded
+    result. Raises ImageTooLarge, DecompressionBombError or
+    UnidentifiedImageError for uploads that should be rejected and
+    InvalidOperation for a pipeline that does not fit the image. If
+    ``timings`` is a dict it receives the image's pixel count, its start
+    time (``start_ns``) and the seconds spent in each phase (``decode``,
+    which includes any grayscale conversion, ``resize`` for all the
+    geometry steps, ``invert`` for the lookup table, ``encode``).
+    """
+    pipeline = pipeline or compile_ops(None)
+    timings = {} if timings is None else timings
+    # Wall-clock start, so phases that ran in a pool worker can be placed in a trace
+    timings['start_ns'] = time.time_ns()
+    # Only the header is read here; the pixel limit is checked before decoding
+    started = time.perf_counter()
+    img = Image.open(stream, formats=INPUT_FORMATS)
+    check_size(img)
+    timings['pixels'] = img.width * img.height
+    box = pipeline.first_resize()
+    target = fitted_size(img.size, box) if box else None
+    draft_mode = 'L' if pipeline.grayscale else None
+    if draft_mode or (target and target != img.size):
+        # JPEG can decode straight to grayscale and to a smaller scale;
+        # other formats ignore this
+        img.draft(draft_mode, target if target != img.size else None)
+    img.load()
+    if pipeline.grayscale:
+        img = grayscale(img)
+    timings['decode'] = time.perf_counter() - started
+
+    if pipeline.geometry:
+        started = time.perf_counter()
+        for op, argument in pipeline.geometry:
+            img = apply_geometry(img, op, argument)
+        timings['resize'] = time.perf_counter() - started
+
+    # Large images are mapped strip by strip and encoded to a spool file
+    tiled = use_tiles(img)
+    if pipeline.lut is not None:
+        started = time.perf_counter()
+        img = apply_lut_tiled(img, pipeline.lut) if tiled else apply_lut(img, pipeline.lut)
+        timings['invert'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    if tiled:
+        output = encode_spooled(img, pillow_format, save_kwargs)
+    else:
+        output = io.BytesIO()
+        encode(img, output, pillow_format, save_kwargs)
+        output.seek(0)
+    timings['encode'] = time.perf_counter() - started
+    return output
+
+
+def negotiate_format(accept):
+    """Name of the best NEGOTIATED_FORMATS entry the ``Accept`` header names, or None."""
+    quality = {}
+    for part in accept.split(','):
+        media_type, *params = [piece.strip() for piece in part.split(';')]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[media_type.lower()] = q
+    best, best_q = None, 0.0
+    for name in NEGOTIATED_FORMATS:
+        q = quality.get(OUTPUT_FORMATS[name][1], 0.0)
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def resize_options(values):
+    """Parse ``max_width`` / ``max_height`` from request fields.
+
+    Returns ``(max_width, max_height)`` with None for an unset side, or None
+    if neither is set. Raises ValueError for values out of range.
+    """
+    limits = []
+    for name in ('max_width', 'max_height'):
+        value = values.get(name)
+        if not value:
+            limits.append(None)
+            continue
+        value = int(value)
+        if not 1 <= value <= MAX_OUTPUT_DIMENSION:
+            raise ValueError(f'{name} must be between 1 and {MAX_OUTPUT_DIMENSION}')
+        limits.append(value)
+    return tuple(limits) if any(limits) else None
+
+
+def output_options(values):
+    """Parse the client's output settings from request fields.
+
+    Returns ``(pillow_format, content_type, extension, save_kwargs)`` and
+    raises ValueError for unsupported or out-of-range values.
+    """
+    name = (values.get('format') or DEFAULT_FORMAT).lower()
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported format '{name}', expected one of {', '.join(OUTPUT_FORMATS)}")
+    pillow_format, content_type, extension = OUTPUT_FORMATS[name]
+
+    save_kwargs = {}
+    if pillow_format == 'PNG':
+        level = int(values.get('compress_level') or DEFAULT_PNG_COMPRESS_LEVEL)
+        if not 0 <= level <= 9:
+            raise ValueError('compress_level must be between 0 and 9')
+        save_kwargs['compress_level'] = level
+    else:
+        quality = int(values.get('quality') or DEFAULT_QUALITY)
+        if not 1 <= quality <= 100:
+            raise ValueError('quality must be between 1 and 100')
+        save_kwargs['quality'] = quality
+    return pillow_format, content_type, extension, save_kwargs
+
+
+def encode(img, fp, pillow_format, save_kwargs):
+    """Encode ``img`` into ``fp``, converting only if the format requires it."""
+    allowed = _ENCODABLE_MODES.get(pillow_format)
+    if allowed is not None and img.mode not in allowed:
+        img = img.convert('L' if img.mode in ('1', 'LA') else 'RGB')
+    img.save(fp, format=pillow_format, **save_kwargs)
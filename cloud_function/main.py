@@ -1,16 +1,103 @@
 from flask import request, make_response
-from PIL import Image, ImageOps
+from PIL import Image, UnidentifiedImageError
+from werkzeug.exceptions import RequestEntityTooLarge
+import hashlib
 import io
+import time
 import traceback
 import os
 
+import batch
+import imaging
+import metrics
+import tracing
+import workers
+
 def add_cors_headers(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'POST, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Authorization, Content-Type'
+    response.headers['Access-Control-Allow-Headers'] = 'Authorization, Content-Type, If-None-Match'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag, X-Batch-Errors'
+    return response
+
+def result_etag(stream, params):
+    """Strong ETag from the transform parameters and the uploaded bytes.
+
+    Uses the same scheme as service1's result cache, so both layers hand out
+    the same ETag for the same input.
+    """
+    digest = hashlib.sha256()
+    canonical = '&'.join(f'{name}={params[name]}' for name in sorted(params))
+    digest.update(canonical.encode('utf-8') + b'\0')
+    for chunk in iter(lambda: stream.read(64 * 1024), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return f'"{digest.hexdigest()}"'
+
+def iter_file(fp, chunk_size=64 * 1024):
+    """Yield the contents of ``fp`` in chunks and close it afterwards."""
+    try:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            yield chunk
+    finally:
+        fp.close()
+
+def file_response(fp):
+    """Response streaming ``fp``, which must be positioned at its start."""
+    if isinstance(fp, io.BytesIO):
+        return make_response(fp.getvalue())
+    length = fp.seek(0, os.SEEK_END)
+    fp.seek(0)
+    response = make_response(iter_file(fp))
+    response.headers.set('Content-Length', str(length))
+    return response
+
+def negative_image_batch(request, pillow_format, extension, save_kwargs, pipeline):
+    """Invert several uploaded images (or an archive of them) in one request."""
+    archive_format = (request.values.get('archive_format') or 'zip').lower()
+    if archive_format not in batch.ARCHIVE_FORMATS:
+        response = make_response(f"Unsupported archive_format '{archive_format}'", 400)
+        return add_cors_headers(response)
+
+    try:
+        archive, errors = batch.process_batch(
+            batch.iter_items(request), pillow_format, extension, save_kwargs, archive_format, pipeline)
+    except batch.BatchError as e:
+        response = make_response(str(e), e.status)
+        return add_cors_headers(response)
+    except Exception as e:
+        print(traceback.format_exc())
+        response = make_response(str(e), 500)
+        return add_cors_headers(response)
+
+    response = file_response(archive)
+    response.headers.set('Content-Type', batch.ARCHIVE_FORMATS[archive_format])
+    response.headers.set('Content-Disposition', 'attachment', filename=f'negatives.{archive_format}')
+    response.headers.set('X-Batch-Errors', str(errors))
+    return add_cors_headers(response)
+
+def metrics_response(request):
+    if not metrics.METRICS_ENABLED:
+        return make_response('Not found', 404)
+    body, content_type = metrics.exposition()
+    response = make_response(body)
+    response.headers.set('Content-Type', content_type)
     return response
 
 def negative_image(request):
+    if request.method == 'GET' and request.path.rstrip('/').endswith('/metrics'):
+        return metrics_response(request)
+
+    with tracing.server_span(request) as span:
+        started = time.perf_counter()
+        response = handle_negative_image(request)
+        # Streamed bodies are not included; this is the time to the first byte
+        mode = 'batch' if batch.is_batch(request) else 'single'
+        metrics.REQUEST_DURATION.labels(mode, response.status_code).observe(time.perf_counter() - started)
+        tracing.record_status(span, response.status_code)
+    return response
+
+def handle_negative_image(request):
     if request.method == 'OPTIONS':
         response = make_response('', 204)
         return add_cors_headers(response)
@@ -19,20 +106,84 @@ def negative_image(request):
         response = make_response('POST method required', 405)
         return add_cors_headers(response)
 
-    if 'file' not in request.files:
+    # Also caps bodies sent without a Content-Length
+    request.max_content_length = imaging.MAX_UPLOAD_BYTES
+    try:
+        has_upload = 'file' in request.files or 'archive' in request.files
+    except RequestEntityTooLarge:
+        response = make_response(f'Request body is larger than {imaging.MAX_UPLOAD_BYTES} bytes', 413)
+        return add_cors_headers(response)
+    if not has_upload:
         response = make_response('No file part', 400)
         return add_cors_headers(response)
 
+    # Without an explicit format, pick one from the Accept header
+    values = request.values.to_dict()
+    negotiated = False
+    if not values.get('format'):
+        name = imaging.negotiate_format(request.headers.get('Accept', ''))
+        if name is not None:
+            values['format'] = name
+            negotiated = True
+
+    try:
+        pillow_format, content_type, extension, save_kwargs = imaging.output_options(values)
+        pipeline = imaging.compile_ops(values.get('ops'), imaging.resize_options(values))
+    except ValueError as e:
+        response = make_response(str(e), 400)
+        return add_cors_headers(response)
+
+    if batch.is_batch(request):
+        return negative_image_batch(request, pillow_format, extension, save_kwargs, pipeline)
+
     file = request.files['file']
+
+    # The ETag covers exactly the fields the client sent, matching service1
+    params = {'op': 'negative'}
+    params.update({name: values[name] for name in imaging.TRANSFORM_FIELDS if values.get(name)})
     try:
-        img = Image.open(file.stream)
-        inverted_image = ImageOps.invert(img.convert('RGB'))
-        img_byte_arr = io.BytesIO()
-        inverted_image.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        response = make_response(img_byte_arr.read())
-        response.headers.set('Content-Type', 'image/png')
-        response.headers.set('Content-Disposition', 'attachment', filename='negative.png')
+        # Unsupported or oversized images are turned away before being hashed
+        imaging.check_upload(file.stream)
+        etag = result_etag(file.stream, params)
+        if etag in (tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')):
+            response = make_response('', 304)
+            response.headers.set('ETag', etag)
+            if negotiated:
+                response.headers.add('Vary', 'Accept')
+            return add_cors_headers(response)
+
+        size = file.stream.seek(0, os.SEEK_END)
+        file.stream.seek(0)
+        timings = {}
+        with tracing.span('transform', attributes={'image.bytes': size}):
+            try:
+                result = workers.process(file.stream, pillow_format, save_kwargs, timings, pipeline)
+            finally:
+                metrics.observe_transform(size, timings)
+                tracing.record_phases(timings)
+        response = file_response(result)
+        response.headers.set('Content-Type', content_type)
+        response.headers.set('Content-Disposition', 'attachment', filename=f'negative.{extension}')
+        response.headers.set('ETag', etag)
+        if negotiated:
+            response.headers.add('Vary', 'Accept')
+        return add_cors_headers(response)
+    except (imaging.ImageTooLarge, Image.DecompressionBombError) as e:
+        response = make_response(str(e), 413)
+        return add_cors_headers(response)
+    except imaging.InvalidOperation as e:
+        response = make_response(str(e), 400)
+        return add_cors_headers(response)
+    except UnidentifiedImageError:
+        response = make_response(
+            f"Unsupported image format, expected one of {', '.join(imaging.INPUT_FORMATS)}", 415)
+        return add_cors_headers(response)
+    except workers.WorkerBusy as e:
+        response = make_response(str(e), 503)
+        response.headers.set('Retry-After', '1')
+        return add_cors_headers(response)
+    except workers.WorkerTimeout as e:
+        response = make_response(str(e), 504)
         return add_cors_headers(response)
     except Exception as e:
         print(traceback.format_exc())
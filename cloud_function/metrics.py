@@ -0,0 +1,52 @@
+"""
+Prometheus metrics for the negative-image function.
+
+Every request is timed, and every transformed image records its upload
+size, pixel count and the time spent in each phase: ``decode`` (including
+any grayscale conversion), ``resize`` (every resize, crop, rotation and
+flip of an ``ops`` pipeline), ``invert`` (the single lookup-table pass)
+and ``encode``.
+``GET /metrics`` on the function URL returns them in Prometheus format.
+Transforms that run in the worker pool report their timings back to the
+request thread, so only this process records samples.
+"""
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
+
+# Set METRICS_ENABLED=0 to answer /metrics with 404
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 16 KiB to 32 MiB
+SIZE_BUCKETS = tuple(16 * 1024 * 2 ** n for n in range(12))
+# 64 thousand to 64 million pixels
+PIXEL_BUCKETS = tuple(65536 * 2 ** n for n in range(11))
+
+REQUEST_DURATION = Histogram(
+    'function_request_duration_seconds', 'Time to produce a response',
+    ['mode', 'status'], buckets=LATENCY_BUCKETS,
+)
+PHASE_DURATION = Histogram(
+    'image_phase_duration_seconds', 'Time spent in each phase of the transform',
+    ['phase'], buckets=LATENCY_BUCKETS,
+)
+IMAGE_BYTES = Histogram('image_input_bytes', 'Size of each uploaded image', buckets=SIZE_BUCKETS)
+IMAGE_PIXELS = Histogram('image_input_pixels', 'Pixel count of each uploaded image', buckets=PIXEL_BUCKETS)
+
+PHASES = ('decode', 'resize', 'invert', 'encode')
+
+
+def observe_transform(size, timings):
+    """Record one image, given its upload size and the timings from ``imaging.process``."""
+    IMAGE_BYTES.observe(size)
+    if 'pixels' in timings:
+        IMAGE_PIXELS.observe(timings['pixels'])
+    for phase in PHASES:
+        if phase in timings:
+            PHASE_DURATION.labels(phase).observe(timings[phase])
+
+
+def exposition():
+    """Return ``(body, content_type)`` for a scrape."""
+    return generate_latest(), CONTENT_TYPE_LATEST
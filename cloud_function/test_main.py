@@ -0,0 +1,158 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+from functions_framework import create_app
+from PIL import Image
+
+import workers
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+@pytest.fixture
+def client():
+    return create_app('negative_image', SOURCE).test_client()
+
+
+@pytest.fixture
+def process_pool(monkeypatch):
+    monkeypatch.setattr(workers, 'EXECUTION_MODE', 'process')
+    monkeypatch.setattr(workers, 'WORKER_PROCESSES', 1)
+    monkeypatch.setattr(workers, '_pool', None)
+    yield
+    if workers._pool is not None:
+        workers._pool.shutdown()
+
+
+def encoded(img, image_format='PNG'):
+    buf = io.BytesIO()
+    img.save(buf, image_format)
+    return buf.getvalue()
+
+
+def png(size=(4, 4), color=(10, 20, 30), mode='RGB'):
+    return encoded(Image.new(mode, size, color))
+
+
+def upload(data, name='a.png'):
+    return (io.BytesIO(data), name)
+
+
+def negative(response):
+    assert response.status_code == 200, response.data
+    return Image.open(io.BytesIO(response.data))
+
+
+@pytest.mark.parametrize('mode, color, expected', [
+    ('RGB', (10, 20, 30), (245, 235, 225)),
+    ('RGBA', (10, 20, 30, 128), (245, 235, 225, 128)),
+    ('L', 10, 245),
+])
+def test_inversion_keeps_the_mode(client, mode, color, expected):
+    img = negative(client.post('/', data={'file': upload(png(mode=mode, color=color))}))
+    assert img.mode == mode
+    assert img.getpixel((0, 0)) == expected
+
+
+def test_palette_inversion_keeps_the_indexes(client):
+    source = Image.new('P', (2, 1))
+    source.putpalette([10, 20, 30, 200, 100, 0] + [0] * 762)
+    source.putpixel((1, 0), 1)
+    img = negative(client.post('/', data={'file': upload(encoded(source))}))
+    assert img.mode == 'P'
+    assert [img.getpixel((x, 0)) for x in range(2)] == [0, 1]
+    assert img.convert('RGB').getpixel((0, 0)) == (245, 235, 225)
+    assert img.convert('RGB').getpixel((1, 0)) == (55, 155, 255)
+
+
+def test_ops_run_in_order(client):
+    source = Image.new('RGB', (4, 2), (0, 0, 0))
+    source.putpixel((0, 0), (255, 255, 255))
+    img = negative(client.post('/', data={'file': upload(encoded(source)), 'ops': 'rotate:90,grayscale,invert'}))
+    assert img.size == (2, 4)
+    assert img.mode == 'L'
+    # The white top-left pixel ends up top-right, and inverted
+    assert img.getpixel((1, 0)) == 0
+    assert img.getpixel((0, 0)) == 255
+
+
+@pytest.mark.parametrize('ops', ['sharpen', 'rotate:45', 'crop:4x4', 'resize:x', ','])
+def test_bad_ops_get_400(client, ops):
+    response = client.post('/', data={'file': upload(png()), 'ops': ops})
+    assert response.status_code == 400
+
+
+def test_crop_outside_the_image_gets_400(client):
+    response = client.post('/', data={'file': upload(png()), 'ops': 'crop:2x2+10+10'})
+    assert response.status_code == 400
+
+
+def test_non_image_gets_415(client):
+    response = client.post('/', data={'file': upload(b'%PDF-1.7 not an image', 'a.pdf')})
+    assert response.status_code == 415
+
+
+def test_missing_file_gets_400(client):
+    assert client.post('/', data={'format': 'png'}).status_code == 400
+
+
+def test_one_file_batch_returns_an_archive(client):
+    response = client.post('/', data={'file': upload(png()), 'batch': '1'})
+    assert response.status_code == 200
+    assert response.content_type == 'application/zip'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        manifest = json.loads(archive.read('manifest.json'))
+        assert len(manifest['items']) == 1
+        assert len(archive.namelist()) == 2
+
+
+def test_one_file_without_marker_is_a_single_image(client):
+    response = client.post('/', data={'file': upload(png())})
+    assert response.status_code == 200
+    assert response.content_type == 'image/png'
+
+
+def test_batch_reports_every_item_in_the_manifest(client):
+    files = [upload(png(), 'a.png'), upload(png(color=(0, 0, 0)), 'b.png'), upload(b'junk', 'c.png')]
+    response = client.post('/', data={'file': files, 'batch': '1'})
+    assert response.status_code == 200
+    assert response.headers['X-Batch-Errors'] == '1'
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        items = json.loads(archive.read('manifest.json'))['items']
+        assert [item['status'] for item in items] == ['ok', 'ok', 'error']
+        negatives = [name for name in archive.namelist() if name != 'manifest.json']
+        assert len(negatives) == 2
+        assert Image.open(io.BytesIO(archive.read(negatives[1]))).getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_archive_upload_returns_a_tar(client):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as archive:
+        archive.writestr('one.png', png())
+        archive.writestr('two.png', png())
+    response = client.post('/', data={'archive': upload(buf.getvalue(), 'in.zip'), 'archive_format': 'tar'})
+    assert response.status_code == 200
+    assert response.content_type == 'application/x-tar'
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        names = archive.getnames()
+        assert 'manifest.json' in names
+        assert len(names) == 3
+
+
+def test_corrupt_archive_gets_400(client):
+    response = client.post('/', data={'archive': upload(b'PK\x03\x04 truncated', 'in.zip')})
+    assert response.status_code == 400
+
+
+def test_process_pool_mode(client, process_pool):
+    img = negative(client.post('/', data={'file': upload(png(mode='RGBA', color=(10, 20, 30, 128)))}))
+    assert workers._pool is not None
+    assert img.mode == 'RGBA'
+    assert img.getpixel((0, 0)) == (245, 235, 225, 128)
+
+    # Image errors raised in the worker are reported as for inline mode
+    assert client.post('/', data={'file': upload(png()), 'ops': 'crop:2x2+10+10'}).status_code == 400
@@ -0,0 +1,155 @@
+"""
+Distributed tracing for the negative-image function.
+
+The function continues the trace in the request's W3C ``traceparent``
+header (sent by service1) with a server span per request, a span around
+each transform and one span per image phase (decode, resize, invert,
+encode; see ``metrics`` for what each one covers).
+Phase spans are built from the timings ``imaging.process`` records, so
+transforms that ran in the worker pool are traced too.
+
+TRACING_EXPORTER picks the exporter: "none" (default), "file" (JSON lines
+in TRACING_FILE, a local stand-in for a collector), "console" or "otlp"
+(an OpenTelemetry collector at TRACING_OTLP_ENDPOINT).
+"""
+import importlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from opentelemetry import context, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+
+TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER', 'none')
+TRACING_SERVICE_NAME = os.environ.get('TRACING_SERVICE_NAME', 'negative-image-function')
+
+# exporter name -> (class path, constructor options)
+TRACING_EXPORTERS = {
+    'none': None,
+    'file': ('tracing.JsonLinesSpanExporter', {
+        'path': os.environ.get('TRACING_FILE', '/tmp/traces/spans.jsonl'),
+    }),
+    'console': ('opentelemetry.sdk.trace.export.ConsoleSpanExporter', {}),
+    'otlp': ('opentelemetry.exporter.otlp.proto.http.trace_exporter.OTLPSpanExporter', {
+        'endpoint': os.environ.get('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces'),
+    }),
+}
+
+PHASES = ('decode', 'resize', 'invert', 'encode')
+
+_propagator = TraceContextTextMapPropagator()
+
+_tracer = None
+_tracer_pid = None
+_lock = threading.Lock()
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """Appends one JSON object per finished span to a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, spans):
+        lines = []
+        for span in spans:
+            lines.append(json.dumps({
+                'trace_id': f'{span.context.trace_id:032x}',
+                'span_id': f'{span.context.span_id:016x}',
+                'parent_span_id': f'{span.parent.span_id:016x}' if span.parent else None,
+                'name': span.name,
+                'kind': span.kind.name,
+                'service': span.resource.attributes.get('service.name'),
+                'start_ns': span.start_time,
+                'duration_ms': round((span.end_time - span.start_time) / 1e6, 3),
+                'status': span.status.status_code.name,
+                'attributes': dict(span.attributes),
+            }))
+        try:
+            with self._lock, open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+        except OSError as e:
+            print(f"Span export failed: {str(e)}")
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def _load(path):
+    module, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+def get_tracer():
+    """This process's tracer, or None if tracing is off."""
+    global _tracer, _tracer_pid
+    pid = os.getpid()
+    if _tracer_pid != pid:
+        with _lock:
+            if _tracer_pid != pid:
+                backend = TRACING_EXPORTERS[TRACING_EXPORTER]
+                if backend is None:
+                    _tracer = None
+                else:
+                    class_path, options = backend
+                    provider = TracerProvider(resource=Resource.create({'service.name': TRACING_SERVICE_NAME}))
+                    provider.add_span_processor(BatchSpanProcessor(_load(class_path)(**options)))
+                    _tracer = provider.get_tracer('negative_image')
+                _tracer_pid = pid
+    return _tracer
+
+
+@contextmanager
+def span(name, kind=trace.SpanKind.INTERNAL, attributes=None):
+    """Run the block in a child span of the current one; yields None if tracing is off."""
+    tracer = get_tracer()
+    if tracer is None:
+        yield None
+        return
+    with tracer.start_as_current_span(name, kind=kind, attributes=attributes) as current:
+        yield current
+
+
+@contextmanager
+def server_span(request):
+    """Server span for ``request``, continuing the trace in its ``traceparent``."""
+    token = context.attach(_propagator.extract(request.headers))
+    try:
+        with span(f'{request.method} negative-image', trace.SpanKind.SERVER,
+                  {'http.method': request.method}) as current:
+            yield current
+    finally:
+        context.detach(token)
+
+
+def record_status(current, status_code):
+    if current is None:
+        return
+    current.set_attribute('http.status_code', status_code)
+    if status_code >= 500:
+        current.set_status(trace.Status(trace.StatusCode.ERROR))
+
+
+def record_phases(timings):
+    """Add a span for each phase in ``timings`` (from ``imaging.process``) to the current span."""
+    tracer = get_tracer()
+    if tracer is None or 'start_ns' not in timings:
+        return
+    start = timings['start_ns']
+    for phase in PHASES:
+        if phase not in timings:
+            continue
+        end = start + int(timings[phase] * 1e9)
+        phase_span = tracer.start_span(phase, start_time=start)
+        if phase == 'decode' and 'pixels' in timings:
+            phase_span.set_attribute('image.pixels', timings['pixels'])
+        phase_span.end(end_time=end)
+        start = end
@@ -0,0 +1,224 @@
+"""
+Optional process pool for the negative-image transform.
+
+With ``EXECUTION_MODE=process`` each decode/invert/encode runs in a warm
+``ProcessPoolExecutor`` instead of on the request thread, so an instance
+with several vCPUs and request concurrency above one can use every core.
+Image bytes travel to and from the workers through shared memory blocks;
+only the block names and sizes are pickled.
+
+The number of jobs waiting for or running in the pool is capped at
+MAX_QUEUED_JOBS (callers beyond it get WorkerBusy) and callers stop
+waiting after JOB_TIMEOUT seconds (WorkerTimeout).
+"""
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import imaging
+
+
+def _available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# 'inline' runs transforms on the request thread, 'process' in the pool
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'inline').lower()
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', str(_available_cpus())))
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', str(WORKER_PROCESSES * 2)))
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', '30'))
+# Forking a multi-threaded server is unsafe, so workers come from a fork server
+WORKER_START_METHOD = os.environ.get('WORKER_START_METHOD', 'forkserver')
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(MAX_QUEUED_JOBS)
+
+
+class WorkerBusy(Exception):
+    """Raised when MAX_QUEUED_JOBS transforms are already pending."""
+
+
+class WorkerTimeout(Exception):
+    """Raised when a transform does not finish within JOB_TIMEOUT."""
+
+
+def _warm_up():
+    # Runs once in every worker; importing imaging loads Pillow and its limits
+    return os.getpid()
+
+
+def _transform(input_name, input_size, pillow_format, save_kwargs, pipeline=None):
+    """Worker side: decode from one shared block and encode into a new one.
+
+    Returns ``(output_name, output_size, timings)``. The parent unlinks
+    both blocks.
+    """
+    source = shared_memory.SharedMemory(name=input_name)
+    try:
+        view = source.buf[:input_size]
+        try:
+            stream = io.BytesIO(view)
+        finally:
+            view.release()
+    finally:
+        source.close()
+
+    timings = {}
+    result = imaging.process(stream, pillow_format, save_kwargs, timings, pipeline)
+    try:
+        size = result.seek(0, os.SEEK_END)
+        result.seek(0)
+        output = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            view = output.buf[:size]
+            try:
+                result.readinto(view)
+            finally:
+                view.release()
+        finally:
+            output.close()
+    finally:
+        result.close()
+    return output.name, size, timings
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=WORKER_PROCESSES,
+                    mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                )
+                # Start every worker now rather than on the first requests
+                for future in [pool.submit(_warm_up) for _ in range(WORKER_PROCESSES)]:
+                    future.result()
+                _pool = pool
+    return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _unlink(name):
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+def _copy_stream(stream, block, size):
+    """Copy ``size`` bytes of ``stream`` into the shared ``block``."""
+    stream.seek(0)
+    view = block.buf[:size]
+    try:
+        offset = 0
+        while offset < size:
+            count = stream.readinto(view[offset:offset + 64 * 1024])
+            if not count:
+                break
+            offset += count
+    finally:
+        view.release()
+
+
+def _read_output(name, size):
+    """Move a worker's result out of shared memory into a rewound file."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        if size <= imaging.SPOOL_MAX_BYTES:
+            output = io.BytesIO()
+        else:
+            output = tempfile.SpooledTemporaryFile(max_size=imaging.SPOOL_MAX_BYTES)
+        view = block.buf[:size]
+        try:
+            output.write(view)
+        finally:
+            view.release()
+    finally:
+        block.close()
+        block.unlink()
+    output.seek(0)
+    return output
+
+
+def _finish(future, source):
+    """Release the job's slot and shared memory once the worker is done with it."""
+    source.close()
+    source.unlink()
+    _slots.release()
+    if future.cancelled() or future.exception() is not None:
+        return
+    if getattr(future, 'abandoned', False):
+        # The caller timed out, so nobody will read the result
+        _unlink(future.result()[0])
+
+
+def process_in_pool(stream, pillow_format, save_kwargs, timings=None, pipeline=None):
+    """Run ``imaging.process`` for ``stream`` in the worker pool.
+
+    Raises WorkerBusy if the pool's queue is full and WorkerTimeout if the
+    job takes longer than JOB_TIMEOUT. Image errors from the worker are
+    re-raised unchanged.
+    """
+    if not _slots.acquire(blocking=False):
+        raise WorkerBusy(f'{MAX_QUEUED_JOBS} image transforms are already queued')
+    try:
+        size = stream.seek(0, os.SEEK_END)
+        source = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    except Exception:
+        _slots.release()
+        raise
+    try:
+        _copy_stream(stream, source, size)
+        pool = _get_pool()
+        future = pool.submit(_transform, source.name, size, pillow_format, save_kwargs, pipeline)
+    except Exception:
+        source.close()
+        source.unlink()
+        _slots.release()
+        raise
+    future.add_done_callback(lambda done: _finish(done, source))
+
+    try:
+        output_name, output_size, worker_timings = future.result(timeout=JOB_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.abandoned = True
+        if future.done() and future.exception() is None:
+            # Finished between the timeout and the flag being set
+            _unlink(future.result()[0])
+        raise WorkerTimeout(f'Image transform did not finish within {JOB_TIMEOUT:g}s')
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); start a fresh pool next time
+        _discard_pool(pool)
+        raise
+    if timings is not None:
+        timings.update(worker_timings)
+    return _read_output(output_name, output_size)
+
+
+def process(stream, pillow_format, save_kwargs, timings=None, pipeline=None):
+    """Decode, transform and encode one image using the configured execution mode.
+
+    ``timings`` and ``pipeline`` are as for ``imaging.process``.
+    """
+    if EXECUTION_MODE == 'process':
+        return process_in_pool(stream, pillow_format, save_kwargs, timings, pipeline)
+    return imaging.process(stream, pillow_format, save_kwargs, timings, pipeline)
@@ -1,6 +1,53 @@
 import React, { useState } from 'react';
 import './App.css';
 
+// Extension for each image type the backend can return
+const EXTENSIONS = {
+  'image/avif': 'avif',
+  'image/webp': 'webp',
+  'image/png': 'png',
+  'image/jpeg': 'jpg',
+};
+
+// Sent when no output format is chosen, so the backend can pick the
+// smallest format this browser displays
+const NEGOTIATED_ACCEPT = 'image/webp,image/png;q=0.9,*/*;q=0.5';
+
+// Shrink the image to fit maxWidth x maxHeight and re-encode it in the
+// browser, so large originals are not uploaded in full. Returns the
+// original file if it already fits or cannot be decoded here.
+const downscaleForUpload = async (file, maxWidth, maxHeight) => {
+  let bitmap;
+  try {
+    bitmap = await createImageBitmap(file);
+  } catch (error) {
+    return file;
+  }
+  const scale = Math.min(
+    maxWidth ? maxWidth / bitmap.width : 1,
+    maxHeight ? maxHeight / bitmap.height : 1,
+    1
+  );
+  if (scale === 1) {
+    bitmap.close();
+    return file;
+  }
+  const canvas = document.createElement('canvas');
+  canvas.width = Math.max(1, Math.round(bitmap.width * scale));
+  canvas.height = Math.max(1, Math.round(bitmap.height * scale));
+  const context = canvas.getContext('2d');
+  context.imageSmoothingQuality = 'high';
+  context.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+  bitmap.close();
+  // Browsers without a WebP encoder fall back to PNG
+  const blob = await new Promise((resolve) => canvas.toBlob(resolve, 'image/webp', 0.92));
+  if (!blob || blob.size >= file.size) {
+    return file;
+  }
+  const name = file.name.replace(/\.[^.]*$/, '') + '.' + (EXTENSIONS[blob.type] || 'png');
+  return new File([blob], name, { type: blob.type });
+};
+
 function App() {
   const [input, setInput] = useState('');
   const [service1Response, setService1Response] = useState('');
@@ -11,6 +58,11 @@ function App() {
   const [processing, setProcessing] = useState(false);
   const [downloadUrl, setDownloadUrl] = useState(null);
   const [cloudFnError, setCloudFnError] = useState('');
+  const [downloadName, setDownloadName] = useState('negative.png');
+  const [maxWidth, setMaxWidth] = useState('');
+  const [maxHeight, setMaxHeight] = useState('');
+  const [outputFormat, setOutputFormat] = useState('');
+  const [resizeBeforeUpload, setResizeBeforeUpload] = useState(true);
 
   const callService1 = async () => {
     try {
@@ -51,12 +103,29 @@ function App() {
     setDownloadUrl(null);
     try {
       const proxyUrl = '/api/service1/negative-image/';
+      const width = parseInt(maxWidth, 10) || 0;
+      const height = parseInt(maxHeight, 10) || 0;
+      const upload = resizeBeforeUpload && (width || height)
+        ? await downscaleForUpload(selectedFile, width, height)
+        : selectedFile;
+
       const formData = new FormData();
-      formData.append('file', selectedFile);
+      formData.append('file', upload);
+      // The backend also enforces the size, whatever was uploaded
+      if (width) {
+        formData.append('max_width', width);
+      }
+      if (height) {
+        formData.append('max_height', height);
+      }
+      if (outputFormat) {
+        formData.append('format', outputFormat);
+      }
 
       const response = await fetch(proxyUrl, {
         method: 'POST',
-        body: formData
+        body: formData,
+        headers: outputFormat ? {} : { Accept: NEGOTIATED_ACCEPT }
       });
       if (!response.ok) {
         const text = await response.text();
@@ -64,6 +133,7 @@ function App() {
       }
       const blob = await response.blob();
       const url = window.URL.createObjectURL(blob);
+      setDownloadName(`negative.${EXTENSIONS[blob.type] || 'png'}`);
       setDownloadUrl(url);
     } catch (err) {
       setCloudFnError(err.message);
@@ -102,12 +172,42 @@ function App() {
         <div className="cloud-function-section">
           <h2>Image Negative Cloud Function</h2>
           <input type="file" accept="image/*" onChange={handleFileChange} />
+          <div className="image-options">
+            <input
+              type="number"
+              min="1"
+              value={maxWidth}
+              onChange={(e) => setMaxWidth(e.target.value)}
+              placeholder="Max width"
+            />
+            <input
+              type="number"
+              min="1"
+              value={maxHeight}
+              onChange={(e) => setMaxHeight(e.target.value)}
+              placeholder="Max height"
+            />
+            <select value={outputFormat} onChange={(e) => setOutputFormat(e.target.value)}>
+              <option value="">Best for this browser</option>
+              <option value="webp">WebP</option>
+              <option value="png">PNG</option>
+              <option value="jpeg">JPEG</option>
+            </select>
+            <label>
+              <input
+                type="checkbox"
+                checked={resizeBeforeUpload}
+                onChange={(e) => setResizeBeforeUpload(e.target.checked)}
+              />
+              Resize before upload
+            </label>
+          </div>
           <button onClick={handleCloudFunction} disabled={processing}>
             {processing ? 'Processing...' : 'Create Negative'}
           </button>
           {cloudFnError && <p style={{ color: 'red' }}>{cloudFnError}</p>}
           {downloadUrl && (
-            <a href={downloadUrl} download="negative.png">Download Negative Image</a>
+            <a href={downloadUrl} download={downloadName}>Download Negative Image</a>
           )}
         </div>
       </header>
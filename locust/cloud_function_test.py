@@ -1,33 +1,16 @@
-from locust import HttpUser, task, between
+from locust import FastHttpUser, task, between
 import os
-import time
-import random
-import csv
-from datetime import datetime
+from form_data_helper import cached_form_data_for_image
 
-class CloudFunctionUser(HttpUser):
+import metrics
+
+# One row per request (with the image size taken from the request context),
+# written in batches by the master
+metrics.install('cloud_function_performance', detail_fields=('image_size',))
+
+class CloudFunctionUser(FastHttpUser):
     wait_time = between(1, 3)
     
-    def on_start(self):
-        """Setup for the Cloud Function tests"""
-        self.results_dir = "results"
-        os.makedirs(self.results_dir, exist_ok=True)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.csv_file_path = f"{self.results_dir}/cloud_function_performance_{timestamp}.csv"
-        
-        with open(self.csv_file_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(['Timestamp', 'Image Size', 'Request Time (ms)', 'Response Size (bytes)', 'Success', 'Status Code', 'Error'])
-    
-    def log_metrics(self, image_size, request_time_ms, response_size, success, status_code=200, error=''):
-        """Log detailed metrics to CSV file"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-        
-        with open(self.csv_file_path, 'a', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([timestamp, image_size, request_time_ms, response_size, success, status_code, error])
-    
     @task
     def test_small_image(self):
         """Test with small image (~50KB)"""
@@ -52,63 +35,38 @@ class CloudFunctionUser(HttpUser):
             return
         
         file_size = os.path.getsize(image_path)
-        
-        start_time = time.time()
+        body, content_type = cached_form_data_for_image(image_path, field_name="file")
         
         headers = {
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Accept': 'image/png,image/*,*/*;q=0.8',
             'Accept-Language': 'en-US,en;q=0.9',
             'Origin': self.host,
-            'Referer': f"{self.host}/"
+            'Referer': f"{self.host}/",
+            'Content-Type': content_type
         }
         
-        try:
-            with open(image_path, "rb") as image_file:
-                file_content = image_file.read()
-            
-            file_name = os.path.basename(image_path)
-            
-            files = {
-                "file": (file_name, file_content, "image/png")
-            }
+        with self.client.post(
+            "/api/service1/negative-image/",
+            data=body,
+            headers=headers,
+            name=f"Cloud Function - {size.capitalize()} Image ({file_size/1024:.1f}KB)",
+            context={'image_size': size},
+            catch_response=True
+        ) as response:
+            status_code = response.status_code
             
-            with self.client.post(
-                "/api/service1/negative-image/",
-                files=files,
-                headers=headers,
-                name=f"Cloud Function - {size.capitalize()} Image ({file_size/1024:.1f}KB)",
-                catch_response=True
-            ) as response:
-                end_time = time.time()
-                request_time_ms = (end_time - start_time) * 1000
-                status_code = response.status_code
-                success = status_code == 200
-                error_msg = ''
-                
-                if success:
-                    if response.headers.get('Content-Type', '').startswith('image/'):
-                        response_size = len(response.content)
-                        self.log_metrics(size, request_time_ms, response_size, True, status_code)
-                        response.success()
-                    else:
-                        error_msg = f"Not an image: {response.headers.get('Content-Type')}"
-                        print(f"ERROR: {error_msg}")
-                        print(f"Content preview: {response.content[:100]}")
-                        self.log_metrics(size, request_time_ms, len(response.content), False, status_code, error_msg)
-                        response.failure(error_msg)
+            if status_code == 200:
+                if response.headers.get('Content-Type', '').startswith('image/'):
+                    response.success()
                 else:
-                    error_msg = f"HTTP {status_code}"
-                    print(f"ERROR: Cloud Function returned {status_code}")
-                    print(f"Headers: {dict(response.headers)}")
-                    print(f"Content: {response.content[:200]}")
-                    response_size = len(response.content) if response.content else 0
-                    self.log_metrics(size, request_time_ms, response_size, False, status_code, error_msg)
+                    error_msg = f"Not an image: {response.headers.get('Content-Type')}"
+                    print(f"ERROR: {error_msg}")
+                    print(f"Content preview: {response.content[:100]}")
                     response.failure(error_msg)
-        except Exception as e:
-            end_time = time.time()
-            request_time_ms = (end_time - start_time) * 1000
-            error_msg = str(e)
-            print(f"EXCEPTION: {error_msg}")
-            self.log_metrics(size, request_time_ms, 0, False, 0, error_msg)
-            raise 
\ No newline at end of file
+            else:
+                error_msg = f"HTTP {status_code}"
+                print(f"ERROR: Cloud Function returned {status_code}")
+                print(f"Headers: {dict(response.headers)}")
+                print(f"Content: {(response.content or b'')[:200]}")
+                response.failure(error_msg)
@@ -1,6 +1,7 @@
 """
 Helper functions for better form data handling in Locust
 """
+import functools
 import random
 import string
 import os
@@ -84,4 +85,15 @@ def create_form_data_for_image(image_path, field_name="file"):
         field_name: (os.path.basename(image_path), file_content, content_type)
     }
     
-    return create_multipart_formdata({}, files) 
\ No newline at end of file
+    return create_multipart_formdata({}, files) 
+
+@functools.lru_cache(maxsize=None)
+def cached_form_data_for_image(image_path, field_name="file"):
+    """
+    Same as create_form_data_for_image, but builds each body only once.
+    
+    Load tests send the same few images over and over; re-reading and
+    re-encoding them on every request costs generator CPU that should go
+    into sending requests.
+    """
+    return create_form_data_for_image(image_path, field_name)
@@ -2,12 +2,13 @@
 """
 Generate test images of different sizes for Locust performance testing.
 """
+import argparse
 import os
 from PIL import Image, ImageDraw
 import random
 import numpy as np
 
-def create_test_image(name, width, height, complexity=10):
+def create_test_image(name, width, height, complexity=10, output_dir="test_images"):
     """Create a test image with specified dimensions and visual complexity.
     
     Args:
@@ -15,6 +16,7 @@ def create_test_image(name, width, height, complexity=10):
         width: Image width in pixels
         height: Image height in pixels
         complexity: Number of shapes to draw (affects file size)
+        output_dir: Directory the image is written to
     """
     # Create a blank image with a white background
     img = Image.new('RGB', (width, height), color='white')
@@ -66,23 +68,39 @@ def create_test_image(name, width, height, complexity=10):
         
         img = Image.fromarray(img_array)
     
-    img.save(f"test_images/{name}.png", quality=95 if name == "large" else 85)
+    path = os.path.join(output_dir, f"{name}.png")
+    img.save(path, quality=95 if name == "large" else 85)
     
-    file_size = os.path.getsize(f"test_images/{name}.png") / 1024  # KB
+    file_size = os.path.getsize(path) / 1024  # KB
     print(f"Created {name}.png ({file_size:.2f} KB)")
 
-def main():
-    """Generate test images of different sizes."""
-    os.makedirs("test_images", exist_ok=True)
+def generate(output_dir="test_images", seed=None):
+    """Generate the small, medium and large test images in ``output_dir``.
+
+    With a ``seed`` the images are byte-for-byte reproducible, so benchmark
+    runs on different commits replay the same workload.
+    """
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+    os.makedirs(output_dir, exist_ok=True)
     
     # Create small image (~50KB)
-    create_test_image("small", 200, 150, complexity=5)
+    create_test_image("small", 200, 150, complexity=5, output_dir=output_dir)
     
     # Create medium image (~500KB)
-    create_test_image("medium", 400, 300, complexity=10)
+    create_test_image("medium", 400, 300, complexity=10, output_dir=output_dir)
     
     # Create large image (~2MB)
-    create_test_image("large", 600, 450, complexity=20)
+    create_test_image("large", 600, 450, complexity=20, output_dir=output_dir)
+
+def main():
+    """Generate test images of different sizes."""
+    parser = argparse.ArgumentParser(description="Generate test images for performance testing.")
+    parser.add_argument("--output-dir", default="test_images")
+    parser.add_argument("--seed", type=int, help="Seed for reproducible images")
+    args = parser.parse_args()
+    generate(args.output_dir, args.seed)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,27 +1,22 @@
-from locust import HttpUser, task, between
+from locust import FastHttpUser, task, between
 import random
 import os
 import json
-from form_data_helper import create_form_data_for_image
+from form_data_helper import cached_form_data_for_image
 
-class ProjectUserCustomFormData(HttpUser):
+import metrics
+
+metrics.install('load_test')
+
+class ProjectUserCustomFormData(FastHttpUser):
     wait_time = between(1, 5)
     
-    def on_start(self):
-        """Initialize the user session"""
-        os.makedirs("results", exist_ok=True)
-        
-        self.browser_headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Connection': 'keep-alive'
-        }
-        
-        self.client.headers.update({
-            'Content-Type': 'application/json',
-            **self.browser_headers
-        })
+    # Sent with every request; FastHttpUser keeps connections alive itself
+    default_headers = {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Accept': '*/*',
+        'Accept-Language': 'en-US,en;q=0.9',
+    }
     
     @task(3)
     def call_service1(self):
@@ -78,7 +73,7 @@ class ProjectUserCustomFormData(HttpUser):
             return
         
         try:
-            body, content_type = create_form_data_for_image(image_path, field_name="file")
+            body, content_type = cached_form_data_for_image(image_path, field_name="file")
             
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -0,0 +1,319 @@
+"""
+Shared metrics collection for the Locust test scripts.
+
+Every request Locust reports is recorded in a log-linear latency histogram
+(HDR-style: a fixed relative error of under 1% and bounded memory however
+long the run) and, optionally, as a detail row. Output is written once per
+run under ``results/``:
+
+    <prefix>_<run>_summary.csv      time series of the whole run
+    <prefix>_<run>_endpoints.csv    per-endpoint percentiles at the end
+    <prefix>_<run>_requests.csv     one row per request (if enabled)
+
+Rows are buffered and written in batches. In distributed mode the workers
+ship their histograms and rows to the master with each stats report, and
+only the master writes files.
+
+Usage in a locustfile:
+
+    import metrics
+    metrics.install('stress_test')
+"""
+import csv
+import os
+import time
+from datetime import datetime
+
+import gevent
+from locust import events
+from locust.runners import MasterRunner, WorkerRunner
+
+RESULTS_DIR = os.environ.get('LOCUST_RESULTS_DIR', 'results')
+SUMMARY_INTERVAL = float(os.environ.get('LOCUST_SUMMARY_INTERVAL', '5'))
+
+# Values below this many microseconds are stored exactly; larger values keep
+# their top SIGNIFICANT_BITS bits, a relative error of at most 2 ** -7
+SIGNIFICANT_BITS = 8
+
+
+class LatencyHistogram:
+    """Streaming latency histogram with HDR-style log-linear buckets."""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def _bucket(micros):
+        shift = micros.bit_length() - SIGNIFICANT_BITS
+        if shift <= 0:
+            return micros
+        return (micros >> shift) << shift
+
+    def record(self, value_ms):
+        micros = max(0, int(value_ms * 1000))
+        bucket = self._bucket(micros)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value_ms
+        self.min = value_ms if self.min is None else min(self.min, value_ms)
+        self.max = value_ms if self.max is None else max(self.max, value_ms)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """Latency in milliseconds below which ``fraction`` of requests fall."""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(round(fraction * self.count)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(bucket / 1000.0, self.max)
+        return self.max
+
+    def to_dict(self):
+        # Buckets travel to the master as pairs so msgpack never sees integer map keys
+        return {
+            'counts': [[bucket, count] for bucket, count in self.counts.items()],
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts = {bucket: count for bucket, count in data['counts']}
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+
+class BufferedCsvWriter:
+    """CSV file that collects rows in memory and writes them in batches."""
+
+    def __init__(self, path, header, batch_size=500):
+        self.path = path
+        self._batch_size = batch_size
+        self._rows = []
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(header)
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self._batch_size:
+            self.flush()
+
+    def write_many(self, rows):
+        self._rows.extend(rows)
+        if len(self._rows) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self._writer.writerows(self._rows)
+            self._rows = []
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class MetricsCollector:
+    """Collects request metrics for one locustfile and writes per-run output.
+
+    Args:
+        prefix: Name used for the result files
+        detail_fields: Request ``context`` keys added as columns to the
+            per-request CSV; ``None`` disables that file
+    """
+
+    SUMMARY_HEADER = ['Time (s)', 'Requests', 'Success Rate (%)', 'Avg Response Time (ms)',
+                      'P50 (ms)', 'P95 (ms)', 'P99 (ms)', 'RPS', 'Failures']
+
+    def __init__(self, prefix, detail_fields=None):
+        self.prefix = prefix
+        self.detail_fields = detail_fields
+        self._writes_files = False
+        self._reset()
+        self._summary = None
+        self._requests = None
+        self._summary_loop = None
+
+    def _reset(self):
+        self.histograms = {}
+        self.failures = {}
+        self._pending_rows = []
+        self._started = time.time()
+        self._stopped = None
+
+    @property
+    def run_histogram(self):
+        total = LatencyHistogram()
+        for histogram in self.histograms.values():
+            total.merge(histogram)
+        return total
+
+    # Locust event handlers
+
+    def on_test_start(self, environment, **kwargs):
+        self._finish_run()
+        self._writes_files = not isinstance(environment.runner, WorkerRunner)
+        self._reset()
+        if not self._writes_files:
+            return
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        run = datetime.now().strftime('%Y%m%d_%H%M%S')
+        base = os.path.join(RESULTS_DIR, f'{self.prefix}_{run}')
+        self._summary = BufferedCsvWriter(f'{base}_summary.csv', self.SUMMARY_HEADER, batch_size=1)
+        self._endpoints_path = f'{base}_endpoints.csv'
+        if self.detail_fields is not None:
+            self._requests = BufferedCsvWriter(f'{base}_requests.csv', [
+                'Timestamp', 'Name', *[field.replace('_', ' ').title() for field in self.detail_fields],
+                'Request Time (ms)', 'Response Size (bytes)', 'Success', 'Status Code', 'Error'])
+        self._summary_loop = gevent.spawn(self._write_summaries)
+
+    def on_request(self, request_type, name, response_time, response_length, exception=None,
+                   context=None, response=None, **kwargs):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.record(response_time)
+        if exception is not None:
+            self.failures[name] = self.failures.get(name, 0) + 1
+        if self.detail_fields is not None:
+            context = context or {}
+            self._pending_rows.append([
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+                name,
+                *[context.get(field, '') for field in self.detail_fields],
+                round(response_time, 2),
+                response_length,
+                exception is None,
+                getattr(response, 'status_code', 0) or 0,
+                str(exception) if exception is not None else '',
+            ])
+            if self._requests is not None:
+                self._requests.write_many(self._pending_rows)
+                self._pending_rows = []
+
+    def on_report_to_master(self, client_id, data):
+        """Worker: hand everything recorded since the last report to the master."""
+        data['metrics'] = {
+            'histograms': {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            'failures': self.failures,
+            'rows': self._pending_rows,
+        }
+        self.histograms = {}
+        self.failures = {}
+        self._pending_rows = []
+
+    def on_worker_report(self, client_id, data):
+        """Master: merge a worker's report."""
+        report = data.get('metrics')
+        if not report:
+            return
+        for name, histogram in report['histograms'].items():
+            self.histograms.setdefault(name, LatencyHistogram()).merge(LatencyHistogram.from_dict(histogram))
+        for name, count in report['failures'].items():
+            self.failures[name] = self.failures.get(name, 0) + count
+        if self._requests is not None and report['rows']:
+            self._requests.write_many(report['rows'])
+
+    def on_test_stop(self, environment, **kwargs):
+        if not self._writes_files or self._summary is None:
+            return
+        self._stopped = time.time()
+        if self._summary_loop is not None:
+            self._summary_loop.kill(block=False)
+            self._summary_loop = None
+        # Workers send their last report after the master's test_stop, so the
+        # master finishes the run when it quits or the next run starts
+        if not isinstance(environment.runner, MasterRunner):
+            self._finish_run()
+
+    def on_quitting(self, environment, **kwargs):
+        self._finish_run()
+
+    def _finish_run(self):
+        if self._summary is None:
+            return
+        self._write_summary()
+        self._summary.close()
+        self._summary = None
+        if self._requests is not None:
+            self._requests.close()
+            self._requests = None
+        self._write_endpoints()
+
+    # Output
+
+    def _write_summaries(self):
+        while True:
+            gevent.sleep(SUMMARY_INTERVAL)
+            self._write_summary()
+
+    def _write_summary(self):
+        histogram = self.run_histogram
+        if not histogram.count:
+            return
+        elapsed = (self._stopped or time.time()) - self._started
+        failures = sum(self.failures.values())
+        self._summary.write([
+            round(elapsed, 1),
+            histogram.count,
+            round((histogram.count - failures) / histogram.count * 100, 2),
+            round(histogram.mean, 2),
+            round(histogram.percentile(0.50), 2),
+            round(histogram.percentile(0.95), 2),
+            round(histogram.percentile(0.99), 2),
+            round(histogram.count / elapsed, 2) if elapsed > 0 else 0,
+            failures,
+        ])
+
+    def _write_endpoints(self):
+        with open(self._endpoints_path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Name', 'Requests', 'Failures', 'Avg (ms)', 'Min (ms)', 'P50 (ms)',
+                             'P90 (ms)', 'P95 (ms)', 'P99 (ms)', 'P99.9 (ms)', 'Max (ms)'])
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                writer.writerow([
+                    name, histogram.count, self.failures.get(name, 0), round(histogram.mean, 2),
+                    round(histogram.min or 0, 2),
+                    *[round(histogram.percentile(q), 2) for q in (0.50, 0.90, 0.95, 0.99, 0.999)],
+                    round(histogram.max or 0, 2),
+                ])
+
+
+def install(prefix, detail_fields=None):
+    """Register a MetricsCollector for this locustfile and return it."""
+    collector = MetricsCollector(prefix, detail_fields)
+    events.test_start.add_listener(collector.on_test_start)
+    events.request.add_listener(collector.on_request)
+    events.report_to_master.add_listener(collector.on_report_to_master)
+    events.worker_report.add_listener(collector.on_worker_report)
+    events.test_stop.add_listener(collector.on_test_stop)
+    events.quitting.add_listener(collector.on_quitting)
+    return collector
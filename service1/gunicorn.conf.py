@@ -0,0 +1,44 @@
+"""
+Gunicorn configuration for service1.
+
+Run with ``gunicorn -c gunicorn.conf.py``. The settings and the environment
+variables that override them are in ``service_common.gunicorn_conf``; this
+file only adds the job queue:
+
+JOB_QUEUE_BACKEND
+    Defaults to ``sqlite`` with more than one worker, so every worker can
+    report on every job, and to ``memory`` otherwise. ``memory`` with more
+    than one worker is refused, and its worker is never recycled, as its
+    jobs would be lost.
+GUNICORN_TIMEOUT
+    Defaults to 75 seconds here, as image requests wait up to
+    UPSTREAM_READ_TIMEOUT on the function.
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'service1_project.settings')
+
+from service_common import gunicorn_conf as base  # noqa: E402
+from service_common.gunicorn_conf import *  # noqa: E402,F401,F403
+
+# Must be set before the app is imported; in-memory jobs are only visible to their own worker
+_job_queue_backend = os.environ.setdefault('JOB_QUEUE_BACKEND', 'sqlite' if workers > 1 else 'memory')
+
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '0' if _job_queue_backend == 'memory' else '1000'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '75'))
+
+
+def on_starting(server):
+    if _job_queue_backend == 'memory' and workers > 1:
+        raise RuntimeError(
+            f'JOB_QUEUE_BACKEND=memory cannot be shared by {workers} workers; '
+            'use JOB_QUEUE_BACKEND=sqlite or GUNICORN_WORKERS=1')
+    base.on_starting(server)
+
+
+def post_worker_init(worker):
+    # Run queued jobs from the start, including ones left by the workers of a previous run
+    from hello_app import jobs
+    from hello_app.views import run_negative_image_job
+
+    jobs.start_runner(run_negative_image_job)
@@ -0,0 +1,139 @@
+"""
+Admission control for image requests.
+
+``AdmissionMiddleware`` sheds GET and POST requests to the routes in
+ADMISSION_PATHS (image uploads, and job status polls, which may long-poll)
+with a 503 and Retry-After when:
+
+- they already waited more than ADMISSION_MAX_QUEUE_TIME seconds before
+  reaching the worker, going by the ``X-Request-Start`` header nginx sets;
+- ADMISSION_MAX_IN_FLIGHT image requests are already running in this
+  worker and no slot frees up within ADMISSION_QUEUE_TIMEOUT seconds.
+
+Keeping the in-flight limit below the worker's thread count leaves threads
+free for ``/api/hello/`` and the other cheap routes while the Cloud
+Function is slow. Under ASGI the middleware runs on the event loop and
+only the queue-time check applies; the async proxy has its own limiter
+(``async_upstream.ConcurrencyLimiter``).
+"""
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse
+
+from . import metrics
+
+
+def service_unavailable(message, retry_after):
+    response = JsonResponse({'error': message}, status=503)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def queue_time(request):
+    """Seconds since the front proxy received ``request``, or None if unknown."""
+    value = request.headers.get('X-Request-Start', '')
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return None
+    # nginx sends seconds ($msec); other proxies send milli- or microseconds
+    while started > 1e11:
+        started /= 1000
+    return max(0.0, time.time() - started)
+
+
+class ReleasingIterator:
+    """Streamed response body that frees an admission slot once the response is closed."""
+
+    def __init__(self, chunks, release):
+        self._chunks = iter(chunks)
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        try:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+        finally:
+            self._release()
+
+
+class AdmissionMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.ADMISSION_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.paths = tuple(settings.ADMISSION_PATHS)
+        self.slots = threading.BoundedSemaphore(settings.ADMISSION_MAX_IN_FLIGHT)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def admitted(self, request):
+        return request.method in ('GET', 'POST') and request.path_info.startswith(self.paths)
+
+    def queued_too_long(self, request):
+        """A 503 for ``request`` if it waited too long to reach this worker, else None."""
+        waited = queue_time(request)
+        if waited is not None and waited > settings.ADMISSION_MAX_QUEUE_TIME:
+            metrics.SHED_REQUESTS.labels('queue_time').inc()
+            return service_unavailable('Request waited too long in the queue', 1)
+        return None
+
+    async def __acall__(self, request):
+        if self.admitted(request):
+            response = self.queued_too_long(request)
+            if response is not None:
+                return response
+        return await self.get_response(request)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.admitted(request):
+            return self.get_response(request)
+
+        response = self.queued_too_long(request)
+        if response is not None:
+            return response
+
+        if isinstance(request, ASGIRequest):
+            return self.get_response(request)
+
+        if not self.slots.acquire(timeout=settings.ADMISSION_QUEUE_TIMEOUT):
+            metrics.SHED_REQUESTS.labels('in_flight').inc()
+            return service_unavailable('Too many image requests in progress', 1)
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.slots.release()
+
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            release()
+            raise
+        if response.streaming:
+            # The upstream call is still open until the body has been sent
+            response.streaming_content = ReleasingIterator(response.streaming_content, release)
+        else:
+            release()
+        return response
@@ -0,0 +1,104 @@
+"""
+Async HTTP client and admission limits for the ASGI image proxy.
+
+Each event loop gets one pooled ``httpx.AsyncClient`` and one
+``ConcurrencyLimiter``. Requests beyond the in-flight limit wait in a
+bounded queue for a short time and are then turned away, so a burst of
+uploads degrades into fast 503s instead of unbounded memory growth.
+"""
+import asyncio
+import weakref
+
+from django.conf import settings
+
+_clients = weakref.WeakKeyDictionary()
+_limiters = weakref.WeakKeyDictionary()
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted in time."""
+
+
+class ConcurrencyLimiter:
+    """Caps in-flight upstream calls and the number of callers queued for one."""
+
+    def __init__(self, max_in_flight, max_queued, queue_timeout):
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._max_queued = max_queued
+        self._queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+
+    async def acquire(self):
+        if self.queued >= self._max_queued:
+            raise Overloaded('Too many queued image requests')
+        self.queued += 1
+        # Before Python 3.12, wait_for can time out or be cancelled just after
+        # the semaphore granted a permit and drop it; acquiring in a shielded
+        # task lets that permit be handed back instead
+        acquiring = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            await asyncio.wait_for(asyncio.shield(acquiring), self._queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(acquiring)
+            raise Overloaded('Timed out waiting for an upstream slot')
+        except BaseException:
+            self._abandon(acquiring)
+            raise
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+
+    def _abandon(self, acquiring):
+        """Stop waiting for ``acquiring``, releasing the permit if it won one anyway."""
+
+        def give_back(task):
+            if not task.cancelled() and task.exception() is None:
+                self._semaphore.release()
+
+        acquiring.cancel()
+        acquiring.add_done_callback(give_back)
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+def get_async_client():
+    """Return the pooled async client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        # Imported here so WSGI workers never load httpx
+        import httpx
+
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.ASYNC_UPSTREAM_MAX_KEEPALIVE,
+            ),
+            timeout=httpx.Timeout(
+                settings.UPSTREAM_READ_TIMEOUT,
+                connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+                # Waiting for a pooled connection is bounded by the limiter
+                pool=None,
+            ),
+            # Retries here only cover failed connection attempts
+            transport=httpx.AsyncHTTPTransport(retries=settings.UPSTREAM_RETRY_TOTAL),
+        )
+        _clients[loop] = client
+    return client
+
+
+def get_limiter():
+    """Return the concurrency limiter for the running event loop."""
+    loop = asyncio.get_running_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limiter = ConcurrencyLimiter(
+            max_in_flight=settings.ASYNC_PROXY_MAX_IN_FLIGHT,
+            max_queued=settings.ASYNC_PROXY_MAX_QUEUED,
+            queue_timeout=settings.ASYNC_PROXY_QUEUE_TIMEOUT,
+        )
+        _limiters[loop] = limiter
+    return limiter
@@ -0,0 +1,153 @@
+"""
+Circuit breaker for calls to the Cloud Function.
+
+Each worker process keeps one ``CircuitBreaker`` per function URL. It
+records the outcome of every image request's fallback chain over the last
+CIRCUIT_BREAKER_WINDOW seconds and opens when, after at least
+CIRCUIT_BREAKER_MIN_CALLS calls, too many of them failed or were slow.
+While open, image requests fail at once with a 503 instead of tying up a
+worker thread. After CIRCUIT_BREAKER_OPEN_SECONDS the circuit is half-open:
+a few probe calls go through, and their outcome closes the circuit again
+or reopens it.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_breakers = {}
+_breakers_pid = None
+_lock = threading.Lock()
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+    def __init__(self, retry_after):
+        super().__init__('The Cloud Function is unavailable, try again later')
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Error-rate and latency based breaker with half-open probing."""
+
+    def __init__(self, window, min_calls, error_rate, slow_call_duration, slow_call_rate,
+                 open_seconds, half_open_calls):
+        self._window = window
+        self._min_calls = min_calls
+        self._error_rate = error_rate
+        self._slow_call_duration = slow_call_duration
+        self._slow_call_rate = slow_call_rate
+        self._open_seconds = open_seconds
+        self._half_open_calls = half_open_calls
+        # (finished_at, ok, slow) for calls made while closed
+        self._calls = deque()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            self._update_state(time.monotonic())
+            return self._state
+
+    def _update_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self._open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+
+    def _open(self, now):
+        self._state = OPEN
+        self._opened_at = now
+        self._calls.clear()
+
+    def acquire(self):
+        """Admit one call or raise ``CircuitOpen``; every admitted call must be recorded."""
+        with self._lock:
+            now = time.monotonic()
+            self._update_state(now)
+            if self._state == OPEN:
+                raise CircuitOpen(math.ceil(self._open_seconds - (now - self._opened_at)))
+            if self._state == HALF_OPEN:
+                if self._probes >= self._half_open_calls:
+                    raise CircuitOpen(1)
+                self._probes += 1
+
+    def record(self, ok, duration):
+        """Record an admitted call that succeeded (``ok``) or failed after ``duration`` seconds."""
+        slow = duration >= self._slow_call_duration
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                if not ok or slow:
+                    self._open(now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self._half_open_calls:
+                    self._state = CLOSED
+                return
+            if self._state == OPEN:
+                # Admitted before the circuit opened
+                return
+            self._calls.append((now, ok, slow))
+            while self._calls and now - self._calls[0][0] > self._window:
+                self._calls.popleft()
+            total = len(self._calls)
+            if total < self._min_calls:
+                return
+            errors = sum(1 for _, call_ok, _ in self._calls if not call_ok)
+            slow_calls = sum(1 for _, _, call_slow in self._calls if call_slow)
+            if errors / total >= self._error_rate or slow_calls / total >= self._slow_call_rate:
+                print(f"Opening circuit: {errors}/{total} failed, {slow_calls}/{total} slow")
+                self._open(now)
+
+
+class DisabledBreaker:
+    """Stand-in used when CIRCUIT_BREAKER_ENABLED is off."""
+
+    state = CLOSED
+
+    def acquire(self):
+        pass
+
+    def record(self, ok, duration):
+        pass
+
+
+def get_breaker(function_url):
+    """Return this process's breaker for ``function_url``."""
+    global _breakers, _breakers_pid
+    pid = os.getpid()
+    breaker = _breakers.get(function_url) if _breakers_pid == pid else None
+    if breaker is None:
+        with _lock:
+            if _breakers_pid != pid:
+                _breakers = {}
+                _breakers_pid = pid
+            breaker = _breakers.get(function_url)
+            if breaker is None:
+                if settings.CIRCUIT_BREAKER_ENABLED:
+                    breaker = CircuitBreaker(
+                        window=settings.CIRCUIT_BREAKER_WINDOW,
+                        min_calls=settings.CIRCUIT_BREAKER_MIN_CALLS,
+                        error_rate=settings.CIRCUIT_BREAKER_ERROR_RATE,
+                        slow_call_duration=settings.CIRCUIT_BREAKER_SLOW_CALL_DURATION,
+                        slow_call_rate=settings.CIRCUIT_BREAKER_SLOW_CALL_RATE,
+                        open_seconds=settings.CIRCUIT_BREAKER_OPEN_SECONDS,
+                        half_open_calls=settings.CIRCUIT_BREAKER_HALF_OPEN_CALLS,
+                    )
+                else:
+                    breaker = DisabledBreaker()
+                _breakers[function_url] = breaker
+    return breaker
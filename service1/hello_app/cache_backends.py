@@ -0,0 +1,62 @@
+"""
+Cache backends used by hello_app.
+"""
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+
+# Byte accounting shared by every instance of a named cache, mirroring how
+# LocMemCache shares its store between instances
+_sizes = {}
+_totals = {}
+
+
+class ByteSizeLRUCache(LocMemCache):
+    """In-memory LRU cache bounded by the total size of its entries.
+
+    ``OPTIONS['MAX_BYTES']`` caps the pickled size of everything stored.
+    When an insert would exceed it, least recently used entries are evicted
+    first. Values larger than the whole budget are not stored at all.
+    """
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        options = params.get('OPTIONS', {})
+        self._max_bytes = int(options.get('MAX_BYTES', 64 * 1024 * 1024))
+        self._sizes = _sizes.setdefault(name, {})
+        self._total = _totals.setdefault(name, [0])
+
+    @property
+    def total_bytes(self):
+        return self._total[0]
+
+    def _set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        self._delete(key)
+        size = len(value)
+        if size > self._max_bytes:
+            return
+        while self._cache and self._total[0] + size > self._max_bytes:
+            # LocMemCache keeps the most recently used entries at the front
+            oldest = next(reversed(self._cache))
+            self._delete(oldest)
+        super()._set(key, value, timeout)
+        self._sizes[key] = size
+        self._total[0] += size
+
+    def _cull(self):
+        super()._cull()
+        for key in list(self._sizes):
+            if key not in self._cache:
+                self._total[0] -= self._sizes.pop(key)
+
+    def _delete(self, key):
+        deleted = super()._delete(key)
+        if key in self._sizes:
+            self._total[0] -= self._sizes.pop(key)
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._expire_info.clear()
+            self._sizes.clear()
+            self._total[0] = 0
@@ -0,0 +1,410 @@
+"""
+Asynchronous negative-image jobs.
+
+A job is accepted by writing the upload to JOB_STORAGE_DIR and recording it
+in a queue backend; a pool of worker threads claims queued jobs, calls the
+Cloud Function and writes the result next to the upload. Clients poll (or
+long-poll) the job's status and download the result once it is done.
+
+Two queue backends are provided:
+
+* ``InProcessQueue`` keeps jobs in memory. Status requests must reach the
+  process that accepted the job, and its jobs are lost when the process
+  exits, so it only suits a single worker that is never recycled.
+* ``SQLiteQueue`` keeps jobs in a SQLite file, so every worker process on
+  the same host can accept, run and report on any job. WAL mode relies on
+  shared memory between those processes, so the file must be on a local
+  disk: it does not work on a network volume shared between pods.
+
+Running ``SQLiteQueue`` jobs hold a lease that their worker renews every
+few seconds. A job whose lease ran out (its worker died or was recycled)
+is claimed again, up to JOB_MAX_ATTEMPTS times in all, and then failed.
+
+The caller's ID token is never written to a queue backend: it is kept in
+the memory of the process that accepted the job, until the job finishes
+or JOB_RESULT_TTL passes. A job run by another process calls the
+function without it, using the other auth strategies.
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED_STATUSES = (DONE, FAILED)
+
+# Reentrant because start_runner() creates the queue while holding it
+_lock = threading.RLock()
+_queue = None
+_queue_pid = None
+_runner = None
+_runner_pid = None
+# job id -> (caller's ID token, time it was stored)
+_tokens = {}
+_tokens_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    """Raised when JOB_QUEUE_MAX_PENDING jobs are already waiting."""
+
+
+class JobFailed(Exception):
+    """Raised by a job handler to fail a job with an HTTP status."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+
+def new_job(params, filename, content_type, id_token=None):
+    """Return the record for a freshly submitted job.
+
+    ``id_token`` stays in this process (see ``job_token``); it is not part
+    of the record.
+    """
+    now = time.time()
+    job_id = uuid.uuid4().hex
+    if id_token:
+        with _tokens_lock:
+            _tokens[job_id] = (id_token, now)
+    return {
+        'id': job_id,
+        'status': QUEUED,
+        'params': params,
+        'filename': filename,
+        'content_type': content_type,
+        'result_type': None,
+        'error': None,
+        'error_status': None,
+        'created': now,
+        'updated': now,
+    }
+
+
+def job_token(job_id):
+    """The ID token the job was submitted with, if this process accepted it."""
+    with _tokens_lock:
+        entry = _tokens.get(job_id)
+    return entry[0] if entry is not None else None
+
+
+def forget_token(job_id):
+    with _tokens_lock:
+        _tokens.pop(job_id, None)
+
+
+def input_path(job_id):
+    return os.path.join(settings.JOB_STORAGE_DIR, f'{job_id}.input')
+
+
+def result_path(job_id):
+    return os.path.join(settings.JOB_STORAGE_DIR, f'{job_id}.result')
+
+
+def remove_files(job_id):
+    for path in (input_path(job_id), result_path(job_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class InProcessQueue:
+    """Job queue held in this process's memory."""
+
+    # Jobs cannot outlive the process, so there is nothing to lease
+    lease_seconds = None
+
+    def __init__(self, max_pending):
+        self._max_pending = max_pending
+        self._jobs = {}
+        self._pending = queue.Queue()
+        self._changed = threading.Condition()
+
+    def submit(self, job):
+        with self._changed:
+            if self._pending.qsize() >= self._max_pending:
+                raise QueueFull(f'{self._max_pending} jobs are already queued')
+            self._jobs[job['id']] = dict(job)
+        self._pending.put(job['id'])
+
+    def claim(self, timeout):
+        try:
+            job_id = self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return self.update(job_id, status=RUNNING)
+
+    def renew(self, job_ids):
+        pass
+
+    def update(self, job_id, **changes):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(changes, updated=time.time())
+            self._changed.notify_all()
+            return dict(job)
+
+    def get(self, job_id):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def wait(self, job_id, timeout):
+        """Return the job once it has finished or ``timeout`` seconds have passed."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                job = self._jobs.get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job['status'] in FINISHED_STATUSES or remaining <= 0:
+                    return dict(job) if job is not None else None
+                self._changed.wait(remaining)
+
+    def purge(self, older_than):
+        """Forget finished jobs last updated before ``older_than``; return their ids."""
+        with self._changed:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job['status'] in FINISHED_STATUSES and job['updated'] < older_than]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return expired
+
+
+class SQLiteQueue:
+    """Job queue stored in a SQLite database shared by every local process."""
+
+    _COLUMNS = ('id', 'status', 'params', 'filename', 'content_type',
+                'result_type', 'error', 'error_status', 'created', 'updated')
+
+    def __init__(self, max_pending, path, poll_interval, lease_seconds, max_attempts):
+        self._max_pending = max_pending
+        self._path = path
+        self._poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, status TEXT NOT NULL, params TEXT NOT NULL, '
+                'filename TEXT, content_type TEXT, result_type TEXT, '
+                'error TEXT, error_status INTEGER, created REAL NOT NULL, updated REAL NOT NULL, '
+                'lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0)')
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(jobs)')}
+            if 'lease_until' not in columns:
+                # Databases created before leases; their running jobs get one lease from now
+                db.execute('ALTER TABLE jobs ADD COLUMN lease_until REAL')
+                db.execute('ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1')
+                db.execute('UPDATE jobs SET lease_until = ? WHERE status = ?',
+                           (time.time() + lease_seconds, RUNNING))
+            if 'id_token' in columns:
+                # Databases from before tokens were kept out of the queue
+                db.execute('UPDATE jobs SET id_token = NULL')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, created)')
+
+    def _connect(self):
+        # One connection per thread; SQLite connections are not thread-safe
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    def _record(self, row):
+        if row is None:
+            return None
+        job = {column: row[column] for column in self._COLUMNS}
+        job['params'] = json.loads(job['params'])
+        return job
+
+    def submit(self, job):
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            (pending,) = db.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', (QUEUED,)).fetchone()
+            if pending >= self._max_pending:
+                raise QueueFull(f'{self._max_pending} jobs are already queued')
+            values = dict(job, params=json.dumps(job['params']))
+            db.execute(
+                f'INSERT INTO jobs ({", ".join(self._COLUMNS)}) '
+                f'VALUES ({", ".join("?" * len(self._COLUMNS))})',
+                [values[column] for column in self._COLUMNS])
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def claim(self, timeout):
+        """Claim the oldest queued job, or a running one whose lease ran out."""
+        deadline = time.monotonic() + timeout
+        db = self._connect()
+        while True:
+            now = time.time()
+            # Jobs that keep losing their worker (e.g. one that runs it out of memory) are failed
+            db.execute(
+                'UPDATE jobs SET status = ?, error = ?, error_status = 500, updated = ? '
+                'WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                (FAILED, 'The job was interrupted too many times', now, RUNNING, now, self._max_attempts))
+            # The UPDATE takes the write lock, so each job is claimed once
+            # fetchall() steps the statement to the end, which releases the lock
+            rows = db.execute(
+                'UPDATE jobs SET status = ?, updated = ?, lease_until = ?, attempts = attempts + 1 '
+                'WHERE id = (SELECT id FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) '
+                'ORDER BY created LIMIT 1) RETURNING *',
+                (RUNNING, now, now + self.lease_seconds, QUEUED, RUNNING, now)).fetchall()
+            row = rows[0] if rows else None
+            if row is not None or time.monotonic() >= deadline:
+                return self._record(row)
+            time.sleep(self._poll_interval)
+
+    def renew(self, job_ids):
+        """Extend the leases of running jobs this process is still working on."""
+        if not job_ids:
+            return
+        self._connect().execute(
+            f'UPDATE jobs SET lease_until = ? WHERE status = ? AND id IN ({", ".join("?" * len(job_ids))})',
+            (time.time() + self.lease_seconds, RUNNING, *job_ids))
+
+    def update(self, job_id, **changes):
+        changes['updated'] = time.time()
+        assignments = ', '.join(f'{column} = ?' for column in changes)
+        rows = self._connect().execute(
+            f'UPDATE jobs SET {assignments} WHERE id = ? RETURNING *',
+            [*changes.values(), job_id]).fetchall()
+        return self._record(rows[0] if rows else None)
+
+    def get(self, job_id):
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._record(row)
+
+    def wait(self, job_id, timeout):
+        """Return the job once it has finished or ``timeout`` seconds have passed."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] in FINISHED_STATUSES or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(self._poll_interval, max(0, deadline - time.monotonic())))
+
+    def purge(self, older_than):
+        """Forget finished jobs last updated before ``older_than``; return their ids."""
+        rows = self._connect().execute(
+            'DELETE FROM jobs WHERE status IN (?, ?) AND updated < ? RETURNING id',
+            (*FINISHED_STATUSES, older_than)).fetchall()
+        return [row['id'] for row in rows]
+
+
+class JobRunner:
+    """Worker threads that claim jobs from ``job_queue`` and run ``handler``.
+
+    ``handler(job)`` returns the result's content type, having written the
+    result to ``result_path(job['id'])``, or raises JobFailed.
+    """
+
+    def __init__(self, job_queue, handler, workers):
+        self._queue = job_queue
+        self._handler = handler
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._work, name=f'job-worker-{n}', daemon=True)
+            for n in range(workers)
+        ]
+        if job_queue.lease_seconds:
+            self._threads.append(threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self._queue.lease_seconds / 3)
+            with self._running_lock:
+                job_ids = list(self._running)
+            try:
+                self._queue.renew(job_ids)
+            except Exception as e:
+                print(f"Job lease renewal failed: {str(e)}")
+
+    def _work(self):
+        while True:
+            try:
+                job = self._queue.claim(timeout=1)
+            except Exception as e:
+                print(f"Job queue error: {str(e)}")
+                time.sleep(1)
+                continue
+            if job is not None:
+                self._run(job)
+
+    def _run(self, job):
+        with self._running_lock:
+            self._running.add(job['id'])
+        try:
+            result_type = self._handler(job)
+        except JobFailed as e:
+            self._queue.update(job['id'], status=FAILED, error=str(e), error_status=e.status)
+        except Exception as e:
+            print(f"Job {job['id']} failed: {str(e)}")
+            self._queue.update(job['id'], status=FAILED, error=str(e), error_status=500)
+        else:
+            self._queue.update(job['id'], status=DONE, result_type=result_type)
+        finally:
+            with self._running_lock:
+                self._running.discard(job['id'])
+            forget_token(job['id'])
+            try:
+                os.remove(input_path(job['id']))
+            except FileNotFoundError:
+                pass
+
+
+def get_queue():
+    """Return the configured job queue for this process."""
+    global _queue, _queue_pid
+    pid = os.getpid()
+    if _queue is None or _queue_pid != pid:
+        with _lock:
+            if _queue is None or _queue_pid != pid:
+                os.makedirs(settings.JOB_STORAGE_DIR, exist_ok=True)
+                backend = settings.JOB_QUEUE_BACKENDS[settings.JOB_QUEUE_BACKEND]
+                _queue = import_string(backend['CLASS'])(
+                    max_pending=settings.JOB_QUEUE_MAX_PENDING, **backend.get('OPTIONS', {}))
+                _queue_pid = pid
+    return _queue
+
+
+def start_runner(handler):
+    """Start this process's job workers if they are not running yet."""
+    global _runner, _runner_pid
+    pid = os.getpid()
+    if _runner is None or _runner_pid != pid:
+        with _lock:
+            if _runner is None or _runner_pid != pid:
+                _runner = JobRunner(get_queue(), handler, settings.JOB_WORKERS)
+                _runner_pid = pid
+    return _runner
+
+
+def purge_expired():
+    """Drop finished jobs older than JOB_RESULT_TTL and delete their files."""
+    older_than = time.time() - settings.JOB_RESULT_TTL
+    for job_id in get_queue().purge(older_than):
+        remove_files(job_id)
+    # Tokens of jobs that another process ran
+    with _tokens_lock:
+        for job_id in [job_id for job_id, (_, stored) in _tokens.items() if stored < older_than]:
+            del _tokens[job_id]
@@ -0,0 +1,42 @@
+"""
+Prometheus metrics for service1's image proxy.
+
+The request timing middleware and the ``/metrics`` view are shared with
+service2 (``service_common.metrics``). The image proxy also records how
+long each auth strategy took to prepare, how long the Cloud Function took
+to answer, and why requests were shed.
+"""
+from prometheus_client import Counter, Histogram
+
+from service_common.metrics import LATENCY_BUCKETS, route_label
+
+# 16 KiB to 32 MiB
+SIZE_BUCKETS = tuple(16 * 1024 * 2 ** n for n in range(12))
+
+AUTH_DURATION = Histogram(
+    'upstream_auth_duration_seconds', 'Time spent verifying or minting tokens for an upstream call',
+    ['strategy'], buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_DURATION = Histogram(
+    'upstream_request_duration_seconds', 'Time until the Cloud Function returned its response headers',
+    ['strategy', 'outcome'], buckets=LATENCY_BUCKETS,
+)
+UPLOAD_BYTES = Histogram(
+    'image_upload_bytes', 'Size of uploaded images', ['route'], buckets=SIZE_BUCKETS,
+)
+COALESCED_REQUESTS = Counter(
+    'image_requests_coalesced_total', 'Image requests answered from an identical request already in flight',
+    ['scope'],
+)
+REJECTED_UPLOADS = Counter(
+    'image_uploads_rejected_total', 'Uploads rejected while the request body was being parsed',
+    ['reason'],
+)
+SHED_REQUESTS = Counter(
+    'image_requests_shed_total', 'Image requests turned away with a 503 before reaching the Cloud Function',
+    ['reason'],
+)
+
+
+def observe_upload(request, upload):
+    UPLOAD_BYTES.labels(route_label(request)).observe(upload.size)
@@ -0,0 +1,143 @@
+"""
+Content-addressed cache of negative-image results.
+
+Results are keyed by a SHA-256 hash of the transform parameters and the
+uploaded bytes, so identical uploads are served without calling the Cloud
+Function again. The same hash is used as the response's strong ETag.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# Request fields forwarded to the Cloud Function that change its output
+TRANSFORM_FIELDS = ('format', 'compress_level', 'quality', 'max_width', 'max_height', 'ops')
+
+# Content type of each output format the function can produce
+FORMAT_CONTENT_TYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+}
+
+
+def transform_fields(data):
+    """Return the transform fields the client set in ``data``."""
+    return {name: data[name] for name in TRANSFORM_FIELDS if data.get(name)}
+
+
+def negotiate_format(accept):
+    """Best IMAGE_NEGOTIATED_FORMATS entry named in an ``Accept`` header, or None.
+
+    Only media types the client names count, so ``*/*`` keeps the
+    function's default format.
+    """
+    quality = {}
+    for part in accept.split(','):
+        media_type, *params = [piece.strip() for piece in part.split(';')]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[media_type.lower()] = q
+    best, best_q = None, 0.0
+    for name in settings.IMAGE_NEGOTIATED_FORMATS:
+        q = quality.get(FORMAT_CONTENT_TYPES.get(name), 0.0)
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def request_fields(request):
+    """Transform fields for an image request, negotiating the format if it has none.
+
+    Returns ``(fields, negotiated)``. The negotiated format becomes part of
+    the fields, and so of the result key; responses should then carry
+    ``Vary: Accept``.
+    """
+    fields = transform_fields(request.POST)
+    if 'format' not in fields:
+        name = negotiate_format(request.headers.get('Accept', ''))
+        if name is not None:
+            fields['format'] = name
+            return fields, True
+    return fields, False
+
+
+def result_key(uploaded_file, params):
+    """Hash the transform parameters and the upload's bytes, chunk by chunk.
+
+    Args:
+        uploaded_file: Django ``UploadedFile`` holding the source image
+        params: Dictionary of parameters that affect the output
+
+    The file is rewound afterwards so it can still be sent upstream.
+    """
+    digest = hashlib.sha256()
+    canonical = '&'.join(f'{name}={params[name]}' for name in sorted(params))
+    digest.update(canonical.encode('utf-8') + b'\0')
+    uploaded_file.seek(0)
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+
+def etag_for(key):
+    return f'"{key}"'
+
+
+def etag_matches(request, etag):
+    """True if the request's If-None-Match header lists ``etag``."""
+    header = request.headers.get('If-None-Match', '')
+    if header.strip() == '*':
+        return True
+    return etag in (tag.strip() for tag in header.split(','))
+
+
+def get_result(key):
+    """Return the cached ``{'content', 'content_type'}`` for ``key``, or None."""
+    try:
+        return caches[settings.RESULT_CACHE_ALIAS].get(f'negative:{key}')
+    except Exception as e:
+        # A cache outage should cost a cache miss, not the request
+        print(f"Result cache lookup failed: {str(e)}")
+        return None
+
+
+def store_result(key, content, content_type):
+    caches[settings.RESULT_CACHE_ALIAS].set(
+        f'negative:{key}',
+        {'content': content, 'content_type': content_type},
+        settings.RESULT_CACHE_TIMEOUT,
+    )
+
+
+def caching_iterator(chunks, key, content_type):
+    """Pass ``chunks`` through, storing the result once fully streamed.
+
+    Results larger than RESULT_CACHE_MAX_ITEM_BYTES are streamed but not
+    cached, so the copy kept here never grows past that limit.
+    """
+    buffer = bytearray()
+    cacheable = True
+    for chunk in chunks:
+        if cacheable:
+            if len(buffer) + len(chunk) > settings.RESULT_CACHE_MAX_ITEM_BYTES:
+                cacheable = False
+                buffer = bytearray()
+            else:
+                buffer.extend(chunk)
+        yield chunk
+    if cacheable:
+        try:
+            store_result(key, bytes(buffer), content_type)
+        except Exception as e:
+            print(f"Result cache store failed: {str(e)}")
+
@@ -0,0 +1,332 @@
+"""
+Single-flight coalescing of identical image requests.
+
+Requests with the same result key (upload hash plus transform fields) that
+arrive while one of them is already calling the Cloud Function wait for
+that call instead of making their own. The first request, the leader,
+streams its response as usual and publishes the result once it has been
+sent; the others, the followers, then answer from it.
+
+Within a process followers wait on the leader's ``Flight``. With
+SINGLE_FLIGHT_SHARED the leader also takes a lock in the result cache
+(``cache.add``), and leaders on other pods wait for the result to appear in
+the shared result cache instead; this needs a shared backend such as
+RESULT_CACHE_BACKEND=redis.
+
+A follower whose leader failed or took longer than SINGLE_FLIGHT_TIMEOUT
+calls the function itself.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+from .results import get_result, store_result
+
+_group = None
+_group_pid = None
+_lock = threading.Lock()
+
+
+class Flight:
+    """One in-flight upstream call that other requests can wait for."""
+
+    def __init__(self):
+        self.result = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def finish(self, result):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.result = result
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def wait(self, timeout):
+        """Block until the flight finishes; returns its result, or None."""
+        self._done.wait(timeout)
+        return self.result
+
+    async def await_result(self, timeout):
+        """Async counterpart of ``wait`` that does not hold a thread."""
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(wake)
+            else:
+                finished.set_result(None)
+        try:
+            await asyncio.wait_for(finished, timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.result
+
+
+class FlightGroup:
+    """Thread-safe map of ``key -> Flight`` for the calls in progress in this process."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Return ``(flight, leader)``; ``leader`` is True if the caller must make the call."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def leave(self, key, flight, result):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(result)
+
+
+def get_group():
+    global _group, _group_pid
+    pid = os.getpid()
+    if _group is None or _group_pid != pid:
+        with _lock:
+            if _group is None or _group_pid != pid:
+                _group = FlightGroup()
+                _group_pid = pid
+    return _group
+
+
+class Ticket:
+    """A request's place in a flight.
+
+    A leader must ``publish`` exactly once, with the result or None if the
+    call failed. A follower reads ``result``; None means it should call the
+    function itself.
+    """
+
+    def __init__(self, key, flight=None, leader=False, shared=False, result=None):
+        self.key = key
+        self.leader = leader
+        self.result = result
+        self._flight = flight
+        self._shared = shared
+
+    def publish(self, result):
+        if not self.leader or self._flight is None:
+            return
+        flight, self._flight = self._flight, None
+        get_group().leave(self.key, flight, result)
+        if self._shared:
+            release_shared(self.key)
+
+
+def _lock_key(key):
+    return f'singleflight:{key}'
+
+
+def acquire_shared(key):
+    """Take the cross-pod lock for ``key``; True if this pod should call the function."""
+    try:
+        return caches[settings.RESULT_CACHE_ALIAS].add(_lock_key(key), os.getpid(), settings.SINGLE_FLIGHT_TIMEOUT)
+    except Exception as e:
+        # Without the lock store every pod calls the function itself
+        print(f"Single-flight lock failed: {str(e)}")
+        return True
+
+
+def release_shared(key):
+    try:
+        caches[settings.RESULT_CACHE_ALIAS].delete(_lock_key(key))
+    except Exception as e:
+        print(f"Single-flight unlock failed: {str(e)}")
+
+
+def _shared_lock_held(key):
+    try:
+        return caches[settings.RESULT_CACHE_ALIAS].get(_lock_key(key)) is not None
+    except Exception:
+        return False
+
+
+def wait_shared(key):
+    """Poll the result cache until another pod's leader stores ``key``'s result."""
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        result = get_result(key)
+        if result is not None or not _shared_lock_held(key):
+            return result
+    return None
+
+
+async def await_shared(key):
+    """Async counterpart of ``wait_shared``."""
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        result = await sync_to_async(get_result, thread_sensitive=False)(key)
+        if result is not None:
+            return result
+        if not await sync_to_async(_shared_lock_held, thread_sensitive=False)(key):
+            return None
+    return None
+
+
+def join(key):
+    """Join the flight for ``key`` and, as a follower, wait for its result."""
+    if not settings.SINGLE_FLIGHT_ENABLED:
+        return Ticket(key)
+    flight, leader = get_group().join(key)
+    if not leader:
+        result = flight.wait(settings.SINGLE_FLIGHT_TIMEOUT)
+        if result is not None:
+            metrics.COALESCED_REQUESTS.labels('local').inc()
+        return Ticket(key, result=result)
+    if settings.SINGLE_FLIGHT_SHARED and not acquire_shared(key):
+        result = wait_shared(key)
+        if result is not None:
+            metrics.COALESCED_REQUESTS.labels('shared').inc()
+            # Requests waiting on this pod get the other pod's result too
+            get_group().leave(key, flight, result)
+            return Ticket(key, result=result)
+        return Ticket(key, flight, leader=True)
+    return Ticket(key, flight, leader=True, shared=settings.SINGLE_FLIGHT_SHARED)
+
+
+async def ajoin(key):
+    """Async counterpart of ``join``."""
+    if not settings.SINGLE_FLIGHT_ENABLED:
+        return Ticket(key)
+    flight, leader = get_group().join(key)
+    if not leader:
+        result = await flight.await_result(settings.SINGLE_FLIGHT_TIMEOUT)
+        if result is not None:
+            metrics.COALESCED_REQUESTS.labels('local').inc()
+        return Ticket(key, result=result)
+    if settings.SINGLE_FLIGHT_SHARED and not await sync_to_async(acquire_shared, thread_sensitive=False)(key):
+        result = await await_shared(key)
+        if result is not None:
+            metrics.COALESCED_REQUESTS.labels('shared').inc()
+            get_group().leave(key, flight, result)
+            return Ticket(key, result=result)
+        return Ticket(key, flight, leader=True)
+    return Ticket(key, flight, leader=True, shared=settings.SINGLE_FLIGHT_SHARED)
+
+
+class _ResultBuffer:
+    """Keeps one copy of a streamed result for the result cache and a ticket.
+
+    The copy is stored under the ticket's key if it fits in
+    RESULT_CACHE_MAX_ITEM_BYTES and published to the ticket if it fits in
+    SINGLE_FLIGHT_MAX_BYTES. Larger results, and responses closed before
+    the end, are not stored and publish None.
+    """
+
+    def __init__(self, ticket, content_type):
+        self._ticket = ticket
+        self._content_type = content_type
+        self._buffer = bytearray()
+        self._limit = max(settings.RESULT_CACHE_MAX_ITEM_BYTES,
+                          settings.SINGLE_FLIGHT_MAX_BYTES if ticket.leader else 0)
+        self._content = None
+
+    def _keep(self, chunk):
+        if self._buffer is not None:
+            if len(self._buffer) + len(chunk) > self._limit:
+                self._buffer = None
+            else:
+                self._buffer.extend(chunk)
+        return chunk
+
+    def _finish(self):
+        """Take the complete result out of the buffer; returns it if it should be stored."""
+        if self._buffer is not None:
+            self._content, self._buffer = bytes(self._buffer), None
+        if self._content is not None and len(self._content) <= settings.RESULT_CACHE_MAX_ITEM_BYTES:
+            return self._content
+        return None
+
+    def _store(self, content):
+        try:
+            store_result(self._ticket.key, content, self._content_type)
+        except Exception as e:
+            print(f"Result cache store failed: {str(e)}")
+
+    def _publish(self):
+        content = self._content
+        if content is not None and len(content) > settings.SINGLE_FLIGHT_MAX_BYTES:
+            content = None
+        self._ticket.publish(None if content is None else {'content': content, 'content_type': self._content_type})
+
+
+class SharingIterator(_ResultBuffer):
+    """Streamed response body that caches and publishes the complete result."""
+
+    def __init__(self, chunks, ticket, content_type):
+        super().__init__(ticket, content_type)
+        self._chunks = iter(chunks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            content = self._finish()
+            if content is not None:
+                self._store(content)
+            raise
+        return self._keep(chunk)
+
+    def close(self):
+        try:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+        finally:
+            self._publish()
+
+
+class AsyncSharingIterator(_ResultBuffer):
+    """``SharingIterator`` for the async generators of the ASGI proxy.
+
+    It must not be iterable synchronously, or Django would stream it as a
+    sync iterator.
+    """
+
+    def __init__(self, chunks, ticket, content_type):
+        super().__init__(ticket, content_type)
+        self._chunks = chunks.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            content = self._finish()
+            if content is not None:
+                await sync_to_async(self._store, thread_sensitive=False)(content)
+            # Publish now; the response is only closed after the last chunk is sent
+            self._publish()
+            raise
+        return self._keep(chunk)
+
+    def close(self):
+        self._publish()
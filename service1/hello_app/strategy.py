@@ -0,0 +1,226 @@
+"""
+Upstream strategy engine for calls to the Cloud Function.
+
+Three pieces decide how an image request reaches the function:
+
+``AuthMemory``
+    Remembers, per audience (function URL), the auth strategy that last got
+    an answer, so the next request tries it first instead of walking the
+    whole fallback chain again.
+``Deadline``
+    Stops the chain from starting attempts after UPSTREAM_TOTAL_TIMEOUT and
+    caps each attempt's socket read timeout at UPSTREAM_ATTEMPT_TIMEOUT and
+    the time left, so a slow failure no longer costs a full read timeout
+    per strategy. The read timeout bounds each wait for data, not the
+    attempt as a whole.
+``hedged`` / ``ahedged``
+    If an attempt has not answered after UPSTREAM_HEDGE_AFTER seconds,
+    send the same request again and use whichever answers first.
+"""
+import asyncio
+import concurrent.futures
+import os
+import threading
+import time
+
+from django.conf import settings
+
+_memory = None
+_memory_pid = None
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+class AuthMemory:
+    """Thread-safe map of ``audience -> (strategy, remembered_at)`` with a TTL."""
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, audience):
+        with self._lock:
+            entry = self._entries.get(audience)
+            if entry is None:
+                return None
+            strategy, remembered_at = entry
+            if time.monotonic() - remembered_at > self._ttl:
+                del self._entries[audience]
+                return None
+            return strategy
+
+    def remember(self, audience, strategy):
+        with self._lock:
+            self._entries[audience] = (strategy, time.monotonic())
+
+    def forget(self, audience, strategy):
+        with self._lock:
+            entry = self._entries.get(audience)
+            if entry is not None and entry[0] == strategy:
+                del self._entries[audience]
+
+
+def get_memory():
+    global _memory, _memory_pid
+    pid = os.getpid()
+    if _memory is None or _memory_pid != pid:
+        with _lock:
+            if _memory is None or _memory_pid != pid:
+                _memory = AuthMemory(settings.UPSTREAM_AUTH_MEMORY_TTL)
+                _memory_pid = pid
+    return _memory
+
+
+def attempt_order(audience):
+    """Auth strategies to try for ``audience``, the last one that worked first."""
+    order = list(settings.UPSTREAM_AUTH_ORDER)
+    if settings.UPSTREAM_REMEMBER_AUTH:
+        remembered = get_memory().get(audience)
+        if remembered in order:
+            order.remove(remembered)
+            order.insert(0, remembered)
+    return order
+
+
+def remember(audience, strategy):
+    if settings.UPSTREAM_REMEMBER_AUTH:
+        get_memory().remember(audience, strategy)
+
+
+def forget(audience, strategy):
+    if settings.UPSTREAM_REMEMBER_AUTH:
+        get_memory().forget(audience, strategy)
+
+
+class Deadline:
+    """Time budget for one request's whole fallback chain.
+
+    The budget is checked before each attempt. An attempt that is already
+    running is only bounded by its socket timeouts, so an upstream that
+    keeps sending data can take it past the deadline.
+    """
+
+    def __init__(self, total=None):
+        self._expires = time.monotonic() + (total if total is not None else settings.UPSTREAM_TOTAL_TIMEOUT)
+
+    def remaining(self):
+        return max(0.0, self._expires - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def socket_timeouts(self):
+        """``(connect, read)`` socket timeouts for the next attempt.
+
+        ``read`` limits each wait for the upstream to send data (headers or
+        the next body chunk), not the total time of the attempt.
+        """
+        read = min(settings.UPSTREAM_ATTEMPT_TIMEOUT, self.remaining())
+        return min(settings.UPSTREAM_CONNECT_TIMEOUT, read), read
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=settings.UPSTREAM_HEDGE_WORKERS, thread_name_prefix='upstream-hedge')
+                _executor_pid = pid
+    return _executor
+
+
+def _usable(response):
+    return response.status_code < 500
+
+
+def _close_when_done(future):
+    """Close a losing request's response once it arrives."""
+    def close(done):
+        if not done.cancelled() and done.exception() is None:
+            done.result().close()
+    future.add_done_callback(close)
+
+
+def hedged(call, hedge_after=None):
+    """Return ``call()``'s response, racing a second call if the first is slow.
+
+    ``call`` must be safe to run twice at once. The first response below
+    500 wins; the other is closed when it arrives. Without ``hedge_after``
+    (the default UPSTREAM_HEDGE_AFTER of 0) ``call`` runs on this thread.
+    """
+    hedge_after = settings.UPSTREAM_HEDGE_AFTER if hedge_after is None else hedge_after
+    if not hedge_after:
+        return call()
+    executor = _get_executor()
+    first = executor.submit(call)
+    try:
+        return first.result(timeout=hedge_after)
+    except concurrent.futures.TimeoutError:
+        pass
+    pending = {first, executor.submit(call)}
+    fallback, error = None, None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = error or future.exception()
+                continue
+            response = future.result()
+            if _usable(response):
+                for other in pending:
+                    _close_when_done(other)
+                if fallback is not None:
+                    fallback.close()
+                return response
+            if fallback is None:
+                fallback = response
+            else:
+                response.close()
+    if fallback is not None:
+        return fallback
+    raise error
+
+
+async def _aclose_when_done(task):
+    try:
+        response = await task
+    except Exception:
+        return
+    await response.aclose()
+
+
+async def ahedged(call, hedge_after=None):
+    """Async counterpart of ``hedged``; ``call`` returns a coroutine."""
+    hedge_after = settings.UPSTREAM_HEDGE_AFTER if hedge_after is None else hedge_after
+    if not hedge_after:
+        return await call()
+    first = asyncio.ensure_future(call())
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done:
+        return first.result()
+    pending = {first, asyncio.ensure_future(call())}
+    fallback, error = None, None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                error = error or task.exception()
+                continue
+            response = task.result()
+            if _usable(response):
+                for other in pending:
+                    asyncio.ensure_future(_aclose_when_done(other))
+                if fallback is not None:
+                    await fallback.aclose()
+                return response
+            if fallback is None:
+                fallback = response
+            else:
+                await response.aclose()
+    if fallback is not None:
+        return fallback
+    raise error
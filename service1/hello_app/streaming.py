@@ -0,0 +1,180 @@
+"""
+Chunked pass-through helpers for the image proxy.
+
+``MultipartFileStream`` encodes uploaded files as a multipart/form-data body
+without ever holding a whole file in memory, and ``iter_upstream`` (or
+``aiter_upstream`` for the ASGI proxy) hands the Cloud Function's response
+to Django one chunk at a time.
+"""
+import io
+import threading
+import uuid
+import weakref
+
+from asgiref.sync import sync_to_async
+
+# One lock per uploaded file: streams built from the same upload (e.g. a
+# hedged request and its original) seek and read it from different threads
+_read_locks = weakref.WeakKeyDictionary()
+_read_locks_lock = threading.Lock()
+
+
+def _read_lock(uploaded_file):
+    with _read_locks_lock:
+        lock = _read_locks.get(uploaded_file)
+        if lock is None:
+            lock = _read_locks[uploaded_file] = threading.Lock()
+        return lock
+
+
+def _quote(value):
+    return str(value).replace('\r', '').replace('\n', '').replace('"', '%22')
+
+
+class MultipartFileStream(io.RawIOBase):
+    """Read-only, seekable multipart/form-data body backed by uploaded files.
+
+    Args:
+        files: List of ``(field_name, uploaded_file)`` pairs
+        fields: Optional dictionary of plain form fields
+        boundary: Optional boundary string, generated if not provided
+
+    The total length is known up front, so ``requests`` sends a
+    Content-Length header and urllib3 can rewind the body on retry. Every
+    stream keeps its own offset into the uploads, so a fresh stream can be
+    built for each attempt without re-reading the file into memory, and
+    several streams over the same upload may be read at once.
+    """
+
+    def __init__(self, files, fields=None, boundary=None):
+        super().__init__()
+        self.boundary = boundary or uuid.uuid4().hex
+        self._segments = []
+        self._locks = {}
+        for name, value in (fields or {}).items():
+            self._segments.append((
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{_quote(name)}"\r\n\r\n'
+                f'{value}\r\n'
+            ).encode('utf-8'))
+        for name, uploaded_file in files:
+            content_type = uploaded_file.content_type or 'application/octet-stream'
+            self._segments.append((
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{_quote(name)}"; '
+                f'filename="{_quote(uploaded_file.name)}"\r\n'
+                f'Content-Type: {content_type}\r\n\r\n'
+            ).encode('utf-8'))
+            self._segments.append(uploaded_file)
+            self._locks[id(uploaded_file)] = _read_lock(uploaded_file)
+            self._segments.append(b'\r\n')
+        self._segments.append(f'--{self.boundary}--\r\n'.encode('utf-8'))
+        self._length = sum(self._segment_size(segment) for segment in self._segments)
+        self._pos = 0
+
+    @staticmethod
+    def _segment_size(segment):
+        return len(segment) if isinstance(segment, bytes) else segment.size
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    @property
+    def on_disk(self):
+        """True if any upload was spooled to a temporary file, so reads may block."""
+        return any(hasattr(segment, 'temporary_file_path') for segment in self._segments)
+
+    def __len__(self):
+        return self._length
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._length + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        self._pos = max(0, min(pos, self._length))
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._pos
+        chunks = []
+        start = 0
+        for segment in self._segments:
+            segment_size = self._segment_size(segment)
+            end = start + segment_size
+            if size > 0 and self._pos < end:
+                offset = self._pos - start
+                count = min(size, segment_size - offset)
+                if isinstance(segment, bytes):
+                    chunk = segment[offset:offset + count]
+                else:
+                    with self._locks[id(segment)]:
+                        segment.seek(offset)
+                        chunk = segment.read(count)
+                chunks.append(chunk)
+                self._pos += len(chunk)
+                size -= len(chunk)
+                if len(chunk) < count:
+                    # The upload is shorter than its declared size
+                    break
+            start = end
+        return b''.join(chunks)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def iter_upstream(response, chunk_size):
+    """Yield the body of a streamed ``requests`` response and release it."""
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+    finally:
+        response.close()
+
+
+async def aiter_stream(stream, chunk_size):
+    """Yield a file-like request body in chunks for an async HTTP client.
+
+    Bodies that may be read from disk are read in a worker thread, so the
+    event loop never waits on file I/O; in-memory ones are read inline.
+    """
+    read = sync_to_async(stream.read, thread_sensitive=False) if getattr(stream, 'on_disk', True) else None
+    while True:
+        chunk = await read(chunk_size) if read is not None else stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def aiter_upstream(response, chunk_size, on_close=None):
+    """Yield the body of a streamed ``httpx`` response and release it.
+
+    ``on_close`` is called once the response has been closed, whether the
+    body was fully sent or the client went away.
+    """
+    try:
+        async for chunk in response.aiter_bytes(chunk_size):
+            yield chunk
+    finally:
+        await response.aclose()
+        if on_close is not None:
+            on_close()
@@ -1,3 +1,422 @@
-from django.test import TestCase
+import asyncio
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import threading
+import zlib
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from rest_framework.renderers import BrowsableAPIRenderer
+
+from . import breaker, jobs, singleflight, strategy
+from .admission import AdmissionMiddleware
+from .cache_backends import ByteSizeLRUCache
+from .results import caching_iterator, etag_for, negotiate_format, result_key, store_result
+from .views import HelloWorldView
+
+JSON_ONLY = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+    'DEFAULT_PERMISSION_CLASSES': [],
+    'UNAUTHENTICATED_USER': None,
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+}
+
+
+def png(width=4, height=4):
+    """The signature and IHDR chunk of a PNG, which is all the proxy reads."""
+    ihdr = b'IHDR' + struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + ihdr + struct.pack('>I', zlib.crc32(ihdr))
+
+
+class HelloFastPathTests(SimpleTestCase):
+    def test_json(self):
+        response = self.client.get('/api/hello/', {'input': 'Ada'}, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'message': 'Hello World, Ada'})
+
+    @skipUnless(BrowsableAPIRenderer in HelloWorldView.renderer_classes, 'this settings profile only renders JSON')
+    def test_html_gets_browsable_api(self):
+        response = self.client.get('/api/hello/', HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/html'))
+
+    @override_settings(REST_FRAMEWORK=JSON_ONLY)
+    def test_html_without_browsable_api_gets_json(self):
+        # The settings_api profile only renders JSON
+        for accept in ('text/html', '*/*'):
+            with self.subTest(accept=accept):
+                response = self.client.get('/api/hello/', {'input': 'Ada'}, HTTP_ACCEPT=accept)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json(), {'message': 'Hello World, Ada'})
+
+
+class FormatNegotiationTests(SimpleTestCase):
+    def test_browser_accept_picks_a_format_the_function_can_encode(self):
+        accept = 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8'
+        self.assertEqual(negotiate_format(accept), 'webp')
+        self.assertIsNone(negotiate_format('*/*'))
+
+
+class BatchProxyTests(SimpleTestCase):
+    @mock.patch('hello_app.views.send_with_fallbacks', return_value=None)
+    def test_one_file_batch_is_marked(self, send):
+        upload = SimpleUploadedFile('a.png', b'\x89PNG\r\n\x1a\n', content_type='image/png')
+        self.client.post('/api/negative-image/batch/', {'file': upload})
+        files, _, fields = send.call_args.args
+        self.assertEqual(len(files), 1)
+        self.assertEqual(fields['batch'], '1')
+
+
+class JobTokenTests(SimpleTestCase):
+    def test_id_token_stays_out_of_the_queue(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jobs.sqlite3')
+            job_queue = jobs.SQLiteQueue(10, path, poll_interval=0.01, lease_seconds=30, max_attempts=3)
+            job = jobs.new_job({}, 'a.png', 'image/png', 'secret-token')
+            job_queue.submit(job)
+            self.addCleanup(jobs.forget_token, job['id'])
+
+            self.assertEqual(jobs.job_token(job['id']), 'secret-token')
+            with sqlite3.connect(path) as db:
+                rows = db.execute('SELECT * FROM jobs').fetchall()
+            self.assertEqual(len(rows), 1)
+            self.assertNotIn('secret-token', [str(value) for value in rows[0]])
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('hello_app.breaker.time')
+        self.clock = patcher.start().monotonic
+        self.clock.return_value = 1000.0
+        self.addCleanup(patcher.stop)
+        self.breaker = breaker.CircuitBreaker(
+            window=30, min_calls=4, error_rate=0.5, slow_call_duration=10, slow_call_rate=0.8,
+            open_seconds=30, half_open_calls=2)
+
+    def call(self, ok, duration=0.1):
+        self.breaker.acquire()
+        self.breaker.record(ok, duration)
+
+    def trip(self):
+        for ok in (True, True, False, False):
+            self.call(ok)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_stays_closed_below_min_calls(self):
+        for _ in range(3):
+            self.call(False)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+
+    def test_stays_closed_below_error_rate(self):
+        for ok in (True, True, True, False):
+            self.call(ok)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+
+    def test_opens_at_error_rate(self):
+        self.trip()
+        self.clock.return_value += 10
+        with self.assertRaises(breaker.CircuitOpen) as raised:
+            self.breaker.acquire()
+        self.assertEqual(raised.exception.retry_after, 20)
+
+    def test_opens_on_slow_calls(self):
+        for _ in range(4):
+            self.call(True, duration=10)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_half_open_probes_that_succeed_close_the_circuit(self):
+        self.trip()
+        self.clock.return_value += 30
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.breaker.acquire()
+        self.breaker.acquire()
+        # Only CIRCUIT_BREAKER_HALF_OPEN_CALLS probes at a time
+        with self.assertRaises(breaker.CircuitOpen):
+            self.breaker.acquire()
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.breaker.acquire()
+
+    def test_half_open_probe_that_fails_reopens_the_circuit(self):
+        self.trip()
+        self.clock.return_value += 30
+        self.breaker.acquire()
+        self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        with self.assertRaises(breaker.CircuitOpen) as raised:
+            self.breaker.acquire()
+        self.assertEqual(raised.exception.retry_after, 30)
+
+    def test_open_circuit_answers_503_with_retry_after(self):
+        self.trip()
+        with mock.patch('hello_app.views.breaker.get_breaker', return_value=self.breaker), \
+                mock.patch('hello_app.views.call_function') as call_function:
+            response = self.client.post('/api/negative-image/', {
+                'file': SimpleUploadedFile('a.png', png(), content_type='image/png'),
+            })
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '30')
+        call_function.assert_not_called()
+
+
+@override_settings(ADMISSION_ENABLED=True, ADMISSION_MAX_IN_FLIGHT=2, ADMISSION_QUEUE_TIMEOUT=0)
+class AdmissionTests(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = AdmissionMiddleware(
+            lambda request: StreamingHttpResponse(iter([b'negative'])))
+
+    def image_request(self):
+        return self.factory.post('/api/negative-image/')
+
+    def test_sheds_once_max_in_flight_is_reached(self):
+        held = [self.middleware(self.image_request()) for _ in range(2)]
+        self.assertTrue(all(response.status_code == 200 for response in held))
+
+        shed = self.middleware(self.image_request())
+        self.assertEqual(shed.status_code, 503)
+        self.assertEqual(shed['Retry-After'], '1')
+
+        # A slot frees up once a streamed response has been sent
+        held[0].close()
+        self.assertEqual(self.middleware(self.image_request()).status_code, 200)
+
+    def test_job_status_polls_are_admitted(self):
+        for _ in range(2):
+            self.middleware(self.image_request())
+        shed = self.middleware(self.factory.get('/api/jobs/0123abcd/', {'wait': '5'}))
+        self.assertEqual(shed.status_code, 503)
+
+    def test_other_routes_are_not_counted(self):
+        middleware = AdmissionMiddleware(lambda request: HttpResponse('hello'))
+        middleware.slots = mock.Mock(**{'acquire.return_value': False})
+        self.assertEqual(middleware(self.factory.get('/api/hello/')).status_code, 200)
+        middleware.slots.acquire.assert_not_called()
+
+
+@override_settings(SINGLE_FLIGHT_ENABLED=True, SINGLE_FLIGHT_SHARED=False, SINGLE_FLIGHT_TIMEOUT=5,
+                   SINGLE_FLIGHT_MAX_BYTES=16, RESULT_CACHE_MAX_ITEM_BYTES=16)
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('hello_app.singleflight.store_result')
+        self.store_result = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.key = f'test-{self.id()}'
+
+    def lead(self):
+        ticket = singleflight.join(self.key)
+        self.assertTrue(ticket.leader)
+        # Joining the same key now makes a follower
+        flight, leader = singleflight.get_group().join(self.key)
+        self.assertFalse(leader)
+        return ticket, flight
+
+    def test_followers_get_the_leaders_result(self):
+        ticket = singleflight.join(self.key)
+        self.assertTrue(ticket.leader)
+
+        waiting = threading.Event()
+        wait = singleflight.Flight.wait
+
+        def follower_wait(flight, timeout):
+            waiting.set()
+            return wait(flight, timeout)
+
+        followers = []
+        with mock.patch.object(singleflight.Flight, 'wait', follower_wait):
+            thread = threading.Thread(target=lambda: followers.append(singleflight.join(self.key)))
+            thread.start()
+            waiting.wait(5)
+            body = singleflight.SharingIterator([b'nega', b'tive'], ticket, 'image/png')
+            self.assertEqual(b''.join(body), b'negative')
+            body.close()
+            thread.join(5)
+
+        follower, = followers
+        self.assertFalse(follower.leader)
+        self.assertEqual(follower.result, {'content': b'negative', 'content_type': 'image/png'})
+        self.store_result.assert_called_once_with(self.key, b'negative', 'image/png')
+        # The flight is over, so the next request leads a new one
+        self.assertTrue(singleflight.join(self.key).leader)
+
+    def test_failed_leader_publishes_none(self):
+        ticket, flight = self.lead()
+        ticket.publish(None)
+        self.assertIsNone(flight.wait(0))
+
+    def test_leader_closed_before_the_end_publishes_none(self):
+        ticket, flight = self.lead()
+        body = singleflight.SharingIterator(iter([b'nega', b'tive']), ticket, 'image/png')
+        next(body)
+        body.close()
+        self.assertIsNone(flight.wait(0))
+        self.store_result.assert_not_called()
+
+    def test_result_over_max_bytes_is_not_shared(self):
+        ticket, flight = self.lead()
+        body = singleflight.SharingIterator([b'x' * 10, b'x' * 10], ticket, 'image/png')
+        self.assertEqual(len(b''.join(body)), 20)
+        body.close()
+        self.assertIsNone(flight.wait(0))
+        self.store_result.assert_not_called()
+
+    def test_async_iterator_publishes_once_exhausted(self):
+        ticket, flight = self.lead()
+
+        async def chunks():
+            yield b'nega'
+            yield b'tive'
+
+        async def consume():
+            return b''.join([chunk async for chunk in
+                             singleflight.AsyncSharingIterator(chunks(), ticket, 'image/png')])
+
+        self.assertEqual(asyncio.run(consume()), b'negative')
+        # Published without waiting for close()
+        self.assertEqual(flight.wait(0), {'content': b'negative', 'content_type': 'image/png'})
+        self.store_result.assert_called_once_with(self.key, b'negative', 'image/png')
+
+
+class ByteSizeLRUCacheTests(SimpleTestCase):
+    value = b'x' * 100
+
+    def make_cache(self, max_bytes):
+        cache = ByteSizeLRUCache(f'test-{self.id()}', {'OPTIONS': {'MAX_BYTES': max_bytes}})
+        self.addCleanup(cache.clear)
+        return cache
+
+    def test_evicts_least_recently_used_to_stay_within_budget(self):
+        size = len(pickle.dumps(self.value, pickle.HIGHEST_PROTOCOL))
+        cache = self.make_cache(2 * size + 10)
+        cache.set('a', self.value)
+        cache.set('b', self.value)
+        self.assertEqual(cache.total_bytes, 2 * size)
+        cache.get('a')
+        cache.set('c', self.value)
+        self.assertEqual(cache.get('a'), self.value)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), self.value)
+        self.assertEqual(cache.total_bytes, 2 * size)
+
+    def test_value_over_the_budget_is_not_stored(self):
+        cache = self.make_cache(50)
+        cache.set('a', self.value)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_replacing_and_deleting_keep_the_total(self):
+        cache = self.make_cache(1024)
+        cache.set('a', self.value)
+        cache.set('a', self.value)
+        size = cache.total_bytes
+        self.assertEqual(size, len(pickle.dumps(self.value, pickle.HIGHEST_PROTOCOL)))
+        cache.delete('a')
+        self.assertEqual(cache.total_bytes, 0)
+
+    @override_settings(RESULT_CACHE_MAX_ITEM_BYTES=8)
+    def test_results_over_the_item_cap_are_streamed_but_not_stored(self):
+        with mock.patch('hello_app.results.store_result') as store:
+            self.assertEqual(b''.join(caching_iterator([b'x' * 5, b'x' * 5], 'key', 'image/png')), b'x' * 10)
+            store.assert_not_called()
+            self.assertEqual(b''.join(caching_iterator([b'x' * 4, b'x' * 4], 'key', 'image/png')), b'x' * 8)
+            store.assert_called_once_with('key', b'x' * 8, 'image/png')
+
+
+class ResultCacheResponseTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(caches['results'].clear)
+        patcher = mock.patch('hello_app.views.send_with_fallbacks')
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, fields=None, **headers):
+        upload = SimpleUploadedFile('a.png', png(), content_type='image/png')
+        return self.client.post('/api/negative-image/', {'file': upload, **(fields or {})}, **headers)
+
+    def key(self, **fields):
+        return result_key(SimpleUploadedFile('a.png', png()), {'op': 'negative', **fields})
+
+    def test_if_none_match_gets_304(self):
+        key = self.key(format='png')
+        response = self.post({'format': 'png'}, HTTP_IF_NONE_MATCH=etag_for(key))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag_for(key))
+        self.send.assert_not_called()
+
+    def test_negotiated_304_varies_on_accept(self):
+        key = self.key(format='webp')
+        response = self.post(HTTP_ACCEPT='image/webp', HTTP_IF_NONE_MATCH=etag_for(key))
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('Accept', response['Vary'])
+
+    def test_negotiated_cache_hit_varies_on_accept(self):
+        store_result(self.key(format='webp'), b'negative', 'image/webp')
+        response = self.post(HTTP_ACCEPT='image/webp')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('Accept', response['Vary'])
+        self.send.assert_not_called()
+
+
+class ImageUploadHandlerTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('hello_app.views.send_with_fallbacks', return_value=None)
+        self.send = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, content, path='/api/negative-image/'):
+        upload = SimpleUploadedFile('upload', content, content_type='application/octet-stream')
+        return self.client.post(path, {'file': upload, 'format': 'png'})
+
+    def test_image_within_limits_is_forwarded(self):
+        self.post(png(100, 100))
+        self.send.assert_called_once()
+
+    @override_settings(UPLOAD_MAX_BYTES=1024)
+    def test_body_over_max_bytes_gets_413(self):
+        response = self.post(png() + b'\0' * 2048)
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('1024 bytes', response.json()['error'])
+        self.send.assert_not_called()
+
+    def test_unknown_magic_bytes_get_415(self):
+        response = self.post(b'%PDF-1.7 not an image at all')
+        self.assertEqual(response.status_code, 415)
+        self.send.assert_not_called()
+
+    @override_settings(UPLOAD_ALLOWED_FORMATS=['jpeg'])
+    def test_format_outside_allowed_formats_gets_415(self):
+        self.assertEqual(self.post(png()).status_code, 415)
+
+    @override_settings(UPLOAD_MAX_PIXELS=10_000)
+    def test_image_over_max_pixels_gets_413(self):
+        response = self.post(png(101, 100))
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('10100 pixels', response.json()['error'])
+        self.send.assert_not_called()
+
+    def test_batch_parts_are_not_sniffed(self):
+        self.post(b'not an image', path='/api/negative-image/batch/')
+        self.send.assert_called_once()
+
+
+@override_settings(UPSTREAM_CONNECT_TIMEOUT=3, UPSTREAM_ATTEMPT_TIMEOUT=30)
+class DeadlineTests(SimpleTestCase):
+    def test_socket_timeouts_never_exceed_the_time_left(self):
+        with mock.patch('hello_app.strategy.time') as clock:
+            clock.monotonic.return_value = 100.0
+            deadline = strategy.Deadline(total=60)
+            self.assertEqual(deadline.socket_timeouts(), (3, 30))
+            clock.monotonic.return_value = 158.0
+            self.assertEqual(deadline.socket_timeouts(), (2, 2))
+            clock.monotonic.return_value = 160.0
+            self.assertTrue(deadline.expired())
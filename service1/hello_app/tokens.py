@@ -0,0 +1,124 @@
+"""
+Cached service-account ID tokens for calling the Cloud Function.
+
+The credentials file is read once per process. Each audience keeps its own
+ID token, which a background timer refreshes shortly before it expires, so
+requests normally never wait on token minting.
+"""
+import datetime
+import json
+import os
+import threading
+
+from django.conf import settings
+
+from .upstream import get_session
+
+_lock = threading.Lock()
+_provider = None
+_provider_key = None
+
+# Tokens closer than this to expiry are refreshed before being handed out
+_MIN_VALIDITY_SECONDS = 30
+
+
+def _utcnow():
+    # google-auth reports token expiry as a naive UTC datetime
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class _AudienceToken:
+    """ID token for one audience, refreshed at most once at a time."""
+
+    def __init__(self, credentials, refresh_margin, retry_delay):
+        self._credentials = credentials
+        self._refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self._retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def _seconds_left(self):
+        expiry = self._credentials.expiry
+        if not self._credentials.token or expiry is None:
+            return 0
+        return (expiry - _utcnow()).total_seconds()
+
+    def _refresh(self):
+        # Imported lazily so google-auth is only loaded when a service
+        # account is actually in use
+        from google.auth.transport.requests import Request as GoogleAuthRequest
+
+        self._credentials.refresh(GoogleAuthRequest(session=get_session()))
+        self._schedule(self._seconds_left() - self._refresh_margin.total_seconds())
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 1), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception as e:
+                print(f"Background service account token refresh failed: {str(e)}")
+                if self._seconds_left() > self._retry_delay:
+                    self._schedule(self._retry_delay)
+
+    def get(self):
+        if self._seconds_left() > _MIN_VALIDITY_SECONDS:
+            return self._credentials.token
+        # Only one thread mints a token; the others wait and reuse it
+        with self._lock:
+            if self._seconds_left() <= _MIN_VALIDITY_SECONDS:
+                self._refresh()
+            return self._credentials.token
+
+
+class ServiceAccountTokenProvider:
+    """Hands out cached ID tokens minted from a service-account key file."""
+
+    def __init__(self, credentials_path, refresh_margin, retry_delay):
+        with open(credentials_path, 'r') as f:
+            self._info = json.load(f)
+        self._refresh_margin = refresh_margin
+        self._retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._tokens = {}
+
+    @property
+    def is_web_client(self):
+        return 'web' in self._info
+
+    def get_token(self, audience):
+        """Return a valid ID token for ``audience``, minting it if needed."""
+        token = self._tokens.get(audience)
+        if token is None:
+            with self._lock:
+                token = self._tokens.get(audience)
+                if token is None:
+                    from google.oauth2 import service_account
+
+                    credentials = service_account.IDTokenCredentials.from_service_account_info(
+                        self._info, target_audience=audience)
+                    token = _AudienceToken(credentials, self._refresh_margin, self._retry_delay)
+                    self._tokens[audience] = token
+        return token.get()
+
+
+def get_token_provider(credentials_path):
+    """Return the token provider for this process and credentials file."""
+    global _provider, _provider_key
+    key = (os.getpid(), credentials_path)
+    if _provider is None or _provider_key != key:
+        with _lock:
+            if _provider is None or _provider_key != key:
+                _provider = ServiceAccountTokenProvider(
+                    credentials_path,
+                    refresh_margin=settings.SERVICE_ACCOUNT_TOKEN_REFRESH_MARGIN,
+                    retry_delay=settings.SERVICE_ACCOUNT_TOKEN_RETRY_DELAY,
+                )
+                _provider_key = key
+    return _provider
@@ -0,0 +1,190 @@
+"""
+Distributed tracing with W3C trace context.
+
+``TracingMiddleware`` continues the trace named in the incoming
+``traceparent`` header (nginx adds one if the browser did not) and opens a
+server span for the request. The image proxy adds a span for each auth
+attempt and each call to the Cloud Function, and forwards ``traceparent``
+so the function's spans join the same trace.
+
+TRACING_EXPORTER picks an entry from TRACING_EXPORTERS. With "none" no
+spans are recorded, but the incoming ``traceparent`` is still passed on to
+the function unchanged.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.module_loading import import_string
+from opentelemetry import context, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+
+SERVER = trace.SpanKind.SERVER
+CLIENT = trace.SpanKind.CLIENT
+INTERNAL = trace.SpanKind.INTERNAL
+
+_propagator = TraceContextTextMapPropagator()
+
+_tracer = None
+_tracer_pid = None
+_lock = threading.Lock()
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """Appends one JSON object per finished span to a local file.
+
+    A stand-in for a collector when running locally; every process may
+    share the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def export(self, spans):
+        lines = []
+        for span in spans:
+            lines.append(json.dumps({
+                'trace_id': f'{span.context.trace_id:032x}',
+                'span_id': f'{span.context.span_id:016x}',
+                'parent_span_id': f'{span.parent.span_id:016x}' if span.parent else None,
+                'name': span.name,
+                'kind': span.kind.name,
+                'service': span.resource.attributes.get('service.name'),
+                'start_ns': span.start_time,
+                'duration_ms': round((span.end_time - span.start_time) / 1e6, 3),
+                'status': span.status.status_code.name,
+                'attributes': dict(span.attributes),
+            }))
+        try:
+            with self._lock, open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+        except OSError as e:
+            print(f"Span export failed: {str(e)}")
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def get_tracer():
+    """This process's tracer, or None if tracing is off."""
+    global _tracer, _tracer_pid
+    pid = os.getpid()
+    if _tracer_pid != pid:
+        with _lock:
+            if _tracer_pid != pid:
+                backend = settings.TRACING_EXPORTERS[settings.TRACING_EXPORTER]
+                if backend is None:
+                    _tracer = None
+                else:
+                    # A provider per process, so the export thread is never inherited from the master
+                    provider = TracerProvider(
+                        resource=Resource.create({'service.name': settings.TRACING_SERVICE_NAME}))
+                    exporter = import_string(backend['CLASS'])(**backend.get('OPTIONS', {}))
+                    provider.add_span_processor(BatchSpanProcessor(exporter))
+                    _tracer = provider.get_tracer('hello_app')
+                _tracer_pid = pid
+    return _tracer
+
+
+@contextmanager
+def span(name, kind=INTERNAL, attributes=None):
+    """Run the block in a child span of the current one.
+
+    Yields the span, or None if tracing is off.
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        yield None
+        return
+    with tracer.start_as_current_span(name, kind=kind, attributes=attributes) as current:
+        yield current
+
+
+@contextmanager
+def continued(carrier):
+    """Make the trace context in ``carrier`` (a header dict) current for the block."""
+    token = context.attach(_propagator.extract(carrier))
+    try:
+        yield
+    finally:
+        context.detach(token)
+
+
+def carrier():
+    """Headers that continue the current trace, e.g. ``{'traceparent': ...}``."""
+    headers = {}
+    _propagator.inject(headers)
+    return headers
+
+
+@contextmanager
+def upstream_span(strategy, attempt):
+    """Client span around one call to the Cloud Function."""
+    with span('POST negative-image-function', CLIENT,
+              {'auth.strategy': strategy, 'upstream.attempt': attempt}) as current:
+        yield current
+
+
+def record_status(current, status_code):
+    if current is None:
+        return
+    current.set_attribute('http.status_code', status_code)
+    if status_code >= 500:
+        current.set_status(trace.Status(trace.StatusCode.ERROR))
+
+
+def record_error(current, error):
+    if current is None:
+        return
+    current.record_exception(error)
+    current.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else request.path_info.lstrip('/')
+
+
+class TracingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with continued(request.headers), span(request.method, SERVER) as current:
+            response = self.get_response(request)
+            record_server_span(current, request, response)
+            return response
+
+    async def __acall__(self, request):
+        # The context is attached in this task; sync views run by sync_to_async inherit it
+        with continued(request.headers), span(request.method, SERVER) as current:
+            response = await self.get_response(request)
+            record_server_span(current, request, response)
+            return response
+
+
+def record_server_span(current, request, response):
+    if current is None:
+        return
+    # The route is only known once the URL has been resolved
+    current.update_name(f'{request.method} {route_name(request)}')
+    current.set_attribute('http.method', request.method)
+    current.set_attribute('http.route', route_name(request))
+    record_status(current, response.status_code)
@@ -0,0 +1,217 @@
+"""
+Upload limits for the image routes.
+
+``ImageUploadHandler`` runs ahead of Django's memory and temporary-file
+upload handlers and rejects an upload as soon as it can tell it is
+unacceptable:
+
+- a request body over UPLOAD_MAX_BYTES, going by Content-Length, before any
+  of it is read (413);
+- a ``file`` part whose first bytes match none of UPLOAD_ALLOWED_FORMATS
+  (415);
+- a ``file`` part whose header declares more than UPLOAD_MAX_PIXELS pixels
+  (413).
+
+Parts of batch requests are not sniffed; the function reports bad items in
+the batch manifest.
+
+Parts that pass are handed on unchanged: Django keeps them in memory up to
+FILE_UPLOAD_MAX_MEMORY_SIZE and spools larger ones to a temporary file.
+``UploadLimitMiddleware`` turns a rejection into a JSON error response.
+Formats whose size is not found in the first UPLOAD_SNIFF_BYTES (TIFF,
+AVIF) are left for the Cloud Function to check.
+"""
+import struct
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+from django.http import JsonResponse
+
+from . import metrics
+
+# Multipart fields that must hold an image; batch archives are checked by the function
+IMAGE_FIELDS = ('file',)
+# Batches report a bad item in their manifest instead of failing as a whole
+UNSNIFFED_ROUTES = ('batch_negative_image_proxy',)
+# Most headers fit in the first chunk; JPEGs with large EXIF blocks may not
+UPLOAD_SNIFF_BYTES = 64 * 1024
+
+
+class UploadRejected(Exception):
+    """Raised while parsing a request whose upload must not be accepted."""
+
+    def __init__(self, message, status, reason):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+def check_body_size(content_length):
+    if content_length and content_length > settings.UPLOAD_MAX_BYTES:
+        raise UploadRejected(
+            f'Request body is larger than {settings.UPLOAD_MAX_BYTES} bytes', 413, 'body_size')
+
+
+def detect_format(header):
+    """Image format named by the magic bytes at the start of ``header``, or None."""
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    if header[:2] == b'BM':
+        return 'bmp'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    if header[4:8] == b'ftyp' and header[8:12] in (b'avif', b'avis'):
+        return 'avif'
+    return None
+
+
+def _jpeg_size(header):
+    pos = 2
+    while pos + 9 <= len(header):
+        if header[pos] != 0xFF:
+            return None
+        marker = header[pos + 1]
+        if marker == 0xFF:
+            # Fill byte before the marker
+            pos += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', header[pos + 5:pos + 9])
+            return width, height
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Markers without a length
+            pos += 2
+            continue
+        pos += 2 + struct.unpack('>H', header[pos + 2:pos + 4])[0]
+    return None
+
+
+def _webp_size(header):
+    chunk = header[12:16]
+    if chunk == b'VP8 ' and len(header) >= 30:
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(header) >= 25:
+        bits = int.from_bytes(header[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(header) >= 30:
+        return int.from_bytes(header[24:27], 'little') + 1, int.from_bytes(header[27:30], 'little') + 1
+    return None
+
+
+def image_size(image_format, header):
+    """``(width, height)`` declared in ``header``, or None if it is not there (yet)."""
+    if image_format == 'png' and header[12:16] == b'IHDR' and len(header) >= 24:
+        return struct.unpack('>II', header[16:24])
+    if image_format == 'gif' and len(header) >= 10:
+        return struct.unpack('<HH', header[6:10])
+    if image_format == 'bmp' and len(header) >= 26:
+        if struct.unpack('<I', header[14:18])[0] == 12:
+            return struct.unpack('<HH', header[18:22])
+        width, height = struct.unpack('<ii', header[18:26])
+        return abs(width), abs(height)
+    if image_format == 'jpeg':
+        return _jpeg_size(header)
+    if image_format == 'webp':
+        return _webp_size(header)
+    return None
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """Sniffs image parts as they arrive and passes every chunk on unchanged.
+
+    Must come first in FILE_UPLOAD_HANDLERS so nothing is stored for a
+    rejected upload.
+    """
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        check_body_size(content_length)
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        match = getattr(self.request, 'resolver_match', None)
+        sniffed = field_name in IMAGE_FIELDS and getattr(match, 'url_name', None) not in UNSNIFFED_ROUTES
+        self.header = bytearray() if sniffed else None
+        self.format = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.header is not None:
+            self.header += raw_data[:UPLOAD_SNIFF_BYTES - len(self.header)]
+            self._sniff(complete=False)
+        return raw_data
+
+    def file_complete(self, file_size):
+        if self.header is not None:
+            self._sniff(complete=True)
+        # The next handler builds the uploaded file
+        return None
+
+    def _sniff(self, complete):
+        if self.format is None:
+            if len(self.header) < 12 and not complete:
+                return
+            self.format = detect_format(self.header)
+            if self.format not in settings.UPLOAD_ALLOWED_FORMATS:
+                self.header = None
+                raise UploadRejected(
+                    f"Unsupported image format, expected one of {', '.join(settings.UPLOAD_ALLOWED_FORMATS)}",
+                    415, 'unsupported_format')
+        size = image_size(self.format, self.header)
+        if size is None:
+            if complete or len(self.header) >= UPLOAD_SNIFF_BYTES:
+                # Size unknown; the Cloud Function checks it
+                self.header = None
+            return
+        self.header = None
+        pixels = size[0] * size[1]
+        if pixels > settings.UPLOAD_MAX_PIXELS:
+            raise UploadRejected(
+                f'Image has {pixels} pixels, the limit is {settings.UPLOAD_MAX_PIXELS}', 413, 'pixels')
+
+
+class UploadLimitMiddleware:
+    """Rejects oversized bodies up front and turns ``UploadRejected`` into an error response."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.reject_oversized(request)
+        return response if response is not None else self.get_response(request)
+
+    async def __acall__(self, request):
+        response = self.reject_oversized(request)
+        return response if response is not None else await self.get_response(request)
+
+    def reject_oversized(self, request):
+        if request.method != 'POST':
+            return None
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        try:
+            check_body_size(content_length)
+        except UploadRejected as e:
+            return self.process_exception(request, e)
+        return None
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, UploadRejected):
+            return None
+        metrics.REJECTED_UPLOADS.labels(exception.reason).inc()
+        return JsonResponse({'error': str(exception)}, status=exception.status)
@@ -0,0 +1,121 @@
+"""
+Process-wide HTTP client for calls from service1 to the Cloud Function.
+
+Every gunicorn worker gets one ``requests.Session`` backed by a bounded
+keep-alive connection pool, so repeated image requests reuse the same
+TCP/TLS connections instead of opening a new one per call.
+"""
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+class UpstreamSession(requests.Session):
+    """Session that applies default timeouts and counts upstream calls."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+        self._stats_lock = threading.Lock()
+        self.requests_total = 0
+        self.errors_total = 0
+        self.in_flight = 0
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._stats_lock:
+            self.requests_total += 1
+            self.in_flight += 1
+        try:
+            return super().request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._stats_lock:
+                self.errors_total += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self.in_flight -= 1
+
+
+def _build_session():
+    retry = Retry(
+        total=settings.UPSTREAM_RETRY_TOTAL,
+        connect=settings.UPSTREAM_RETRY_TOTAL,
+        read=0,
+        status=settings.UPSTREAM_RETRY_TOTAL,
+        backoff_factor=settings.UPSTREAM_RETRY_BACKOFF,
+        status_forcelist=(502, 503, 504),
+        # The image function is idempotent, so POSTs are safe to retry
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.UPSTREAM_POOL_CONNECTIONS,
+        pool_maxsize=settings.UPSTREAM_POOL_MAXSIZE,
+        pool_block=True,
+        max_retries=retry,
+    )
+    session = UpstreamSession(
+        timeout=(settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """Return the session for this process, creating it on first use.
+
+    The session is keyed on the process id so that workers forked from a
+    preloaded gunicorn master never share sockets with their parent.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def pool_stats():
+    """Return request counters and per-host connection pool metrics."""
+    session = get_session()
+    pools = []
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            # The pool queue is pre-filled with None placeholders, so only
+            # real connection objects count as idle
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+            pools.append({
+                'scheme': pool.scheme,
+                'host': pool.host,
+                'port': pool.port,
+                'maxsize': pool.pool.maxsize if pool.pool else 0,
+                'idle_connections': idle,
+                'connections_opened': pool.num_connections,
+                'requests_sent': pool.num_requests,
+            })
+    return {
+        'pid': os.getpid(),
+        'requests_total': session.requests_total,
+        'errors_total': session.errors_total,
+        'in_flight': session.in_flight,
+        'pools': pools,
+    }
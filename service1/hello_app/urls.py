@@ -1,7 +1,16 @@
 from django.urls import path
-from .views import HelloWorldView, health_check, NegativeImageProxyView
+from .views import (
+    AsyncNegativeImageProxyView, BatchNegativeImageProxyView, HelloWorldView, health_check, JobResultView,
+    JobStatusView, NegativeImageJobView, NegativeImageProxyView, upstream_stats,
+)
 
 urlpatterns = [
     path('hello/', HelloWorldView.as_view(), name='hello_world'),
     path('negative-image/', NegativeImageProxyView.as_view(), name='negative_image_proxy'),
+    path('negative-image/batch/', BatchNegativeImageProxyView.as_view(), name='batch_negative_image_proxy'),
+    path('negative-image/async/', AsyncNegativeImageProxyView.as_view(), name='async_negative_image_proxy'),
+    path('jobs/negative-image/', NegativeImageJobView.as_view(), name='negative_image_job'),
+    path('jobs/<str:job_id>/', JobStatusView.as_view(), name='job_status'),
+    path('jobs/<str:job_id>/result/', JobResultView.as_view(), name='job_result'),
+    path('upstream/stats/', upstream_stats, name='upstream_stats'),
 ]
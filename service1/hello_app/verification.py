@@ -0,0 +1,153 @@
+"""
+Cached verification of the Google ID tokens sent by the frontend.
+
+Google's signing certificates are kept for as long as their Cache-Control
+headers allow, and tokens that already passed verification are remembered
+(keyed by their SHA-256 hash) until they expire, so an upload with a known
+token needs no network round-trip and no signature check.
+"""
+import base64
+import email.utils
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .upstream import get_session
+
+_lock = threading.Lock()
+_verifier = None
+
+_MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+
+def _cache_ttl(headers, default_ttl):
+    """Seconds a certificate response may be cached, from its HTTP headers."""
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+    match = _MAX_AGE_RE.search(cache_control)
+    if match:
+        age = int(headers.get('Age', '0') or 0)
+        return max(int(match.group(1)) - age, 0)
+    expires = headers.get('Expires')
+    if expires:
+        try:
+            return max(email.utils.parsedate_to_datetime(expires).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            pass
+    return default_ttl
+
+
+def _key_id(token):
+    """Return the unverified ``kid`` from a JWT header, or None."""
+    try:
+        header = token.split('.', 1)[0]
+        header += '=' * (-len(header) % 4)
+        return json.loads(base64.urlsafe_b64decode(header)).get('kid')
+    except (ValueError, AttributeError):
+        return None
+
+
+class CertificateCache:
+    """Google's public signing certificates, refetched only when stale."""
+
+    def __init__(self, url, default_ttl, min_refetch_interval):
+        self.url = url
+        self._default_ttl = default_ttl
+        self._min_refetch_interval = min_refetch_interval
+        self._lock = threading.Lock()
+        self._certs = None
+        self._expires_at = 0
+        self._fetched_at = 0
+
+    def _fetch(self):
+        response = get_session().get(self.url)
+        if response.status_code != 200:
+            raise ValueError(f'Could not fetch certificates at {self.url}: HTTP {response.status_code}')
+        self._certs = response.json()
+        self._fetched_at = time.monotonic()
+        self._expires_at = self._fetched_at + _cache_ttl(response.headers, self._default_ttl)
+
+    def get(self, key_id=None):
+        """Return the certificates, refetching if stale or ``key_id`` is unknown.
+
+        An unknown key id usually means Google rotated its keys, but it can
+        also be a forged token, so such refetches are rate limited.
+        """
+        now = time.monotonic()
+        certs = self._certs
+        stale = certs is None or now >= self._expires_at
+        unknown_key = (
+            certs is not None and key_id is not None and key_id not in certs
+            and now - self._fetched_at >= self._min_refetch_interval
+        )
+        if stale or unknown_key:
+            with self._lock:
+                if self._certs is certs:
+                    self._fetch()
+                certs = self._certs
+        return certs
+
+
+class IdTokenVerifier:
+    """Verifies ID tokens and caches the results until each token expires."""
+
+    def __init__(self, certificates, audience, max_entries, clock_skew):
+        self._certificates = certificates
+        self._audience = audience
+        self._max_entries = max_entries
+        self._clock_skew = clock_skew
+        self._lock = threading.Lock()
+        self._verified = OrderedDict()
+
+    def verify(self, id_token):
+        """Return the token's claims, raising ValueError if it is invalid."""
+        key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+        now = time.time()
+        with self._lock:
+            entry = self._verified.get(key)
+            if entry is not None:
+                if entry['exp'] > now:
+                    self._verified.move_to_end(key)
+                    return dict(entry)
+                del self._verified[key]
+
+        from google.auth import jwt
+
+        idinfo = jwt.decode(
+            id_token,
+            certs=self._certificates.get(_key_id(id_token)),
+            audience=self._audience,
+            clock_skew_in_seconds=self._clock_skew,
+        )
+        with self._lock:
+            self._verified[key] = idinfo
+            self._verified.move_to_end(key)
+            while len(self._verified) > self._max_entries:
+                self._verified.popitem(last=False)
+        return dict(idinfo)
+
+
+def get_verifier():
+    """Return the process-wide ID token verifier."""
+    global _verifier
+    if _verifier is None:
+        with _lock:
+            if _verifier is None:
+                certificates = CertificateCache(
+                    settings.GOOGLE_OAUTH2_CERTS_URL,
+                    default_ttl=settings.ID_TOKEN_CERTS_DEFAULT_TTL,
+                    min_refetch_interval=settings.ID_TOKEN_CERTS_MIN_REFETCH_INTERVAL,
+                )
+                _verifier = IdTokenVerifier(
+                    certificates,
+                    audience=settings.GOOGLE_OAUTH_CLIENT_ID,
+                    max_entries=settings.ID_TOKEN_CACHE_MAX_ENTRIES,
+                    clock_skew=settings.ID_TOKEN_CLOCK_SKEW,
+                )
+    return _verifier
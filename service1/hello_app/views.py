@@ -1,25 +1,39 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
 from django.shortcuts import render
+from rest_framework.negotiation import DefaultContentNegotiation
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-import requests
+from django.views import View
 import os
-import json
+import time
 import traceback
-from google.auth.transport.requests import Request as GoogleAuthRequest
-from google.oauth2 import service_account
-from google.oauth2 import id_token as google_id_token
-from google.auth.transport import requests as google_requests
+from . import breaker, jobs, metrics, singleflight, strategy as upstream_strategy, tracing
+from .admission import service_unavailable
+from .async_upstream import Overloaded, get_async_client, get_limiter
+from .results import (
+    caching_iterator, etag_for, etag_matches, get_result, request_fields, result_key,
+    transform_fields,
+)
+from .streaming import MultipartFileStream, aiter_stream, aiter_upstream, iter_upstream
 
 # Create your views here.
 
+def hello_message(input_text):
+    return f'Hello World, {input_text}'
+
 class HelloWorldView(APIView):
     def get(self, request):
         input_text = request.query_params.get('input', 'Stranger')
         return Response({
-            'message': f'Hello World, {input_text}'
+            'message': hello_message(input_text)
         })
 
 def health_check(request):
@@ -29,126 +43,628 @@ def health_check(request):
 def hello_view(request):
     return JsonResponse({"message": "Hello from Service 1!"})
 
+def upstream_stats(request):
+    """Connection pool metrics for this worker's Cloud Function client."""
+    from .upstream import pool_stats
+
+    return JsonResponse(pool_stats())
+
+# Function responses that reject the request itself; another auth attempt
+# would fail the same way, so these are relayed to the client as-is
+CLIENT_ERROR_STATUSES = (400, 413, 415)
+
+# Download name extension for each content type the function can return
+RESULT_EXTENSIONS = {'image/png': 'png', 'image/webp': 'webp', 'image/jpeg': 'jpg', 'image/avif': 'avif'}
+
+def attachment_header(content_type):
+    extension = RESULT_EXTENSIONS.get(content_type.split(';')[0].strip(), 'png')
+    return f'attachment; filename="negative.{extension}"'
+
+def call_function(function_url, files, headers=None, fields=None, timeout=None):
+    """POST the uploads to the Cloud Function as a streamed multipart body.
+
+    ``files`` is a list of ``(field_name, uploaded_file)`` pairs.
+    ``timeout`` overrides the session's ``(connect, read)`` timeouts.
+    """
+    # requests is imported on the first upstream call, not at startup
+    from .upstream import get_session
+
+    body = MultipartFileStream(files, fields)
+    headers = {**(headers or {}), 'Content-Type': body.content_type}
+    kwargs = {'timeout': timeout} if timeout is not None else {}
+    return get_session().post(function_url, data=body, headers=headers, stream=True, **kwargs)
+
+def answered(response):
+    """True if the function accepted or rejected the request itself.
+
+    Another auth attempt would get the same answer, so the chain stops.
+    """
+    return response.status_code == 200 or response.status_code in CLIENT_ERROR_STATUSES
+
+def send_with_fallbacks(files, id_token, fields):
+    """Call the function with each auth attempt in turn.
+
+    Attempts follow ``upstream_strategy.attempt_order`` and share one
+    deadline. Returns the first response that is a success or a client
+    error, or None if every attempt failed or the deadline passed. Raises
+    ``breaker.CircuitOpen`` without calling the function while its circuit
+    is open.
+    """
+    function_url = settings.NEGATIVE_IMAGE_FUNCTION_URL
+    circuit = breaker.get_breaker(function_url)
+    circuit.acquire()
+    started = time.perf_counter()
+    response = None
+    try:
+        response = try_auth_attempts(function_url, files, id_token, fields)
+    finally:
+        circuit.record(response is not None, time.perf_counter() - started)
+    return response
+
+def try_auth_attempts(function_url, files, id_token, fields):
+    """The fallback chain behind ``send_with_fallbacks``."""
+    deadline = upstream_strategy.Deadline()
+    for attempt, (strategy, label, headers) in enumerate(auth_attempts(function_url, id_token), 1):
+        if deadline.expired():
+            print("Upstream deadline passed, giving up")
+            break
+        timeout = deadline.socket_timeouts()
+        headers = {**headers, **tracing.carrier()}
+        started = time.perf_counter()
+        with tracing.upstream_span(strategy, attempt) as span:
+            try:
+                response = upstream_strategy.hedged(
+                    lambda: call_function(function_url, files, headers, fields, timeout))
+            except Exception as call_error:
+                tracing.record_error(span, call_error)
+                metrics.UPSTREAM_DURATION.labels(strategy, 'exception').observe(time.perf_counter() - started)
+                upstream_strategy.forget(function_url, strategy)
+                print(f"{label} error: {str(call_error)}")
+                continue
+            tracing.record_status(span, response.status_code)
+        metrics.UPSTREAM_DURATION.labels(strategy, response.status_code).observe(time.perf_counter() - started)
+        
+        if answered(response):
+            upstream_strategy.remember(function_url, strategy)
+            return response
+        upstream_strategy.forget(function_url, strategy)
+        print(f"{label} failed with status {response.status_code}")
+        response.close()
+    return None
+
+def relayed_error(upstream):
+    """Pass a client error from the function on to the client."""
+    error = JsonResponse({'error': upstream.text}, status=upstream.status_code)
+    upstream.close()
+    return error
+
+def image_response(upstream, cache_key, ticket):
+    """Stream a successful Cloud Function response back to the client.
+
+    The result is kept as it streams past, then stored in the result cache
+    and handed to the requests waiting on ``ticket`` from the same copy.
+    """
+    content_type = upstream.headers.get('Content-Type', 'image/png')
+    chunks = iter_upstream(upstream, settings.UPSTREAM_STREAM_CHUNK_SIZE)
+    django_response = StreamingHttpResponse(
+        singleflight.SharingIterator(chunks, ticket, content_type), content_type=content_type)
+    if 'Content-Length' in upstream.headers and 'Content-Encoding' not in upstream.headers:
+        django_response['Content-Length'] = upstream.headers['Content-Length']
+    django_response['Content-Disposition'] = attachment_header(content_type)
+    django_response['ETag'] = etag_for(cache_key)
+    django_response['X-Cache'] = 'MISS'
+    return django_response
+
+def cached_image_response(cached, cache_key):
+    """Serve a result straight from the result cache."""
+    django_response = HttpResponse(cached['content'], content_type=cached['content_type'])
+    django_response['Content-Disposition'] = attachment_header(cached['content_type'])
+    django_response['ETag'] = etag_for(cache_key)
+    django_response['X-Cache'] = 'HIT'
+    return django_response
+
+def coalesced_response(result, cache_key):
+    """Serve the result of an identical request that was already in flight."""
+    django_response = cached_image_response(result, cache_key)
+    django_response['X-Cache'] = 'COALESCED'
+    return django_response
+
+def user_token_headers(id_token):
+    """Verify the user's ID token and return headers that forward it, or None."""
+    from .verification import get_verifier
+
+    try:
+        # Signing certs and verified tokens are cached between requests
+        idinfo = get_verifier().verify(id_token)
+    except ValueError as e:
+        # Invalid token
+        print(f"Token verification error: {str(e)}")
+        return None
+    
+    # Check if the token is valid
+    if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
+        print("Invalid token issuer")
+        return None
+    
+    # Log the authenticated user
+    print(f"Authenticated user: {idinfo['email']}")
+    return {'Authorization': f'Bearer {id_token}'}
+
+def service_account_headers(function_url):
+    """Return headers carrying a service-account ID token, or None."""
+    credentials_path = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+    if not credentials_path or not os.path.exists(credentials_path):
+        print("No service account credentials found")
+        return None
+    
+    from .tokens import get_token_provider
+
+    # Credentials are loaded once per process and tokens are cached
+    token_provider = get_token_provider(credentials_path)
+    
+    # Check if it's a web client or service account
+    if token_provider.is_web_client:
+        print("Found web client credentials, not service account")
+        return None
+    return {'Authorization': f'Bearer {token_provider.get_token(function_url)}'}
+
+def direct_headers(function_url, id_token):
+    return {}
+
+def user_headers(function_url, id_token):
+    # Only try with the user's ID token if provided
+    if not id_token:
+        return None
+    return user_token_headers(id_token)
+
+def service_account_call_headers(function_url, id_token):
+    return service_account_headers(function_url)
+
+# Auth strategy -> (log label, function returning its headers or None)
+AUTH_STRATEGIES = {
+    'direct': ('Direct call', direct_headers),
+    'user_token': ('User token call', user_headers),
+    'service_account': ('Service account call', service_account_call_headers),
+}
+
+def auth_attempts(function_url, id_token):
+    """Yield ``(strategy, label, headers)`` for each way of calling the function.
+
+    The order comes from ``upstream_strategy.attempt_order``: the strategy
+    that last worked for this function first, then UPSTREAM_AUTH_ORDER
+    (by default the unauthenticated call, as the function is public). Tokens
+    are only verified or minted once the attempts before them have failed.
+    """
+    for strategy in upstream_strategy.attempt_order(function_url):
+        label, build_headers = AUTH_STRATEGIES[strategy]
+        started = time.perf_counter()
+        with tracing.span('upstream auth', attributes={'auth.strategy': strategy}):
+            try:
+                headers = build_headers(function_url, id_token)
+            except Exception as auth_error:
+                print(f"{label} auth error: {str(auth_error)}")
+                headers = None
+        metrics.AUTH_DURATION.labels(strategy).observe(time.perf_counter() - started)
+        if headers is None:
+            continue
+        print(f"Calling Cloud Function: {label}...")
+        yield strategy, label, headers
+
+def not_modified_response(cache_key):
+    not_modified = HttpResponseNotModified()
+    not_modified['ETag'] = etag_for(cache_key)
+    return not_modified
+
+def negotiated_response(response, negotiated):
+    """Mark ``response`` as depending on the Accept header if its format was negotiated."""
+    if negotiated:
+        patch_vary_headers(response, ['Accept'])
+    return response
+
+class ImageAcceptNegotiation(DefaultContentNegotiation):
+    """Leave the Accept header to the view.
+
+    Image requests may accept only image types, which no DRF renderer
+    produces; the view picks the output format from it instead of
+    answering 406.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
 @method_decorator(csrf_exempt, name='dispatch')
 class NegativeImageProxyView(APIView):
+    content_negotiation_class = ImageAcceptNegotiation
+
     def post(self, request):
         # Get the file from the request
         image_file = request.FILES.get('file')
         if not image_file:
             return JsonResponse({'error': 'No file provided'}, status=400)
+        metrics.observe_upload(request, image_file)
         
         # Get the ID token from the request - now optional
         id_token = request.POST.get('id_token')
         
+        # Output settings (format, size, compression) are passed through to the
+        # function; without a format, one is picked from the Accept header
+        fields, negotiated = request_fields(request)
+        
+        # Identical uploads share a content-addressed key, which is also the ETag
+        cache_key = result_key(image_file, {'op': 'negative', **fields})
+        if etag_matches(request, etag_for(cache_key)):
+            return negotiated_response(not_modified_response(cache_key), negotiated)
+        cached = get_result(cache_key)
+        if cached is not None:
+            return negotiated_response(cached_image_response(cached, cache_key), negotiated)
+        
+        # An identical request already calling the function answers this one too
+        ticket = singleflight.join(cache_key)
+        if ticket.result is not None:
+            return negotiated_response(coalesced_response(ticket.result, cache_key), negotiated)
+        
+        # Waiting requests are released when the body has been streamed
+        streaming = False
         try:
-            # Prepare to call the Cloud Function
-            function_url = 'https://us-central1-white-site-459410-c0.cloudfunctions.net/negative-image-function'
+            response = send_with_fallbacks([('file', image_file)], id_token, fields)
+            if response is None:
+                # If we get here, all authentication methods failed
+                return JsonResponse({
+                    'error': 'Failed to call the Cloud Function. Please check the logs for details.'
+                }, status=500)
+            if response.status_code != 200:
+                return relayed_error(response)
             
-            # First try to call the Cloud Function directly without authentication
-            # This is the primary method now that the function is public
-            try:
-                print("Calling Cloud Function without authentication...")
-                files = {'file': (image_file.name, image_file.read(), image_file.content_type)}
-                response = requests.post(function_url, files=files)
+            # Stream the image back as the response
+            django_response = image_response(response, cache_key, ticket)
+            streaming = True
+            return negotiated_response(django_response, negotiated)
                 
-                if response.status_code == 200:
-                    # Return the image as a response
-                    django_response = HttpResponse(response.content, content_type='image/png')
-                    django_response['Content-Disposition'] = 'attachment; filename="negative.png"'
-                    return django_response
-                else:
-                    print(f"Direct call failed with status {response.status_code}")
-                    # If direct call fails and we have a token, try with authentication
-            except Exception as direct_call_error:
-                print(f"Direct call error: {str(direct_call_error)}")
-                # Continue with authentication attempts if we have a token
+        except breaker.CircuitOpen as e:
+            metrics.SHED_REQUESTS.labels('circuit_open').inc()
+            return service_unavailable(str(e), e.retry_after)
+        except Exception as e:
+            print(f"Proxy error: {str(e)}")
+            print(traceback.format_exc())
+            return JsonResponse({'error': f'Proxy error: {str(e)}'}, status=500)
+        finally:
+            if not streaming:
+                ticket.publish(None)
             
-            # Only try with the user's ID token if provided
-            if id_token:
-                try:
-                    # Verify the ID token
-                    try:
-                        # Specify the CLIENT_ID from your Google OAuth credentials
-                        client_id = '790253395116-3tuj7t3amf29guokqj406m5r3i39t0nd.apps.googleusercontent.com'
-                        idinfo = google_id_token.verify_oauth2_token(
-                            id_token, google_requests.Request(), client_id)
-                        
-                        # Check if the token is valid
-                        if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-                            print("Invalid token issuer")
-                            # Continue with other methods instead of returning error
-                        else:
-                            # Log the authenticated user
-                            user_email = idinfo['email']
-                            print(f"Authenticated user: {user_email}")
-                            
-                            # Try with the user's ID token
-                            print("Trying with user's ID token...")
-                            files = {'file': (image_file.name, image_file.read(), image_file.content_type)}
-                            headers = {'Authorization': f'Bearer {id_token}'}
-                            response = requests.post(function_url, files=files, headers=headers)
-                            
-                            if response.status_code == 200:
-                                # Return the image as a response
-                                django_response = HttpResponse(response.content, content_type='image/png')
-                                django_response['Content-Disposition'] = 'attachment; filename="negative.png"'
-                                return django_response
-                            else:
-                                print(f"User token call failed with status {response.status_code}")
-                                # If user token call fails, try with service account
-                    except ValueError as e:
-                        # Invalid token
-                        print(f"Token verification error: {str(e)}")
-                        # Continue with other methods instead of returning error
-                except Exception as user_token_error:
-                    print(f"User token error: {str(user_token_error)}")
-                    # Continue with service account attempt
+    def get(self, request):
+        return JsonResponse({"message": "Negative image proxy is up. Use POST with an image file."})
+
+# Fields that only apply to batch requests
+BATCH_FIELDS = ('archive_format',)
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchNegativeImageProxyView(APIView):
+    """Forward several images (or one ZIP/tar archive) in a single function call.
+
+    The function inverts the items in parallel and returns an archive with
+    a manifest reporting each item's outcome. The proxy streams it through
+    unchanged, so the whole batch costs one auth check and one round-trip.
+    """
+
+    def post(self, request):
+        files = [('file', f) for f in request.FILES.getlist('file')]
+        if 'archive' in request.FILES:
+            files.append(('archive', request.FILES['archive']))
+        if not files:
+            return JsonResponse({'error': 'No files provided'}, status=400)
+        for _, upload in files:
+            metrics.observe_upload(request, upload)
+        
+        id_token = request.POST.get('id_token')
+        fields = transform_fields(request.POST)
+        fields.update({name: request.POST[name] for name in BATCH_FIELDS if request.POST.get(name)})
+        # Tells the function to answer with an archive even for a single file
+        fields['batch'] = '1'
+        
+        try:
+            response = send_with_fallbacks(files, id_token, fields)
+            if response is None:
+                return JsonResponse({
+                    'error': 'Failed to call the Cloud Function. Please check the logs for details.'
+                }, status=500)
+            if response.status_code != 200:
+                return relayed_error(response)
             
-            # Try with service account if available
-            credentials_path = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
-            if credentials_path and os.path.exists(credentials_path):
-                try:
-                    print("Trying with service account...")
-                    # Check if it's a web client or service account
-                    with open(credentials_path, 'r') as f:
-                        creds_data = json.load(f)
-                    
-                    if 'web' in creds_data:
-                        print("Found web client credentials, not service account")
-                    else:
-                        # Assume it's a service account
-                        credentials = service_account.IDTokenCredentials.from_service_account_file(
-                            credentials_path,
-                            target_audience=function_url
-                        )
-                        credentials.refresh(GoogleAuthRequest())
-                        sa_id_token = credentials.token
-                        
-                        files = {'file': (image_file.name, image_file.read(), image_file.content_type)}
-                        headers = {'Authorization': f'Bearer {sa_id_token}'}
-                        response = requests.post(function_url, files=files, headers=headers)
-                        
-                        if response.status_code == 200:
-                            # Return the image as a response
-                            django_response = HttpResponse(response.content, content_type='image/png')
-                            django_response['Content-Disposition'] = 'attachment; filename="negative.png"'
-                            return django_response
-                        else:
-                            print(f"Service account call failed with status {response.status_code}")
-                except Exception as sa_error:
-                    print(f"Service account error: {str(sa_error)}")
-            else:
-                print("No service account credentials found")
+            django_response = StreamingHttpResponse(
+                iter_upstream(response, settings.UPSTREAM_STREAM_CHUNK_SIZE),
+                content_type=response.headers.get('Content-Type', 'application/zip'))
+            for header in ('Content-Length', 'Content-Disposition', 'X-Batch-Errors'):
+                if header in response.headers:
+                    django_response[header] = response.headers[header]
+            return django_response
+        
+        except breaker.CircuitOpen as e:
+            metrics.SHED_REQUESTS.labels('circuit_open').inc()
+            return service_unavailable(str(e), e.retry_after)
+        except Exception as e:
+            print(f"Proxy error: {str(e)}")
+            print(traceback.format_exc())
+            return JsonResponse({'error': f'Proxy error: {str(e)}'}, status=500)
+    
+    def get(self, request):
+        return JsonResponse({"message": "Batch negative image proxy is up. Use POST with several image files or an archive."})
+
+def run_negative_image_job(job):
+    """Job handler: invert a queued upload and write the result to disk."""
+    # Continue the trace of the request that queued the job
+    with tracing.continued(job['params'].get('trace', {})):
+        with tracing.span('negative image job', attributes={'job.id': job['id']}):
+            return process_negative_image_job(job)
+
+def process_negative_image_job(job):
+    fields = job['params']['fields']
+    cache_key = job['params']['cache_key']
+    cached = get_result(cache_key)
+    if cached is not None:
+        with open(jobs.result_path(job['id']), 'wb') as result_file:
+            result_file.write(cached['content'])
+        return cached['content_type']
+    
+    with open(jobs.input_path(job['id']), 'rb') as source:
+        upload = UploadedFile(source, name=job['filename'], content_type=job['content_type'],
+                              size=os.fstat(source.fileno()).st_size)
+        try:
+            response = send_with_fallbacks([('file', upload)], jobs.job_token(job['id']), fields)
+        except breaker.CircuitOpen as e:
+            raise jobs.JobFailed(str(e), 503)
+        if response is None:
+            raise jobs.JobFailed('Failed to call the Cloud Function. Please check the logs for details.')
+        if response.status_code != 200:
+            message = response.text
+            response.close()
+            raise jobs.JobFailed(message, response.status_code)
+        
+        content_type = response.headers.get('Content-Type', 'image/png')
+        chunks = caching_iterator(
+            iter_upstream(response, settings.UPSTREAM_STREAM_CHUNK_SIZE), cache_key, content_type)
+        partial_path = jobs.result_path(job['id']) + '.partial'
+        with open(partial_path, 'wb') as result_file:
+            for chunk in chunks:
+                result_file.write(chunk)
+        os.replace(partial_path, jobs.result_path(job['id']))
+    return content_type
+
+def job_payload(job):
+    """Public view of a job record."""
+    payload = {
+        'job_id': job['id'],
+        'status': job['status'],
+        'created': job['created'],
+        'updated': job['updated'],
+        'status_url': reverse('job_status', args=[job['id']]),
+    }
+    if job['status'] == jobs.DONE:
+        payload['result_url'] = reverse('job_result', args=[job['id']])
+    if job['status'] == jobs.FAILED:
+        payload['error'] = job['error']
+    return payload
+
+def job_not_found(job_id):
+    return JsonResponse({'error': f'Unknown job {job_id}'}, status=404)
+
+@method_decorator(csrf_exempt, name='dispatch')
+class NegativeImageJobView(APIView):
+    """Accept an image for asynchronous inversion and return its job id.
+
+    The upload is queued and the request returns at once with ``202``, so
+    a burst of uploads waits in the queue rather than holding connections
+    open to the Cloud Function.
+    """
+
+    content_negotiation_class = ImageAcceptNegotiation
+
+    def post(self, request):
+        image_file = request.FILES.get('file')
+        if not image_file:
+            return JsonResponse({'error': 'No file provided'}, status=400)
+        metrics.observe_upload(request, image_file)
+        
+        id_token = request.POST.get('id_token')
+        fields, _ = request_fields(request)
+        cache_key = result_key(image_file, {'op': 'negative', **fields})
+        
+        jobs.purge_expired()
+        jobs.start_runner(run_negative_image_job)
+        # The job runs on another thread, so the trace context travels with it
+        job = jobs.new_job({'fields': fields, 'cache_key': cache_key, 'trace': tracing.carrier()},
+                           image_file.name, image_file.content_type, id_token)
+        with open(jobs.input_path(job['id']), 'wb') as destination:
+            for chunk in image_file.chunks():
+                destination.write(chunk)
+        try:
+            jobs.get_queue().submit(job)
+        except jobs.QueueFull as e:
+            jobs.remove_files(job['id'])
+            jobs.forget_token(job['id'])
+            return service_unavailable(str(e), 5)
+        
+        accepted = JsonResponse(job_payload(job), status=202)
+        accepted['Location'] = reverse('job_status', args=[job['id']])
+        return accepted
+
+class JobStatusView(APIView):
+    """Report a job's status; ``?wait=<seconds>`` long-polls until it finishes."""
+
+    def get(self, request, job_id):
+        try:
+            wait = min(float(request.query_params.get('wait', 0)), settings.JOB_MAX_WAIT)
+        except ValueError:
+            return JsonResponse({'error': 'wait must be a number of seconds'}, status=400)
+        
+        job_queue = jobs.get_queue()
+        job = job_queue.wait(job_id, wait) if wait > 0 else job_queue.get(job_id)
+        if job is None:
+            return job_not_found(job_id)
+        return JsonResponse(job_payload(job))
+
+class JobResultView(APIView):
+    """Download the result of a finished job."""
+
+    def get(self, request, job_id):
+        job = jobs.get_queue().get(job_id)
+        if job is None:
+            return job_not_found(job_id)
+        if job['status'] == jobs.FAILED:
+            return JsonResponse({'error': job['error']}, status=job['error_status'] or 500)
+        if job['status'] != jobs.DONE:
+            return JsonResponse(job_payload(job), status=409)
+        
+        cache_key = job['params']['cache_key']
+        if etag_matches(request, etag_for(cache_key)):
+            return not_modified_response(cache_key)
+        try:
+            result_file = open(jobs.result_path(job_id), 'rb')
+        except FileNotFoundError:
+            return job_not_found(job_id)
+        django_response = FileResponse(result_file, content_type=job['result_type'])
+        django_response['Content-Disposition'] = attachment_header(job['result_type'])
+        django_response['ETag'] = etag_for(cache_key)
+        return django_response
+
+async def async_call_function(function_url, files, headers=None, fields=None, timeout=None):
+    """Async counterpart of ``call_function`` using the pooled httpx client."""
+    body = MultipartFileStream(files, fields)
+    headers = {**(headers or {}), 'Content-Type': body.content_type, 'Content-Length': str(len(body))}
+    client = get_async_client()
+    kwargs = {}
+    if timeout is not None:
+        connect, read = timeout
+        # (connect, read, write, pool); pool waits are bounded by the limiter
+        kwargs['timeout'] = (connect, read, read, None)
+    upstream_request = client.build_request(
+        'POST', function_url, headers=headers,
+        content=aiter_stream(body, settings.UPSTREAM_STREAM_CHUNK_SIZE), **kwargs)
+    return await client.send(upstream_request, stream=True)
+
+def async_image_response(upstream, cache_key, on_close, ticket):
+    """Stream a successful async Cloud Function response back to the client."""
+    content_type = upstream.headers.get('Content-Type', 'image/png')
+    chunks = aiter_upstream(upstream, settings.UPSTREAM_STREAM_CHUNK_SIZE, on_close)
+    django_response = StreamingHttpResponse(
+        singleflight.AsyncSharingIterator(chunks, ticket, content_type), content_type=content_type)
+    if 'Content-Length' in upstream.headers and 'Content-Encoding' not in upstream.headers:
+        django_response['Content-Length'] = upstream.headers['Content-Length']
+    django_response['Content-Disposition'] = attachment_header(content_type)
+    django_response['ETag'] = etag_for(cache_key)
+    django_response['X-Cache'] = 'MISS'
+    return django_response
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncNegativeImageProxyView(View):
+    """ASGI variant of NegativeImageProxyView.
+
+    Waiting on the Cloud Function does not hold a thread, so one worker can
+    keep hundreds of image requests in flight. Token verification and
+    minting still use the sync helpers, run in a thread pool.
+    """
+
+    async def post(self, request):
+        if not isinstance(request, ASGIRequest):
+            return JsonResponse({'error': 'This endpoint must be served by an ASGI server'}, status=501)
+        
+        # Parsing the multipart body may spool to disk, so keep it off the event loop
+        image_file = await sync_to_async(lambda: request.FILES.get('file'), thread_sensitive=False)()
+        if not image_file:
+            return JsonResponse({'error': 'No file provided'}, status=400)
+        metrics.observe_upload(request, image_file)
+        
+        id_token = request.POST.get('id_token')
+        
+        fields, negotiated = request_fields(request)
+        cache_key = await sync_to_async(result_key, thread_sensitive=False)(image_file, {'op': 'negative', **fields})
+        if etag_matches(request, etag_for(cache_key)):
+            return negotiated_response(not_modified_response(cache_key), negotiated)
+        cached = await sync_to_async(get_result, thread_sensitive=False)(cache_key)
+        if cached is not None:
+            return negotiated_response(cached_image_response(cached, cache_key), negotiated)
+        
+        # Waiting for an identical request in flight takes no upstream slot
+        ticket = await singleflight.ajoin(cache_key)
+        if ticket.result is not None:
+            return negotiated_response(coalesced_response(ticket.result, cache_key), negotiated)
+        
+        function_url = settings.NEGATIVE_IMAGE_FUNCTION_URL
+        circuit = breaker.get_breaker(function_url)
+        limiter = get_limiter()
+        try:
+            await limiter.acquire()
+        except Overloaded as e:
+            ticket.publish(None)
+            metrics.SHED_REQUESTS.labels('in_flight').inc()
+            return service_unavailable(str(e), 1)
+        try:
+            circuit.acquire()
+        except breaker.CircuitOpen as e:
+            ticket.publish(None)
+            limiter.release()
+            metrics.SHED_REQUESTS.labels('circuit_open').inc()
+            return service_unavailable(str(e), e.retry_after)
+        
+        # The upstream slot is released when the response body has been streamed
+        streaming = False
+        answer = None
+        chain_started = time.perf_counter()
+        try:
+            deadline = upstream_strategy.Deadline()
+            attempts = auth_attempts(function_url, id_token)
+            next_attempt = sync_to_async(next, thread_sensitive=False)
+            attempt_number = 0
+            while not deadline.expired():
+                attempt = await next_attempt(attempts, None)
+                if attempt is None:
+                    break
+                strategy, label, headers = attempt
+                attempt_number += 1
+                timeout = deadline.socket_timeouts()
+                headers = {**headers, **tracing.carrier()}
+                started = time.perf_counter()
+                with tracing.upstream_span(strategy, attempt_number) as span:
+                    try:
+                        response = await upstream_strategy.ahedged(lambda: async_call_function(
+                            function_url, [('file', image_file)], headers, fields, timeout))
+                    except Exception as call_error:
+                        tracing.record_error(span, call_error)
+                        metrics.UPSTREAM_DURATION.labels(strategy, 'exception').observe(time.perf_counter() - started)
+                        upstream_strategy.forget(function_url, strategy)
+                        print(f"{label} error: {str(call_error)}")
+                        continue
+                    tracing.record_status(span, response.status_code)
+                metrics.UPSTREAM_DURATION.labels(strategy, response.status_code).observe(
+                    time.perf_counter() - started)
+                
+                if answered(response):
+                    upstream_strategy.remember(function_url, strategy)
+                    answer = response
+                if response.status_code == 200:
+                    streaming = True
+                    return negotiated_response(
+                        async_image_response(response, cache_key, limiter.release, ticket), negotiated)
+                if response.status_code in CLIENT_ERROR_STATUSES:
+                    await response.aread()
+                    await response.aclose()
+                    return JsonResponse({'error': response.text}, status=response.status_code)
+                upstream_strategy.forget(function_url, strategy)
+                print(f"{label} failed with status {response.status_code}")
+                await response.aclose()
             
-            # If we get here, all authentication methods failed
             return JsonResponse({
                 'error': 'Failed to call the Cloud Function. Please check the logs for details.'
             }, status=500)
-                
+        
         except Exception as e:
             print(f"Proxy error: {str(e)}")
             print(traceback.format_exc())
             return JsonResponse({'error': f'Proxy error: {str(e)}'}, status=500)
-            
-    def get(self, request):
-        return JsonResponse({"message": "Negative image proxy is up. Use POST with an image file."})
+        finally:
+            circuit.record(answer is not None, time.perf_counter() - chain_started)
+            if not streaming:
+                ticket.publish(None)
+                limiter.release()
+    
+    async def get(self, request):
+        return JsonResponse({"message": "Async negative image proxy is up. Use POST with an image file."})
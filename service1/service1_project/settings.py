@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'service_common.metrics.MetricsMiddleware',
+    'hello_app.tracing.TracingMiddleware',
+    'hello_app.uploads.UploadLimitMiddleware',
+    'hello_app.admission.AdmissionMiddleware',
+    'service_common.fastpath.FastPathMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -127,3 +133,263 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_ALL_ORIGINS = True
+
+
+# Prometheus metrics
+# MetricsMiddleware times every request and /metrics exports the results.
+# Set METRICS_ENABLED=0 to turn both off.
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+
+
+# Distributed tracing
+# Spans follow the W3C traceparent header from nginx through this service to
+# the Cloud Function. TRACING_EXPORTER selects where they go: nowhere
+# ("none"), a local JSON-lines file ("file"), stdout ("console") or an
+# OpenTelemetry collector over OTLP/HTTP ("otlp").
+
+TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER', 'none')
+TRACING_SERVICE_NAME = os.environ.get('TRACING_SERVICE_NAME', 'service1')
+
+TRACING_EXPORTERS = {
+    'none': None,
+    'file': {
+        'CLASS': 'hello_app.tracing.JsonLinesSpanExporter',
+        'OPTIONS': {
+            'path': os.environ.get('TRACING_FILE', '/tmp/traces/spans.jsonl'),
+        },
+    },
+    'console': {
+        'CLASS': 'opentelemetry.sdk.trace.export.ConsoleSpanExporter',
+    },
+    'otlp': {
+        'CLASS': 'opentelemetry.exporter.otlp.proto.http.trace_exporter.OTLPSpanExporter',
+        'OPTIONS': {
+            'endpoint': os.environ.get('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces'),
+        },
+    },
+}
+
+
+# Fast path for the greeting endpoint
+# FastPathMiddleware answers these GET routes before the rest of the
+# middleware stack and DRF run. Set FAST_PATH_ENABLED=0 to turn it off.
+
+FAST_PATH_ENABLED = os.environ.get('FAST_PATH_ENABLED', '1') == '1'
+FAST_PATH_ROUTES = {
+    '/api/hello/': 'hello_app.views.hello_message',
+}
+FAST_PATH_CACHE_SIZE = int(os.environ.get('FAST_PATH_CACHE_SIZE', '1024'))
+FAST_PATH_MAX_AGE = int(os.environ.get('FAST_PATH_MAX_AGE', '60'))
+
+# Cloud Function client
+# Each gunicorn worker keeps one pooled keep-alive session to the function.
+
+# Cloud Function that produces the negative image. Point it at a local
+# functions-framework instance to run the whole stack offline.
+NEGATIVE_IMAGE_FUNCTION_URL = os.environ.get(
+    'NEGATIVE_IMAGE_FUNCTION_URL',
+    'https://us-central1-white-site-459410-c0.cloudfunctions.net/negative-image-function')
+UPSTREAM_POOL_CONNECTIONS = int(os.environ.get('UPSTREAM_POOL_CONNECTIONS', '4'))
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', '10'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', '3.05'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', '60'))
+UPSTREAM_RETRY_TOTAL = int(os.environ.get('UPSTREAM_RETRY_TOTAL', '2'))
+UPSTREAM_RETRY_BACKOFF = float(os.environ.get('UPSTREAM_RETRY_BACKOFF', '0.2'))
+# Size of the chunks streamed back to the client from the function's response
+UPSTREAM_STREAM_CHUNK_SIZE = int(os.environ.get('UPSTREAM_STREAM_CHUNK_SIZE', str(64 * 1024)))
+
+# Upstream strategy engine (hello_app/strategy.py)
+# Auth strategies are tried in UPSTREAM_AUTH_ORDER, except that the one that
+# last worked for the function goes first for UPSTREAM_AUTH_MEMORY_TTL
+# seconds. No attempt starts after UPSTREAM_TOTAL_TIMEOUT, and each wait
+# for the function to send data (not the whole attempt) times out after
+# UPSTREAM_ATTEMPT_TIMEOUT, or the time left if that is shorter. With
+# UPSTREAM_HEDGE_AFTER > 0 an attempt that has not answered in that many
+# seconds is sent a second time and the first answer wins.
+UPSTREAM_AUTH_ORDER = [
+    strategy.strip() for strategy in
+    os.environ.get('UPSTREAM_AUTH_ORDER', 'direct,user_token,service_account').split(',') if strategy.strip()
+]
+UPSTREAM_REMEMBER_AUTH = os.environ.get('UPSTREAM_REMEMBER_AUTH', '1') == '1'
+UPSTREAM_AUTH_MEMORY_TTL = float(os.environ.get('UPSTREAM_AUTH_MEMORY_TTL', '300'))
+UPSTREAM_ATTEMPT_TIMEOUT = float(os.environ.get('UPSTREAM_ATTEMPT_TIMEOUT', '30'))
+UPSTREAM_TOTAL_TIMEOUT = float(os.environ.get('UPSTREAM_TOTAL_TIMEOUT', '60'))
+UPSTREAM_HEDGE_AFTER = float(os.environ.get('UPSTREAM_HEDGE_AFTER', '0'))
+UPSTREAM_HEDGE_WORKERS = int(os.environ.get('UPSTREAM_HEDGE_WORKERS', '16'))
+
+# Circuit breaker for the Cloud Function (hello_app/breaker.py)
+# Opens when, over the last CIRCUIT_BREAKER_WINDOW seconds and at least
+# CIRCUIT_BREAKER_MIN_CALLS image requests, the share that failed reaches
+# CIRCUIT_BREAKER_ERROR_RATE or the share slower than
+# CIRCUIT_BREAKER_SLOW_CALL_DURATION seconds reaches
+# CIRCUIT_BREAKER_SLOW_CALL_RATE. Image requests then get a 503 until
+# CIRCUIT_BREAKER_OPEN_SECONDS have passed and
+# CIRCUIT_BREAKER_HALF_OPEN_CALLS probe requests have succeeded.
+CIRCUIT_BREAKER_ENABLED = os.environ.get('CIRCUIT_BREAKER_ENABLED', '1') == '1'
+CIRCUIT_BREAKER_WINDOW = float(os.environ.get('CIRCUIT_BREAKER_WINDOW', '30'))
+CIRCUIT_BREAKER_MIN_CALLS = int(os.environ.get('CIRCUIT_BREAKER_MIN_CALLS', '10'))
+CIRCUIT_BREAKER_ERROR_RATE = float(os.environ.get('CIRCUIT_BREAKER_ERROR_RATE', '0.5'))
+CIRCUIT_BREAKER_SLOW_CALL_DURATION = float(os.environ.get('CIRCUIT_BREAKER_SLOW_CALL_DURATION', '10'))
+CIRCUIT_BREAKER_SLOW_CALL_RATE = float(os.environ.get('CIRCUIT_BREAKER_SLOW_CALL_RATE', '0.8'))
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.environ.get('CIRCUIT_BREAKER_OPEN_SECONDS', '30'))
+CIRCUIT_BREAKER_HALF_OPEN_CALLS = int(os.environ.get('CIRCUIT_BREAKER_HALF_OPEN_CALLS', '2'))
+
+# Admission control for image requests (hello_app/admission.py)
+# Each worker runs at most ADMISSION_MAX_IN_FLIGHT image requests at once;
+# by default one thread fewer than GUNICORN_THREADS, so cheap routes always
+# find a free thread. Requests wait up to ADMISSION_QUEUE_TIMEOUT seconds
+# for a slot, and requests that spent more than ADMISSION_MAX_QUEUE_TIME
+# seconds queued before reaching the worker are rejected outright.
+# Job status polls count too, as a long-poll holds its thread while it waits.
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+ADMISSION_PATHS = ['/api/negative-image/', '/api/jobs/']
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get(
+    'ADMISSION_MAX_IN_FLIGHT', str(max(1, int(os.environ.get('GUNICORN_THREADS', '4')) - 1))))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '0.5'))
+ADMISSION_MAX_QUEUE_TIME = float(os.environ.get('ADMISSION_MAX_QUEUE_TIME', '5'))
+
+# Upload limits (hello_app/uploads.py)
+# Bodies over UPLOAD_MAX_BYTES are rejected from their Content-Length, and
+# 'file' parts are rejected from their first bytes if they are not one of
+# UPLOAD_ALLOWED_FORMATS or declare more than UPLOAD_MAX_PIXELS pixels.
+# Uploads over UPLOAD_SPOOL_THRESHOLD bytes are spooled to UPLOAD_TEMP_DIR
+# (the system default if unset) instead of being kept in memory.
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', str(32 * 1024 * 1024)))
+UPLOAD_MAX_PIXELS = int(os.environ.get('UPLOAD_MAX_PIXELS', str(50_000_000)))
+UPLOAD_ALLOWED_FORMATS = [
+    name.strip() for name in os.environ.get(
+        'UPLOAD_ALLOWED_FORMATS', 'png,jpeg,gif,webp,bmp,tiff,avif').split(',') if name.strip()
+]
+FILE_UPLOAD_HANDLERS = [
+    'hello_app.uploads.ImageUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.environ.get('UPLOAD_SPOOL_THRESHOLD', str(1024 * 1024)))
+FILE_UPLOAD_TEMP_DIR = os.environ.get('UPLOAD_TEMP_DIR') or None
+
+# Service-account ID tokens are refreshed in the background this many
+# seconds before they expire; failed refreshes are retried after the delay.
+SERVICE_ACCOUNT_TOKEN_REFRESH_MARGIN = int(os.environ.get('SERVICE_ACCOUNT_TOKEN_REFRESH_MARGIN', '300'))
+SERVICE_ACCOUNT_TOKEN_RETRY_DELAY = int(os.environ.get('SERVICE_ACCOUNT_TOKEN_RETRY_DELAY', '30'))
+
+# Google ID token verification
+# Point GOOGLE_OAUTH2_CERTS_URL at a local stand-in to verify tokens offline.
+
+GOOGLE_OAUTH_CLIENT_ID = os.environ.get(
+    'GOOGLE_OAUTH_CLIENT_ID', '790253395116-3tuj7t3amf29guokqj406m5r3i39t0nd.apps.googleusercontent.com')
+GOOGLE_OAUTH2_CERTS_URL = os.environ.get('GOOGLE_OAUTH2_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+# Used when the certs response carries no Cache-Control or Expires header
+ID_TOKEN_CERTS_DEFAULT_TTL = int(os.environ.get('ID_TOKEN_CERTS_DEFAULT_TTL', '300'))
+# Minimum gap between refetches triggered by an unknown signing key id
+ID_TOKEN_CERTS_MIN_REFETCH_INTERVAL = int(os.environ.get('ID_TOKEN_CERTS_MIN_REFETCH_INTERVAL', '60'))
+ID_TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('ID_TOKEN_CACHE_MAX_ENTRIES', '1024'))
+ID_TOKEN_CLOCK_SKEW = int(os.environ.get('ID_TOKEN_CLOCK_SKEW', '0'))
+
+# Output format negotiation
+# Image requests without a 'format' field get the first of these formats
+# that their Accept header names (e.g. a browser sending image/webp). Only
+# list formats the deployed function can encode: the pinned Pillow wheel
+# has no AVIF encoder, so "avif" belongs here only after upgrading it.
+IMAGE_NEGOTIATED_FORMATS = [
+    name.strip() for name in os.environ.get('IMAGE_NEGOTIATED_FORMATS', 'webp,png').split(',') if name.strip()
+]
+
+# Negative-image result cache
+# RESULT_CACHE_BACKEND selects an in-memory LRU bounded by total bytes
+# ("memory"), a local directory ("disk"), a Redis-compatible server
+# ("redis", needs the redis package) or no caching at all ("none").
+
+RESULT_CACHE_ALIAS = 'results'
+RESULT_CACHE_BACKEND = os.environ.get('RESULT_CACHE_BACKEND', 'memory')
+RESULT_CACHE_TIMEOUT = int(os.environ.get('RESULT_CACHE_TIMEOUT', '86400'))
+RESULT_CACHE_MAX_ITEM_BYTES = int(os.environ.get('RESULT_CACHE_MAX_ITEM_BYTES', str(8 * 1024 * 1024)))
+
+# Single-flight coalescing of identical image requests (hello_app/singleflight.py)
+# Identical requests wait up to SINGLE_FLIGHT_TIMEOUT seconds for the one
+# already calling the function, sharing results up to SINGLE_FLIGHT_MAX_BYTES.
+# SINGLE_FLIGHT_SHARED extends this across pods through a lock in the
+# result cache, so it needs a shared RESULT_CACHE_BACKEND such as redis.
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', '1') == '1'
+SINGLE_FLIGHT_SHARED = os.environ.get('SINGLE_FLIGHT_SHARED', '0') == '1'
+SINGLE_FLIGHT_TIMEOUT = float(os.environ.get('SINGLE_FLIGHT_TIMEOUT', '65'))
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.environ.get('SINGLE_FLIGHT_POLL_INTERVAL', '0.1'))
+SINGLE_FLIGHT_MAX_BYTES = int(os.environ.get('SINGLE_FLIGHT_MAX_BYTES', str(8 * 1024 * 1024)))
+
+_RESULT_CACHE_BACKENDS = {
+    'memory': {
+        'BACKEND': 'hello_app.cache_backends.ByteSizeLRUCache',
+        'LOCATION': 'negative-image-results',
+        'OPTIONS': {
+            'MAX_BYTES': int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024))),
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    'disk': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('RESULT_CACHE_DIR', '/tmp/negative-image-results'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '1000')),
+        },
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('RESULT_CACHE_URL', 'redis://localhost:6379/0'),
+    },
+    'none': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    RESULT_CACHE_ALIAS: _RESULT_CACHE_BACKENDS[RESULT_CACHE_BACKEND],
+}
+
+# ASGI image proxy (/api/negative-image/async/)
+# Requests beyond ASYNC_PROXY_MAX_IN_FLIGHT wait up to
+# ASYNC_PROXY_QUEUE_TIMEOUT seconds for a slot, with at most
+# ASYNC_PROXY_MAX_QUEUED waiting, before being rejected with a 503.
+
+ASYNC_UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('ASYNC_UPSTREAM_MAX_CONNECTIONS', '200'))
+ASYNC_UPSTREAM_MAX_KEEPALIVE = int(os.environ.get('ASYNC_UPSTREAM_MAX_KEEPALIVE', '50'))
+ASYNC_PROXY_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_PROXY_MAX_IN_FLIGHT', '200'))
+ASYNC_PROXY_MAX_QUEUED = int(os.environ.get('ASYNC_PROXY_MAX_QUEUED', '400'))
+ASYNC_PROXY_QUEUE_TIMEOUT = float(os.environ.get('ASYNC_PROXY_QUEUE_TIMEOUT', '5'))
+
+
+# Asynchronous image jobs (/api/jobs/)
+# JOB_QUEUE_BACKEND "memory" keeps jobs in the accepting process, so it only
+# works with one worker process; "sqlite" shares them between every worker
+# process on the host through JOB_QUEUE_PATH, which must be on a local disk.
+# gunicorn.conf.py picks "sqlite" when it starts more than one worker.
+# Running sqlite jobs hold a JOB_LEASE_SECONDS lease that their worker
+# renews; jobs whose worker died are run again, up to JOB_MAX_ATTEMPTS times.
+# Uploads and results are kept in JOB_STORAGE_DIR for JOB_RESULT_TTL seconds.
+
+JOB_QUEUE_BACKEND = os.environ.get('JOB_QUEUE_BACKEND', 'memory')
+JOB_STORAGE_DIR = os.environ.get('JOB_STORAGE_DIR', '/tmp/negative-image-jobs')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_QUEUE_MAX_PENDING = int(os.environ.get('JOB_QUEUE_MAX_PENDING', '1000'))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', '3600'))
+# Longest a status request may long-poll with ?wait=. A long-poll holds a
+# worker thread (and an admission slot) for the whole wait, so keep it short
+JOB_MAX_WAIT = float(os.environ.get('JOB_MAX_WAIT', '5'))
+
+JOB_QUEUE_BACKENDS = {
+    'memory': {
+        'CLASS': 'hello_app.jobs.InProcessQueue',
+    },
+    'sqlite': {
+        'CLASS': 'hello_app.jobs.SQLiteQueue',
+        'OPTIONS': {
+            'path': os.environ.get('JOB_QUEUE_PATH', os.path.join(JOB_STORAGE_DIR, 'jobs.sqlite3')),
+            'poll_interval': float(os.environ.get('JOB_QUEUE_POLL_INTERVAL', '0.25')),
+            'lease_seconds': float(os.environ.get('JOB_LEASE_SECONDS', '30')),
+            'max_attempts': int(os.environ.get('JOB_MAX_ATTEMPTS', '3')),
+        },
+    },
+}
\ No newline at end of file
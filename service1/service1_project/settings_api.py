@@ -0,0 +1,51 @@
+"""
+API-only settings profile for service1_project.
+
+Select it with DJANGO_SETTINGS_MODULE=service1_project.settings_api. It keeps
+everything from settings.py except the parts the API never uses: admin,
+auth, sessions, messages, the SQLite database and their middleware. Pods
+start faster and every request runs through fewer middleware.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'rest_framework',
+    'corsheaders',
+    'hello_app',
+]
+
+MIDDLEWARE = [
+    'service_common.metrics.MetricsMiddleware',
+    'hello_app.tracing.TracingMiddleware',
+    'hello_app.uploads.UploadLimitMiddleware',
+    'hello_app.admission.AdmissionMiddleware',
+    'service_common.fastpath.FastPathMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request',
+            ],
+        },
+    },
+]
+
+# Nothing queries a database, so none is configured and SQLite is never opened
+DATABASES = {}
+
+AUTH_PASSWORD_VALIDATORS = []
+
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+    'DEFAULT_PERMISSION_CLASSES': [],
+    'UNAUTHENTICATED_USER': None,
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+}
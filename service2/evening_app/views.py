@@ -5,11 +5,14 @@ from django.http import HttpResponse
 
 # Create your views here.
 
+def evening_message(input_text):
+    return f'Good evening, {input_text}'
+
 class GoodEveningView(APIView):
     def get(self, request):
         input_text = request.query_params.get('input', 'Stranger')
         return Response({
-            'message': f'Good evening, {input_text}'
+            'message': evening_message(input_text)
         })
 
 def health_check(request):
@@ -0,0 +1,11 @@
+"""
+Gunicorn configuration for service2.
+
+Run with ``gunicorn -c gunicorn.conf.py``. The settings and the environment
+variables that override them are in ``service_common.gunicorn_conf``.
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'service2_project.settings')
+
+from service_common.gunicorn_conf import *  # noqa: E402,F401,F403
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'service_common.metrics.MetricsMiddleware',
+    'service_common.fastpath.FastPathMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -127,3 +130,22 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_ALL_ORIGINS = True
+
+
+# Prometheus metrics
+# MetricsMiddleware times every request and /metrics exports the results.
+# Set METRICS_ENABLED=0 to turn both off.
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+
+
+# Fast path for the greeting endpoint
+# FastPathMiddleware answers these GET routes before the rest of the
+# middleware stack and DRF run. Set FAST_PATH_ENABLED=0 to turn it off.
+
+FAST_PATH_ENABLED = os.environ.get('FAST_PATH_ENABLED', '1') == '1'
+FAST_PATH_ROUTES = {
+    '/api/evening/': 'evening_app.views.evening_message',
+}
+FAST_PATH_CACHE_SIZE = int(os.environ.get('FAST_PATH_CACHE_SIZE', '1024'))
+FAST_PATH_MAX_AGE = int(os.environ.get('FAST_PATH_MAX_AGE', '60'))
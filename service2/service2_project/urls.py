@@ -14,12 +14,21 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
+from django.conf import settings
 from django.urls import path, include
+from service_common.metrics import metrics_view
 from evening_app.views import health_check
 
 urlpatterns = [
-    path('admin/', admin.site.urls),
     path('api/', include('evening_app.urls')),
     path('', health_check, name='project_health_check'),
 ]
+
+if settings.METRICS_ENABLED:
+    urlpatterns.append(path('metrics', metrics_view, name='metrics'))
+
+# The API-only settings profile leaves the admin out
+if 'django.contrib.admin' in settings.INSTALLED_APPS:
+    from django.contrib import admin
+
+    urlpatterns.append(path('admin/', admin.site.urls))
@@ -0,0 +1,14 @@
+"""
+Code shared by service1 and service2.
+
+``gunicorn_conf``
+    Worker model, limits and Prometheus multiprocess setup; each service's
+    gunicorn.conf.py imports it and overrides what it does differently.
+``metrics``
+    Request timing middleware and the ``/metrics`` view.
+``fastpath``
+    Middleware answering the greeting endpoints without DRF.
+
+Install it next to a service's requirements with ``pip install ../shared``
+(the Dockerfiles do this).
+"""
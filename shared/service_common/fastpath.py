@@ -0,0 +1,108 @@
+"""
+Fast path for the read-only greeting endpoint.
+
+``FastPathMiddleware`` sits first in MIDDLEWARE and answers the routes in
+FAST_PATH_ROUTES itself, skipping the session, auth and CSRF middleware and
+DRF's content negotiation and rendering. Response bodies are cached per
+input in a bounded LRU and carry an ETag and Cache-Control header so nginx
+or a CDN can cache them as well.
+
+Requests that ask for HTML are left to DRF's browsable API if a renderer
+for it is configured; under the JSON-only settings_api profile they get
+JSON from the fast path instead of a 406.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.module_loading import import_string
+from rest_framework.settings import api_settings
+
+
+class ResponseCache:
+    """Thread-safe LRU of ``key -> (body, etag)``."""
+
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+def render(message):
+    """Encode ``{'message': message}`` exactly as DRF's JSONRenderer does."""
+    body = json.dumps({'message': message}, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return body, f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+class FastPathMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.FAST_PATH_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.routes = {path: import_string(target) for path, target in settings.FAST_PATH_ROUTES.items()}
+        self.cache = ResponseCache(settings.FAST_PATH_CACHE_SIZE)
+        self.cache_control = f'public, max-age={settings.FAST_PATH_MAX_AGE}'
+        self.html_renderer = any(
+            renderer.media_type == 'text/html' for renderer in api_settings.DEFAULT_RENDERER_CLASSES)
+        if iscoroutinefunction(self.get_response):
+            # Under ASGI the whole chain, down to the async proxy, stays on the event loop
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.respond(request)
+        return response if response is not None else self.get_response(request)
+
+    async def __acall__(self, request):
+        response = self.respond(request)
+        return response if response is not None else await self.get_response(request)
+
+    def respond(self, request):
+        """The fast-path response to ``request``, or None to pass it down the chain."""
+        build_message = self.routes.get(request.path_info)
+        if build_message is None or request.method != 'GET':
+            return None
+        # Browsers asking for HTML still get DRF's browsable API, where there is one
+        if self.html_renderer and 'text/html' in request.headers.get('Accept', ''):
+            return None
+
+        input_text = request.GET.get('input', 'Stranger')
+        key = (request.path_info, input_text)
+        entry = self.cache.get(key)
+        if entry is None:
+            entry = render(build_message(input_text))
+            self.cache.set(key, entry)
+        body, etag = entry
+
+        if etag in (tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = self.cache_control
+        response['Vary'] = 'Accept'
+        response['Access-Control-Allow-Origin'] = '*'
+        return response
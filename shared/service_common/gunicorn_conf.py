@@ -0,0 +1,110 @@
+"""
+Gunicorn configuration shared by the Django services.
+
+A service's gunicorn.conf.py sets DJANGO_SETTINGS_MODULE, which names the
+project to serve, then does ``from service_common.gunicorn_conf import *``
+and overrides what it does differently. Every setting can be overridden
+through the environment:
+
+GUNICORN_WORKER_CLASS
+    ``sync``, ``gthread`` (default) or ``uvicorn``. ``uvicorn`` serves the
+    ASGI application.
+GUNICORN_WORKERS
+    Worker processes. Defaults to a multiple of the CPUs available to the
+    container (its cgroup quota, if it has one).
+GUNICORN_THREADS
+    Threads per worker for ``gthread``.
+GUNICORN_PRELOAD
+    ``1`` (default) imports the app in the master before forking, so
+    workers share its memory and start faster.
+GUNICORN_MAX_REQUESTS, GUNICORN_MAX_REQUESTS_JITTER
+    Recycle each worker after this many requests, plus a random jitter so
+    workers do not all restart at once.
+GUNICORN_TIMEOUT, GUNICORN_GRACEFUL_TIMEOUT, GUNICORN_KEEPALIVE
+    Worker timeout, shutdown grace period and keep-alive, in seconds.
+PROMETHEUS_MULTIPROC_DIR
+    Where workers write their Prometheus samples so ``/metrics`` can
+    aggregate them. Defaults to a directory under worker_tmp_dir.
+"""
+import math
+import os
+import shutil
+import tempfile
+
+# service1_project, service2_project, ...
+PROJECT = os.environ['DJANGO_SETTINGS_MODULE'].partition('.')[0]
+
+
+def cpu_limit():
+    """Number of CPUs this container may use, rounded up."""
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                quota = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if quota > 0:
+                return max(1, math.ceil(quota / period))
+        except (OSError, ValueError):
+            pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# worker class -> (gunicorn worker class, application, default workers per CPU)
+WORKER_CLASSES = {
+    # Sync workers handle one request at a time, so run more of them
+    'sync': ('sync', f'{PROJECT}.wsgi:application', 2),
+    # Threads overlap network I/O; processes cover CPU work
+    'gthread': ('gthread', f'{PROJECT}.wsgi:application', 1),
+    # One event loop per CPU
+    'uvicorn': ('uvicorn.workers.UvicornWorker', f'{PROJECT}.asgi:application', 1),
+}
+
+_worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+worker_class, wsgi_app, _workers_per_cpu = WORKER_CLASSES[_worker_class]
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', str(cpu_limit() * _workers_per_cpu + 1)))
+threads = int(os.environ.get('GUNICORN_THREADS', '4')) if _worker_class == 'gthread' else 1
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', '100'))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+# Longer than the ingress/nginx idle timeout, so the proxy closes first
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '75'))
+
+# Heartbeat files on tmpfs; a disk-backed /tmp can stall workers in containers
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+# Must be set before the app (and prometheus_client) is imported
+_metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(worker_tmp_dir or tempfile.gettempdir(), f"prometheus-{PROJECT.removesuffix('_project')}"))
+
+
+def on_starting(server):
+    # Samples from a previous run would be added to this one's
+    shutil.rmtree(_metrics_dir, ignore_errors=True)
+    os.makedirs(_metrics_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,79 @@
+"""
+Prometheus request metrics for the services, exported at ``/metrics``.
+
+``MetricsMiddleware`` sits first in MIDDLEWARE and times every request by
+its URL pattern (not the raw path, so ids and query strings do not explode
+the label set). Services define their own metrics alongside these, using
+the same buckets.
+
+Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(set up in gunicorn.conf.py) and ``/metrics`` aggregates all of them.
+"""
+import os
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# From fast-path greetings up to image calls that wait UPSTREAM_READ_TIMEOUT
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Time to produce a response, by URL pattern',
+    ['route', 'method', 'status'], buckets=LATENCY_BUCKETS,
+)
+
+
+def route_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is not None:
+        return match.route
+    # The fast path answers before URL resolution
+    if request.path_info in settings.FAST_PATH_ROUTES:
+        return request.path_info.lstrip('/')
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, started)
+        return response
+
+    def observe(self, request, response, started):
+        # Streamed bodies are not included; this is the time to the first byte
+        REQUEST_DURATION.labels(route_label(request), request.method, response.status_code).observe(
+            time.perf_counter() - started)
+
+
+def metrics_view(request):
+    """Every metric of this process, or of all gunicorn workers, in Prometheus format."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -18,19 +18,21 @@ cd ../terraform
 
 # Build and push service1 image
 echo "Building service1 image..."
-cd ../service1
-docker build --platform linux/amd64 -t ${REGISTRY}/service1:${VERSION} -t ${REGISTRY}/service1:latest .
+# Built from the repository root so the image includes shared/
+cd ..
+docker build --platform linux/amd64 -f service1/Dockerfile -t ${REGISTRY}/service1:${VERSION} -t ${REGISTRY}/service1:latest .
 docker push ${REGISTRY}/service1:${VERSION}
 docker push ${REGISTRY}/service1:latest
-cd ../terraform
+cd terraform
 
 # Build and push service2 image
 echo "Building service2 image..."
-cd ../service2
-docker build --platform linux/amd64 -t ${REGISTRY}/service2:${VERSION} -t ${REGISTRY}/service2:latest .
+# Built from the repository root so the image includes shared/
+cd ..
+docker build --platform linux/amd64 -f service2/Dockerfile -t ${REGISTRY}/service2:${VERSION} -t ${REGISTRY}/service2:latest .
 docker push ${REGISTRY}/service2:${VERSION}
 docker push ${REGISTRY}/service2:latest
-cd ../terraform
+cd terraform
 
 # Update the versions.tf file with new image versions
 cat > versions.tf << EOF
@@ -39,6 +39,7 @@ resource "null_resource" "build_service1_image" {
     service1_views_hash = filesha256("${path.module}/../service1/hello_app/views.py")
     service1_urls_hash = filesha256("${path.module}/../service1/hello_app/urls.py")
     service1_requirements_hash = filesha256("${path.module}/../service1/requirements.txt")
+    shared_hash = sha256(join("", [for f in fileset("${path.module}/../shared", "**/*.{py,toml}") : filesha256("${path.module}/../shared/${f}")]))
   }
 
   provisioner "local-exec" {
@@ -47,7 +48,7 @@ resource "null_resource" "build_service1_image" {
       gcloud auth configure-docker us-central1-docker.pkg.dev --quiet
       
       # Build the service1 image
-      docker build -t us-central1-docker.pkg.dev/${var.project_id}/swe590-project-images/service1:latest ${path.module}/../service1
+      docker build -f ${path.module}/../service1/Dockerfile -t us-central1-docker.pkg.dev/${var.project_id}/swe590-project-images/service1:latest ${path.module}/..
       
       # Push the image to Artifact Registry
       docker push us-central1-docker.pkg.dev/${var.project_id}/swe590-project-images/service1:latest
@@ -63,6 +64,7 @@ resource "null_resource" "build_service2_image" {
     service2_views_hash = filesha256("${path.module}/../service2/evening_app/views.py")
     service2_urls_hash = filesha256("${path.module}/../service2/evening_app/urls.py")
     service2_requirements_hash = filesha256("${path.module}/../service2/requirements.txt")
+    shared_hash = sha256(join("", [for f in fileset("${path.module}/../shared", "**/*.{py,toml}") : filesha256("${path.module}/../shared/${f}")]))
   }
 
   provisioner "local-exec" {
@@ -71,7 +73,7 @@ resource "null_resource" "build_service2_image" {
       gcloud auth configure-docker us-central1-docker.pkg.dev --quiet
       
       # Build the service2 image
-      docker build -t us-central1-docker.pkg.dev/${var.project_id}/swe590-project-images/service2:latest ${path.module}/../service2
+      docker build -f ${path.module}/../service2/Dockerfile -t us-central1-docker.pkg.dev/${var.project_id}/swe590-project-images/service2:latest ${path.module}/..
       
       # Push the image to Artifact Registry
       docker push us-central1-docker.pkg.dev/${var.project_id}/swe590-project-images/service2:latest